@@ -27,9 +27,12 @@ This software is provided without support, warranty, or guarantee.
 Use at your own risk.
 """
 
+import json
 import logging
 import sys
+import time
 import urllib3
+from datetime import datetime
 from urllib.parse import unquote
 
 from flask import Flask
@@ -39,13 +42,19 @@ from flask import jsonify
 from flask import render_template
 from flask import request
 from flask import send_file
+from flask import stream_with_context
 from werkzeug.exceptions import BadRequest
 
 from bootstrapper.lib import archive_utils
+from bootstrapper.lib import artifact_store
 from bootstrapper.lib import bootstrapper_utils
 from bootstrapper.lib import cache_utils
+from bootstrapper.lib import cloud_utils
+from bootstrapper.lib import file_utils
+from bootstrapper.lib import template_cache
 from bootstrapper.lib.db import db_session
 from bootstrapper.lib.db import init_db
+from bootstrapper.lib.db import upgrade_db
 from bootstrapper.lib.exceptions import RequiredParametersError
 from bootstrapper.lib.exceptions import TemplateNotFoundError
 from .lib import jinja2_filters
@@ -108,21 +117,162 @@ def set_object():
     return jsonify(key=key, success=True)
 
 
-@app.route('/bootstrap_openstack', methods=['POST'])
-def bootstrap_openstack():
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """
+    Returns the hit / miss / eviction counters of the in memory cache tier
+    :return: json with 'success', 'stats' and 'status' keys
+    """
+    return jsonify(success=True, stats=cache_utils.stats(), status_code=200)
+
+
+# mime types of the archive types
+_archive_mime_types = {
+    'zip': 'application/zip',
+    'iso': 'application/iso-image',
+    'tgz': 'application/gzip',
+    'encoded_tgz': 'application/octet-stream'
+}
+
+
+def _stream_requested(input_params):
+    """
+    Checks if the archive should be streamed to the client as it is built, instead of being built completely before
+    the response starts. The 'stream' parameter overrides the 'stream_responses' archive option
+    :param input_params: dict of request parameters
+    :return: boolean
+    """
+    stream = input_params.get('stream', config.get('archive', dict()).get('stream_responses', False))
+    return str(stream).lower() in ('true', 'yes', '1')
+
+
+def _stream_archive(base_config, archive_type, file_name, compression=None):
+    """
+    Sends an archive in a chunked response while it is generated. ISO images have a known size up front and are
+    sent with a Content-Length
+    :param base_config: dict of files, see archive_utils.create_archive
+    :param archive_type: 'zip', 'iso', 'tgz' or 'encoded_tgz'
+    :param file_name: name of the attachment
+    :param compression: dict of compression options, see archive_utils.compression_options
+    :return: Response
+    """
     try:
-        input_params = request.get_json() or request.form.to_dict()
-        base_config = bootstrapper_utils.build_base_configs(input_params)
-        base_config = bootstrapper_utils.build_openstack_heat(base_config, input_params, archive=True)
+        chunks, size = archive_utils.stream_archive(base_config, archive_type, compression)
+    except (ValueError, OSError) as e:
+        print('Aborting with no archive created')
+        print(e)
+        abort(500, 'Could not create archive! Check bootstrapper logs for more information')
 
-        archive = archive_utils.create_archive(base_config, input_params['hostname'])
-        mime_type = 'application/zip'
+    response = Response(stream_with_context(chunks), mimetype=_archive_mime_types[archive_type])
+    response.headers['Content-Disposition'] = 'attachment; filename=%s' % file_name
+    if size is not None:
+        response.headers['Content-Length'] = str(size)
 
-        print("archive path is: %s" % archive)
-        if archive is None:
-            abort(500, 'Could not create archive! Check bootstrapper logs for more information')
+    return response
+
+
+def _save_artifact(input_params, base_config, archive_type, file_name, compression=None):
+    """
+    Builds an archive into the artifact store and sends it, see _send_artifact. A previous build of the same request
+    is sent as is when nothing that goes into the archive has changed since
+    :param input_params: dict of request parameters
+    :param base_config: dict of files, see archive_utils.create_archive
+    :param archive_type: 'zip', 'iso', 'tgz' or 'encoded_tgz'
+    :param file_name: name of the attachment
+    :param compression: dict of compression options, see archive_utils.compression_options
+    :return: Response
+    """
+    key = bootstrapper_utils.artifact_key(input_params, base_config, archive_type, compression)
+    artifact = archive_utils.save_artifact(base_config, archive_type, file_name, _archive_mime_types[archive_type],
+                                           compression, key)
+    if artifact is None:
+        print('Aborting with no archive created')
+        abort(500, 'Could not create archive! Check bootstrapper logs for more information')
 
-        return send_file(archive, mimetype=mime_type, as_attachment=True)
+    return _send_artifact(artifact)
+
+
+def _requested_range(artifact):
+    """
+    Works out which part of a retained archive was requested. A Range header is ignored when an If-Range header no
+    longer matches the archive, or when it asks for more than one range
+    :param artifact: dict describing the archive, see archive_utils.get_artifact
+    :return: tuple of start and stop offsets, or None if the range can not be satisfied
+    """
+    size = artifact['size']
+    if request.range is None or request.range.units != 'bytes' or len(request.range.ranges) != 1:
+        return 0, size
+
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != artifact['etag']:
+        return 0, size
+    if if_range.date is not None and if_range.date != datetime.utcfromtimestamp(int(artifact['created'])):
+        return 0, size
+
+    return request.range.range_for_length(size)
+
+
+def _send_artifact(artifact):
+    """
+    Sends a retained archive with a strong ETag, answering conditional and Range requests so interrupted downloads
+    can be resumed. When the WSGI server offers a file wrapper, such as gunicorn, whole archives are sent with
+    sendfile, ranges are always read with artifact_store.iter_range so no more than Content-Length bytes are sent
+    :param artifact: dict describing the archive, see archive_utils.get_artifact
+    :return: Response, or 404 if the archive was removed since it was looked up
+    """
+    size = artifact['size']
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': 'attachment; filename=%s' % artifact['file_name'],
+        'Content-Location': '/archives/%s' % artifact['build_id'],
+        'X-Build-Id': artifact['build_id'],
+        'Cache-Control': 'private, max-age=%d' % max(0, artifact['expires'] - time.time())
+    }
+
+    if request.if_none_match.contains(artifact['etag']):
+        response = Response(status=304, headers=headers)
+        response.set_etag(artifact['etag'])
+        return response
+
+    requested = _requested_range(artifact)
+    if requested is None:
+        headers['Content-Range'] = 'bytes */%d' % size
+        return Response(status=416, headers=headers)
+
+    start, stop = requested
+    status = 200
+    if stop - start != size:
+        status = 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+
+    file_wrapper = request.environ.get('wsgi.file_wrapper', None)
+    try:
+        if request.method == 'HEAD':
+            body = []
+        elif file_wrapper is not None and status == 200:
+            body = file_wrapper(open(artifact['path'], 'rb'), file_utils.read_chunk_size)
+        else:
+            body = artifact_store.iter_range(artifact, start, stop)
+    except FileNotFoundError:
+        # pruned after it was looked up, the archive is opened before any header is sent
+        abort(404, 'Archive not found, it may have expired')
+
+    response = Response(body, status=status, mimetype=artifact['mime_type'], headers=headers,
+                        direct_passthrough=True)
+    response.headers['Content-Length'] = str(stop - start)
+    response.set_etag(artifact['etag'])
+    response.last_modified = int(artifact['created'])
+    response.expires = int(artifact['expires'])
+    return response
+
+
+@app.route('/bootstrap_openstack', methods=['POST'])
+def bootstrap_openstack():
+    try:
+        input_params = request.get_json() or request.form.to_dict()
+        base_config = bootstrapper_utils.build_base_configs(input_params, cache_files=False)
+        base_config = bootstrapper_utils.build_openstack_heat(base_config, input_params, archive=True,
+                                                              cache_files=False)
 
     except (BadRequest, RequiredParametersError):
         abort(400, 'Invalid input parameters')
@@ -130,21 +280,43 @@ def bootstrap_openstack():
         print('Could not load templates!')
         abort(500, 'Could not load template!')
 
+    compression = _get_compression_options(input_params, 'zip')
+    if _stream_requested(input_params):
+        return _stream_archive(base_config, 'zip', input_params['hostname'] + '.zip', compression)
+
+    if archive_utils.artifacts_enabled():
+        return _save_artifact(input_params, base_config, 'zip', input_params['hostname'] + '.zip', compression)
+
+    archive = archive_utils.create_archive_buffer(base_config, input_params['hostname'], compression)
+    mime_type = 'application/zip'
+
+    if archive is None:
+        abort(500, 'Could not create archive! Check bootstrapper logs for more information')
+
+    return send_file(archive, mimetype=mime_type, as_attachment=True,
+                     attachment_filename=input_params['hostname'] + '.zip')
+
 
 @app.route('/bootstrap_kvm', methods=['POST'])
 def bootstrap_kvm():
     try:
         input_params = request.get_json() or request.form.to_dict()
-        base_config = bootstrapper_utils.build_base_configs(input_params)
+        base_config = bootstrapper_utils.build_base_configs(input_params, cache_files=False)
 
-        archive = archive_utils.create_iso(base_config, input_params['hostname'])
+        if _stream_requested(input_params):
+            return _stream_archive(base_config, 'iso', input_params['hostname'] + '.iso')
+
+        if archive_utils.artifacts_enabled():
+            return _save_artifact(input_params, base_config, 'iso', input_params['hostname'] + '.iso')
+
+        archive = archive_utils.create_iso_buffer(base_config, input_params['hostname'])
         mime_type = 'application/iso-image'
 
-        print("archive path is: %s" % archive)
         if archive is None:
             abort(500, 'Could not create archive! Check bootstrapper logs for more information')
 
-        return send_file(archive, mimetype=mime_type, as_attachment=True)
+        return send_file(archive, mimetype=mime_type, as_attachment=True,
+                         attachment_filename=input_params['hostname'] + '.iso')
 
     except (BadRequest, RequiredParametersError):
         abort(400, 'Invalid input parameters')
@@ -157,16 +329,7 @@ def bootstrap_kvm():
 def bootstrap_openstack_tgz():
     try:
         input_params = request.get_json() or request.form.to_dict()
-        base_config = bootstrapper_utils.build_base_configs(input_params)
-
-        archive = archive_utils.create_tgz(base_config, input_params['hostname'])
-        mime_type = 'application/gzip'
-
-        print("archive path is: %s" % archive)
-        if archive is None:
-            abort(500, 'Could not create tgz archive! Check bootstrapper logs for more information')
-
-        return send_file(archive, mimetype=mime_type, as_attachment=True)
+        base_config = bootstrapper_utils.build_base_configs(input_params, cache_files=False)
 
     except (BadRequest, RequiredParametersError):
         abort(400, 'Invalid input parameters')
@@ -174,12 +337,28 @@ def bootstrap_openstack_tgz():
         print('Could not load templates!')
         abort(500, 'Could not load template!')
 
+    compression = _get_compression_options(input_params, 'tgz')
+    if _stream_requested(input_params):
+        return _stream_archive(base_config, 'tgz', input_params['hostname'] + '.tgz', compression)
+
+    if archive_utils.artifacts_enabled():
+        return _save_artifact(input_params, base_config, 'tgz', input_params['hostname'] + '.tgz', compression)
+
+    archive = archive_utils.create_tgz_buffer(base_config, input_params['hostname'], compression)
+    mime_type = 'application/gzip'
+
+    if archive is None:
+        abort(500, 'Could not create tgz archive! Check bootstrapper logs for more information')
+
+    return send_file(archive, mimetype=mime_type, as_attachment=True,
+                     attachment_filename=input_params['hostname'] + '.tgz')
+
 
 @app.route('/bootstrap_aws', methods=['POST'])
 def bootstrap_aws():
     try:
         input_params = request.get_json() or request.form.to_dict()
-        base_config = bootstrapper_utils.build_base_configs(input_params)
+        base_config = bootstrapper_utils.build_base_configs(input_params, cache_files=False)
 
         response = archive_utils.create_s3_bucket(base_config, input_params['hostname'], input_params['aws_location'],
                                                   input_params['aws_key'], input_params['aws_secret']
@@ -200,7 +379,7 @@ def bootstrap_aws():
 def bootstrap_azure():
     try:
         input_params = request.get_json() or request.form.to_dict()
-        base_config = bootstrapper_utils.build_base_configs(input_params)
+        base_config = bootstrapper_utils.build_base_configs(input_params, cache_files=False)
 
         response = archive_utils.create_azure_fileshare(base_config, input_params['hostname'],
                                                         input_params['azure_account_name'],
@@ -222,13 +401,15 @@ def bootstrap_azure():
 def bootstrap_gcp():
     try:
         input_params = bootstrapper_utils.normalize_input_params(request)
-        base_config = bootstrapper_utils.build_base_configs(input_params)
+        base_config = bootstrapper_utils.build_base_configs(input_params, cache_files=False)
 
+        uploads = list()
         response = archive_utils.create_gcp_bucket(base_config, input_params['hostname'],
                                                    input_params['gcp_project_id'],
-                                                   input_params["gcp_access_token"]
+                                                   input_params["gcp_access_token"],
+                                                   uploads
                                                    )
-        return jsonify(response=response)
+        return jsonify(response=response, uploads=uploads)
 
     except KeyError as ke:
         print(ke)
@@ -240,6 +421,14 @@ def bootstrap_gcp():
         abort(500, 'Could not load template!')
 
 
+def _get_compression_options(input_params, archive_type):
+    try:
+        return bootstrapper_utils.get_compression_options(input_params, archive_type)
+    except RequiredParametersError as rpe:
+        print('aborting due to invalid archive_options')
+        abort(400, str(rpe))
+
+
 @app.route('/generate_bootstrap_package', methods=['POST'])
 def generate_bootstrap_package():
     """
@@ -256,7 +445,7 @@ def generate_bootstrap_package():
     try:
         # input_params = request.get_json() or request.form.to_dict()
         input_params = bootstrapper_utils.normalize_input_params(request)
-        base_config = bootstrapper_utils.build_base_configs(input_params)
+        base_config = bootstrapper_utils.build_base_configs(input_params, cache_files=False)
 
     except (BadRequest, RequiredParametersError):
         err_string = '\nRequired variables: hostname'
@@ -274,7 +463,8 @@ def generate_bootstrap_package():
     if 'deployment_type' in input_params and input_params['deployment_type'] == 'openstack':
         print('Including openstack')
         try:
-            base_config = bootstrapper_utils.build_openstack_heat(base_config, input_params, archive=True)
+            base_config = bootstrapper_utils.build_openstack_heat(base_config, input_params, archive=True,
+                                                                  cache_files=False)
         except RequiredParametersError:
             abort(400, 'Could not parse JSON data')
 
@@ -286,16 +476,58 @@ def generate_bootstrap_package():
 
     # user has specified they want an ISO built
     if archive_type == 'iso':
-        archive = archive_utils.create_iso(base_config, input_params['hostname'])
-        mime_type = 'application/iso-image'
+        if _stream_requested(input_params):
+            return _stream_archive(base_config, 'iso', input_params['hostname'] + '.iso')
+
+        if archive_utils.artifacts_enabled():
+            return _save_artifact(input_params, base_config, 'iso', input_params['hostname'] + '.iso')
+
+        archive = archive_utils.create_iso_buffer(base_config, input_params['hostname'])
+        if archive is None:
+            print('Aborting with no archive created')
+            abort(500, 'Could not create archive! Check bootstrapper logs for more information')
+
+        return send_file(archive, mimetype='application/iso-image', as_attachment=True,
+                         attachment_filename=input_params['hostname'] + '.iso')
 
     elif archive_type == 'tgz':
-        archive = archive_utils.create_tgz(base_config, input_params['hostname'])
-        mime_type = 'application/gzip'
+        compression = _get_compression_options(input_params, archive_type)
+        if _stream_requested(input_params):
+            return _stream_archive(base_config, 'tgz', input_params['hostname'] + '.tgz', compression)
+
+        if archive_utils.artifacts_enabled():
+            return _save_artifact(input_params, base_config, 'tgz', input_params['hostname'] + '.tgz', compression)
+
+        archive = archive_utils.create_tgz_buffer(base_config, input_params['hostname'], compression)
+        if archive is None:
+            print('Aborting with no archive created')
+            abort(500, 'Could not create tgz archive! Check bootstrapper logs for more information')
+
+        return send_file(archive, mimetype='application/gzip', as_attachment=True,
+                         attachment_filename=input_params['hostname'] + '.tgz')
 
     elif archive_type == 'encoded_tgz':
-        archive = archive_utils.create_encoded_tgz(base_config, input_params['hostname'])
-        mime_type = 'application/octet-stream'
+        compression = _get_compression_options(input_params, archive_type)
+        if input_params.get('response_format', '') == 'json':
+            # return the encoded archive inline, for example to use directly as user-data
+            encoded = b''.join(archive_utils.iter_encoded_tgz(base_config, compression))
+            return jsonify(success=True, archive=encoded.decode('ascii'), status_code=200)
+
+        if _stream_requested(input_params):
+            return _stream_archive(base_config, 'encoded_tgz', input_params['hostname'] + '.tgz.base64',
+                                   compression)
+
+        if archive_utils.artifacts_enabled():
+            return _save_artifact(input_params, base_config, 'encoded_tgz',
+                                  input_params['hostname'] + '.tgz.base64', compression)
+
+        archive = archive_utils.create_encoded_tgz_buffer(base_config, input_params['hostname'], compression)
+        if archive is None:
+            print('Aborting with no archive created')
+            abort(500, 'Could not create encoded tgz archive! Check bootstrapper logs for more information')
+
+        return send_file(archive, mimetype='application/octet-stream', as_attachment=True,
+                         attachment_filename=input_params['hostname'] + '.tgz.base64')
 
     elif archive_type == 's3':
         required_keys = {'aws_location', 'aws_secret', 'aws_key'}
@@ -343,23 +575,45 @@ def generate_bootstrap_package():
             )
             r.status_code = 400
             return r
+        uploads = list()
         response = archive_utils.create_gcp_bucket(base_config, input_params['hostname'],
                                                    input_params['project_id'],
-                                                   input_params["access_token"]
+                                                   input_params["access_token"],
+                                                   uploads
                                                    )
-        return jsonify(response=response)
+        return jsonify(response=response, uploads=uploads)
 
     else:
-        # no ISO required, just make a zip
-        archive = archive_utils.create_archive(base_config, input_params['hostname'])
-        mime_type = 'application/zip'
+        # no ISO required, just make a zip in memory
+        compression = _get_compression_options(input_params, 'zip')
+        if _stream_requested(input_params):
+            return _stream_archive(base_config, 'zip', input_params['hostname'] + '.zip', compression)
 
-    print("archive path is: %s" % archive)
-    if archive is None:
-        print('Aborting with no archive created')
-        abort(500, 'Could not create archive! Check bootstrapper logs for more information')
+        if archive_utils.artifacts_enabled():
+            return _save_artifact(input_params, base_config, 'zip', input_params['hostname'] + '.zip', compression)
+
+        archive = archive_utils.create_archive_buffer(base_config, input_params['hostname'], compression)
+        if archive is None:
+            print('Aborting with no archive created')
+            abort(500, 'Could not create archive! Check bootstrapper logs for more information')
+
+        return send_file(archive, mimetype='application/zip', as_attachment=True,
+                         attachment_filename=input_params['hostname'] + '.zip')
+
+
+@app.route('/archives/<build_id>', methods=['GET'])
+def get_archive(build_id):
+    """
+    Downloads an archive built while 'artifact_ttl' is set, using the build id from the X-Build-Id header of the
+    original response. Supports Range and If-Range requests to resume interrupted downloads
+    :param build_id: build id of the archive
+    :return: the archive, or 404 if it is unknown or has expired
+    """
+    artifact = archive_utils.get_artifact(build_id)
+    if artifact is None:
+        abort(404, 'Archive not found, it may have expired')
 
-    return send_file(archive, mimetype=mime_type, as_attachment=True)
+    return _send_artifact(artifact)
 
 
 @app.route('/get_bootstrap_variables', methods=['POST'])
@@ -491,6 +745,18 @@ def list_templates():
     return jsonify(success=True, templates=ts, status_code=200)
 
 
+@app.route('/list_content_updates', methods=['GET'])
+def list_content_updates():
+    """
+    Lists the content updates that will be bundled into bootstrap packages, returns a dict of package type to a dict
+    with the following keys, or null if no update of that type is available:
+    name, path, version, size, mtime, sha256
+    :return: json with 'success', 'content_updates' and 'status_code' keys
+    """
+    updates = archive_utils.list_content_updates()
+    return jsonify(success=True, content_updates=updates, status_code=200)
+
+
 @app.route('/get_template', methods=['POST'])
 def get_template():
     input_params = bootstrapper_utils.normalize_input_params(request)
@@ -512,6 +778,15 @@ def list_init_cfg_templates():
     return jsonify(success=True, templates=ts, status_code=200)
 
 
+@app.route('/template_cache_stats', methods=['GET'])
+def template_cache_stats():
+    """
+    Returns the hit / miss counters of the compiled template cache
+    :return: json with 'success', 'stats' and 'status' keys
+    """
+    return jsonify(success=True, stats=template_cache.stats(), status_code=200)
+
+
 @app.route('/render_template', methods=['POST'])
 def render_db_template():
     """
@@ -529,6 +804,58 @@ def render_db_template():
         abort(500, 'Could not load desired template')
 
 
+@app.route('/render_template_batch', methods=['POST'])
+def render_db_template_batch():
+    """
+    Renders a template with many sets of posted variables. Accepts either a JSON object with 'template_name' and
+    'parameters' keys, where 'parameters' is a list of variable dicts, or a JSON lines body with one variable dict per
+    line and the 'template_name' given as a query parameter
+    :return: JSON lines stream with one result per parameter set with 'index', 'success', and 'rendered' or 'message'
+    keys
+    """
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines'):
+        template_name = request.args.get('template_name', None)
+        parameter_sets = _iter_json_lines(request.stream)
+    else:
+        input_params = bootstrapper_utils.normalize_input_params(request)
+        template_name = input_params.get('template_name', None)
+        parameter_sets = input_params.get('parameters', None)
+        if not isinstance(parameter_sets, list):
+            parameter_sets = None
+
+    if template_name is None or parameter_sets is None:
+        abort(400, 'Not all required keys for render_template_batch are present')
+
+    try:
+        results = bootstrapper_utils.compile_template_batch(template_name, parameter_sets)
+        # load the template now so a missing template is reported before the response starts
+        first = next(results, None)
+    except TemplateNotFoundError as tne:
+        print(tne)
+        abort(500, 'Could not load desired template')
+
+    def generate():
+        if first is None:
+            return
+
+        yield json.dumps(first) + '\n'
+        for result in results:
+            yield json.dumps(result) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def _iter_json_lines(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line.decode('utf-8'))
+        except ValueError:
+            yield None
+
+
 @app.route('/get_template_variables', methods=['POST'])
 def get_template_variables():
     print('Getting variables from a single template')
@@ -565,6 +892,18 @@ def init_application():
     app.logger.setLevel(logging.DEBUG)
     print('Init App')
 
+    cache_utils.configure(**config.get('cache', dict()))
+    archive_utils.configure(**config.get('archive', dict()))
+    cloud_utils.configure(**config.get('cloud', dict()))
+    template_cache.configure(render_memo=config.get('render_memo', False))
+    jinja2_filters.configure(**config.get('hash_filters', dict()))
+    for f in jinja2_filters.defined_filters:
+        app.jinja_env.filters[f] = getattr(jinja2_filters, f)
+
+    # share compiled templates between workers, compiling the file based templates now if not already cached
+    app.jinja_env.bytecode_cache = template_cache.get_bytecode_cache()
+    template_cache.precompile_directory_templates(app.jinja_env, ('panos/', 'openstack/'))
+
     import os
     if not os.path.exists('/var/tmp/.bootstrap_complete'):
         init_db()
@@ -572,9 +911,9 @@ def init_application():
         bootstrapper_utils.import_templates()
         with open('/var/tmp/.bootstrap_complete', 'w+') as init_complete:
             init_complete.write('done')
-
-    for f in jinja2_filters.defined_filters:
-        app.jinja_env.filters[f] = getattr(jinja2_filters, f)
+    else:
+        # ensure databases created by older versions have all the required columns
+        upgrade_db()
 
 
 if __name__ == '__main__':
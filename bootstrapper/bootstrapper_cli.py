@@ -25,7 +25,7 @@ def build_bootstrap_gcp(input_config):
         yaml_conf = input_config.read()
         payload = yaml.load(yaml_conf)
         print(payload)
-        base_config = bootstrapper_utils.build_base_configs(payload)
+        base_config = bootstrapper_utils.build_base_configs(payload, cache_files=False)
 
         if not set(['GCP_PROJECT_ID', 'GCP_ACCESS_TOKEN']).issubset(set(os.environ)):
             print('GCP bootstrap type requires GCP_PROJECT_ID and GCP_ACCESS_TOKEN')
@@ -62,7 +62,7 @@ def build_bootstrap_azure(input_config):
         yaml_conf = input_config.read()
         payload = yaml.load(yaml_conf)
         print(payload)
-        base_config = bootstrapper_utils.build_base_configs(payload)
+        base_config = bootstrapper_utils.build_base_configs(payload, cache_files=False)
 
         if not set(['AZURE_STORAGE_ACCOUNT', 'AZURE_STORAGE_ACCESS_KEY']).issubset(set(os.environ)):
             print('Azure bootstrap type requires AZURE_STORAGE_ACCOUNT and AZURE_STORAGE_ACCESS_KEY')
@@ -100,7 +100,7 @@ def build_bootstrap_aws(input_config):
         yaml_conf = input_config.read()
         payload = yaml.load(yaml_conf)
         # print(payload)
-        base_config = bootstrapper_utils.build_base_configs(payload)
+        base_config = bootstrapper_utils.build_base_configs(payload, cache_files=False)
 
         if not set(['AWS_LOCATION', 'AWS_SECRET_KEY', 'AWS_ACCESS_KEY']).issubset(set(os.environ)):
             print('s3 bootstrap type requires AWS_LOCATION, AWS_ACCESS_KEY, and AWS_SECRET_KEY')
@@ -140,7 +140,7 @@ def build_bootstrap_iso(input_arg):
         yaml_conf = input_arg.read()
         payload = yaml.load(yaml_conf)
         print(payload)
-        base_config = bootstrapper_utils.build_base_configs(payload)
+        base_config = bootstrapper_utils.build_base_configs(payload, cache_files=False)
         archive_path = archive_utils.create_iso(base_config, payload['hostname'])
 
         if archive_path is None:
@@ -216,6 +216,17 @@ def get_template(template_name):
     sys.exit(0)
 
 
+@app.cli.command('rebuild_template_variables')
+def rebuild_template_variables():
+    """
+    Re-parses all templates in the db and rebuilds the index of variables defined therein
+    """
+    init_application()
+    indexed = bootstrapper_utils.rebuild_template_variables()
+    print('Indexed variables for %s templates' % indexed)
+    sys.exit(0)
+
+
 @app.cli.command('init')
 def init_cli():
     init_application()
@@ -225,6 +236,7 @@ app.cli.add_command(init_cli)
 app.cli.add_command(get_template)
 app.cli.add_command(import_template)
 app.cli.add_command(list_templates)
+app.cli.add_command(rebuild_template_variables)
 app.cli.add_command(build_bootstrap_iso)
 app.cli.add_command(build_bootstrap_azure)
 app.cli.add_command(build_bootstrap_gcp)
@@ -1,26 +1,498 @@
+import base64
 import logging
+import mimetypes
 import os
+import posixpath
 import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import time
 import uuid
+import zipfile
+import zlib
 
-import boto3
-import requests
 from azure.common import AzureException
-from azure.storage.file import FileService
+from azure.common import AzureMissingResourceHttpError
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import BotoCoreError
 from botocore.exceptions import ClientError
 from google.api_core.exceptions import BadRequest
+from google.api_core.exceptions import GoogleAPIError
 from google.auth.exceptions import GoogleAuthError
-from google.cloud import storage
-from google.oauth2.credentials import Credentials
 
+from . import artifact_store
 from . import cache_utils
+from . import cloud_utils
+from . import compression_utils
+from . import content_catalog
+from . import file_utils
+from . import iso_utils
+from . import member_store
 
 _archive_dir = '/var/tmp/bootstrapper'
 _content_update_dir = '/var/tmp/content_updates/'
 
+# skeleton directories of a PAN-OS bootstrap package
+_bootstrap_dirs = ['config', 'content', 'software', 'license']
+# content update types that are needed for licensed features
+_content_update_types = ['appthreat', 'antivirus', 'wildfire', 'wildfire2', 'app']
+# archives are built in memory until they grow past this size, then they are moved to a temp file in _archive_dir
+_spool_max_size = 32 * 1024 * 1024
+# streamed archives are sent in pieces of at least this size
+_stream_chunk_size = 256 * 1024
+# PAN-OS software images that can be requested with the 'software_image' parameter are staged here
+_software_image_dir = '/var/tmp/software_images/'
+# longest wait in seconds between checks of a server side copy in an Azure file share
+_azure_copy_max_delay = 30
+# zip format values, see the PKWARE APPNOTE. Version 2.0 has deflate and directories, 4.5 has zip64
+_zip_version = 20
+_zip64_version = 45
+_zip_system_unix = 3
+_zip_data_descriptor_flag = 0x08
+_zip_utf8_flag = 0x800
+
+# archive options, see the 'archive' section of conf/configuration.yaml
+__options = {
+    'iso_mkisofs_fallback': False,
+    'precompressed_members': True,
+    'precompressed_dir': '/var/tmp/bootstrapper/precompressed',
+    'precompressed_min_size': 1024 * 1024,
+    'precompressed_max_bytes': 8 * 1024 * 1024 * 1024,
+    # completed archives are kept for artifact_ttl seconds so downloads can be resumed, 0 disables this
+    'artifact_dir': '/var/tmp/bootstrapper/artifacts',
+    'artifact_ttl': 0,
+    # least recently used archives are removed once the artifact store grows past this size in bytes, 0 never does
+    'artifact_max_bytes': 4 * 1024 * 1024 * 1024,
+    # identical requests are served from the artifact store instead of building the archive again
+    'artifact_cache': False,
+    # modification time of every member, fixed so identical inputs build byte for byte identical archives. 0 uses
+    # the time of the build
+    'archive_mtime': 315532800,
+    # compression settings per archive type, see compression_utils.default_options
+    'compression': dict(),
+    'store_extensions': compression_utils.default_store_extensions
+}
+
 log = logging.getLogger(__name__)
 
 
+def _archive_mtime():
+    """
+    Returns the modification time given to every member of an archive. The fixed 'archive_mtime' is only used while
+    'artifact_cache' is set, otherwise members carry the time they were built
+    :return: seconds since the epoch
+    """
+    if __options['artifact_cache'] and __options['archive_mtime']:
+        return __options['archive_mtime']
+    return int(time.time())
+
+
+def _iter_file_contents(file_entry):
+    """
+    Returns the contents of a file from the files dict piece by piece
+    :param file_entry: dict with either a 'contents' key holding a string or an iterable of strings, such as the
+    generator from a jinja2 Template.generate call, or a 'key' to the contents in the cache
+    :return: generator of strings
+    """
+    if 'contents' in file_entry:
+        contents = file_entry['contents']
+        if isinstance(contents, str):
+            yield contents
+        else:
+            for chunk in contents:
+                yield chunk
+    else:
+        yield cache_utils.get(file_entry['key'])
+
+
+def _archive_members(files):
+    """
+    Lists all the members of a bootstrap package built from the given files dict, without creating anything on disk
+    :param files: A dict of files, see _create_archive_directory
+    :return: list of (archive_name, source_path, file_entry) tuples. Directories have neither a source_path nor a
+    file_entry, content updates and software images have a source_path on the local filesystem that is read in place,
+    and rendered files have the file_entry from the files dict
+    """
+    members = list()
+    directories = list(_bootstrap_dirs)
+    for f in files:
+        archive_path = os.path.normpath(files[f]['archive_path'])
+        if archive_path != '.' and archive_path not in directories:
+            directories.append(archive_path)
+
+    for d in directories:
+        members.append((d + '/', None, None))
+
+    for package_type in _content_update_types:
+        latest_update = check_latest_update(package_type)
+        if latest_update is not None:
+            members.append(('content/' + os.path.basename(latest_update), latest_update, None))
+
+    # sorted so the same files always give the same archive
+    for f in sorted(files, key=lambda name: os.path.normpath(os.path.join(files[name]['archive_path'], name))):
+        archive_path = os.path.normpath(os.path.join(files[f]['archive_path'], f))
+        if 'source_path' in files[f]:
+            members.append((archive_path, files[f]['source_path'], None))
+        else:
+            members.append((archive_path, None, files[f]))
+
+    return members
+
+
+def _precompressed_member(source_path, compresslevel=6):
+    """
+    Looks up the precompressed copy of a large static file such as a content update or software image
+    :param source_path: path of the file
+    :param compresslevel: zlib compression level, 0 for files that are stored as is
+    :return: dict from member_store.get_member or None if the file should be compressed as part of the archive
+    """
+    if not __options['precompressed_members']:
+        return None
+
+    try:
+        if os.path.getsize(source_path) < __options['precompressed_min_size']:
+            return None
+
+        return member_store.get_member(source_path, __options['precompressed_dir'], compresslevel,
+                                       __options['precompressed_max_bytes'])
+    except (OSError, ValueError, zlib.error) as e:
+        log.error('Could not precompress %s' % source_path)
+        log.error(e)
+        return None
+
+
+class _ZipWriter(object):
+    """
+    Writes a zip archive to a file object that only needs a write method, so the archive can be streamed. Members
+    compressed while they are written are followed by a data descriptor holding their CRC and sizes, members whose CRC
+    and sizes are known up front, such as precompressed ones, are copied as is. Members and the archive switch to
+    zip64 as needed. zipfile.ZipFile has no public way to copy an already deflated member, nor to set the level of a
+    member before Python 3.7, hence this writer
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.members = list()
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    @staticmethod
+    def _member(name, date_time, external_attr, compress_type):
+        try:
+            encoded_name = name.encode('ascii')
+            flags = 0
+        except UnicodeEncodeError:
+            encoded_name = name.encode('utf-8')
+            flags = _zip_utf8_flag
+
+        return {
+            'name': encoded_name,
+            'flags': flags,
+            'compress_type': compress_type,
+            'dostime': date_time[3] << 11 | date_time[4] << 5 | date_time[5] // 2,
+            'dosdate': (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2],
+            'external_attr': external_attr,
+            'crc': 0,
+            'size': 0,
+            'compressed_size': 0,
+            'offset': 0,
+            'version': _zip_version
+        }
+
+    def _write_local_header(self, member, zip64):
+        member['offset'] = self.offset
+        size, compressed_size = member['size'], member['compressed_size']
+        extra = b''
+        if zip64:
+            member['version'] = _zip64_version
+            extra = struct.pack('<2H2Q', 1, 16, size, compressed_size)
+            size = compressed_size = 0xFFFFFFFF
+
+        self._write(struct.pack('<4s5H3L2H', b'PK\x03\x04', member['version'], member['flags'],
+                                member['compress_type'], member['dostime'], member['dosdate'], member['crc'],
+                                compressed_size, size, len(member['name']), len(extra)) + member['name'] + extra)
+
+    def write_raw(self, name, date_time, external_attr, compress_type, crc, size, compressed_size, chunks):
+        """
+        Writes a member whose CRC and sizes are known, copying its data as is
+        :param name: name of the member in the archive, directories end with a /
+        :param date_time: (year, month, day, hour, minute, second) tuple
+        :param external_attr: file mode and attributes of the member
+        :param compress_type: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED, the compression of the data
+        :param crc: CRC-32 of the uncompressed data
+        :param size: size in bytes of the uncompressed data
+        :param compressed_size: size in bytes of the data as written
+        :param chunks: iterable of bytes of the data as written, a raw deflate stream for zipfile.ZIP_DEFLATED
+        :return: generator that advances once per chunk written
+        """
+        member = self._member(name, date_time, external_attr, compress_type)
+        member.update(crc=crc, size=size, compressed_size=compressed_size)
+        self._write_local_header(member, size > zipfile.ZIP64_LIMIT or compressed_size > zipfile.ZIP64_LIMIT)
+        for chunk in chunks:
+            self._write(chunk)
+            yield
+
+        self.members.append(member)
+
+    def write_stream(self, name, date_time, external_attr, compress_type, level, chunks, size_hint=0):
+        """
+        Writes a member, computing its CRC and compressing it while it is written
+        :param name: name of the member in the archive
+        :param date_time: (year, month, day, hour, minute, second) tuple
+        :param external_attr: file mode and attributes of the member
+        :param compress_type: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+        :param level: zlib compression level used for zipfile.ZIP_DEFLATED
+        :param chunks: iterable of bytes of the uncompressed data
+        :param size_hint: expected size in bytes of the uncompressed data, members that may grow past the zip64 limit
+        need it to be written as zip64
+        :return: generator that advances once per chunk written
+        :raises ValueError: if the compression is not supported or a member without a size_hint needs zip64
+        """
+        if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError('Unsupported zip compression %s for %s' % (compress_type, name))
+
+        member = self._member(name, date_time, external_attr, compress_type)
+        member['flags'] |= _zip_data_descriptor_flag
+        # deflate can make incompressible data slightly larger, leave some room like zipfile does
+        zip64 = size_hint * 1.05 > zipfile.ZIP64_LIMIT
+        self._write_local_header(member, zip64)
+
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if compress_type == zipfile.ZIP_DEFLATED else None
+        crc = 0
+        size = 0
+        compressed_size = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            compressed_size += len(chunk)
+            self._write(chunk)
+            yield
+
+        if compressor is not None:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            self._write(chunk)
+
+        if not zip64 and (size > zipfile.ZIP64_LIMIT or compressed_size > zipfile.ZIP64_LIMIT):
+            raise ValueError('%s is too large for a zip member without zip64' % name)
+
+        member.update(crc=crc, size=size, compressed_size=compressed_size)
+        if zip64:
+            self._write(struct.pack('<4sL2Q', b'PK\x07\x08', crc, compressed_size, size))
+        else:
+            self._write(struct.pack('<4s3L', b'PK\x07\x08', crc, compressed_size, size))
+
+        self.members.append(member)
+
+    def close(self):
+        """
+        Writes the central directory, after which nothing more can be added to the archive
+        :return: None
+        """
+        central_directory_offset = self.offset
+        for member in self.members:
+            # the zip64 extra field holds, in this order, the values that do not fit their 32 bit field
+            values = list()
+            fields = list()
+            for key in ('size', 'compressed_size', 'offset'):
+                if member[key] > zipfile.ZIP64_LIMIT:
+                    values.append(member[key])
+                    fields.append(0xFFFFFFFF)
+                else:
+                    fields.append(member[key])
+
+            extra = b''
+            version = member['version']
+            if values:
+                extra = struct.pack('<2H%dQ' % len(values), 1, 8 * len(values), *values)
+                version = _zip64_version
+
+            self._write(struct.pack('<4s6H3L5H2L', b'PK\x01\x02', _zip_system_unix << 8 | version, version,
+                                    member['flags'], member['compress_type'], member['dostime'], member['dosdate'],
+                                    member['crc'], fields[1], fields[0], len(member['name']), len(extra), 0, 0, 0,
+                                    member['external_attr'], fields[2]) + member['name'] + extra)
+
+        count = len(self.members)
+        central_directory_size = self.offset - central_directory_offset
+        if count > 0xFFFF or central_directory_size > zipfile.ZIP64_LIMIT or \
+                central_directory_offset > zipfile.ZIP64_LIMIT:
+            zip64_end_offset = self.offset
+            self._write(struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, _zip64_version, _zip64_version, 0, 0, count,
+                                    count, central_directory_size, central_directory_offset))
+            self._write(struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_end_offset, 1))
+            count = min(count, 0xFFFF)
+            central_directory_size = min(central_directory_size, 0xFFFFFFFF)
+            central_directory_offset = min(central_directory_offset, 0xFFFFFFFF)
+
+        self._write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, count, count, central_directory_size,
+                                central_directory_offset, 0))
+
+
+def _store_compressed(source_path, compression):
+    """
+    Checks if a content update or software image should be stored as is because it is already compressed
+    :param source_path: path of the file
+    :param compression: dict of compression options, see compression_options
+    :return: boolean
+    """
+    if not compression['store_compressed']:
+        return False
+
+    return compression_utils.is_compressed_file(source_path, __options['store_extensions'])
+
+
+def compression_options(archive_type, overrides=None):
+    """
+    Returns the compression settings of an archive type, see the 'compression' key of the 'archive' section of
+    conf/configuration.yaml
+    :param archive_type: 'zip', 'tgz' or 'encoded_tgz'
+    :param overrides: dict of settings from the request that replace the configured ones
+    :return: dict with 'level', 'store_compressed', 'threads' and 'parallel_min_size' keys
+    :raises ValueError: if a setting is unknown or out of range
+    """
+    return compression_utils.resolve_options(__options['compression'].get(archive_type, None), overrides)
+
+
+def _iter_zip_writes(writer, files, compression):
+    """
+    Writes the members of the bootstrap package into a zip archive
+    :param writer: _ZipWriter of the archive
+    :param files: A dict of files, see _write_zip
+    :param compression: dict of compression options, see compression_options
+    :return: generator that advances once per chunk written, so the output can be sent while the archive is built
+    """
+    level = compression['level']
+    compress_type = zipfile.ZIP_DEFLATED if level > 0 else zipfile.ZIP_STORED
+    date_time = time.gmtime(_archive_mtime())[:6]
+    for name, source_path, file_entry in _archive_members(files):
+        if source_path is None and file_entry is None:
+            yield from writer.write_raw(name, date_time, 0o40755 << 16 | 0x10, zipfile.ZIP_STORED, 0, 0, 0, ())
+
+        elif source_path is not None:
+            # the size is known up front so members over 4GiB are written as zip64
+            size = os.path.getsize(source_path)
+            stored = level == 0 or _store_compressed(source_path, compression)
+            # members that are stored only keep their crc in the member store
+            precompressed = _precompressed_member(source_path, 0 if stored else level)
+            if precompressed is not None:
+                # the crc is already known, copy the deflated stream if it is smaller or the file as is
+                if precompressed['compressed_size'] < precompressed['size']:
+                    yield from writer.write_raw(name, date_time, 0o644 << 16, zipfile.ZIP_DEFLATED,
+                                                precompressed['crc32'], precompressed['size'],
+                                                precompressed['compressed_size'],
+                                                file_utils.iter_file(precompressed['deflate_path']))
+                else:
+                    yield from writer.write_raw(name, date_time, 0o644 << 16, zipfile.ZIP_STORED,
+                                                precompressed['crc32'], precompressed['size'], precompressed['size'],
+                                                file_utils.iter_file(source_path))
+                continue
+
+            yield from writer.write_stream(name, date_time, 0o644 << 16,
+                                           zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED, level,
+                                           file_utils.iter_file(source_path), size)
+
+        else:
+            contents = (chunk.encode('utf-8') for chunk in _iter_file_contents(file_entry))
+            yield from writer.write_stream(name, date_time, 0o644 << 16, file_entry.get('compress_type', compress_type),
+                                           level, contents)
+
+
+def _write_zip(fileobj, files, compression=None):
+    """
+    Writes a zip archive of the bootstrap package to the given file object
+    :param fileobj: file like object opened for writing
+    :param files: A dict of files, see _create_archive_directory. Each file may also include a 'compress_type' key
+    with zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED to override the compression of that member
+    :param compression: dict of compression options, see compression_options. Level 0 stores every member. Large
+    content updates and software images are copied from the precompressed member store, deflated if that makes them
+    smaller, files that are already compressed are stored when 'store_compressed' is set
+    :return: None
+    """
+    if compression is None:
+        compression = compression_options('zip')
+
+    writer = _ZipWriter(fileobj)
+    for _ in _iter_zip_writes(writer, files, compression):
+        pass
+
+    writer.close()
+
+
+class _StreamBuffer(object):
+    """
+    Write only file object that holds what was written until it is taken with drain
+    """
+
+    def __init__(self):
+        self.chunks = list()
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = list()
+        self.size = 0
+        return data
+
+
+def iter_zip(files, compression=None):
+    """
+    Generates a zip archive of the bootstrap package piece by piece, no files are written to disk. Members are
+    written with data descriptors and switch to zip64 as needed, content updates and software images are read
+    straight from their source paths
+    :param files: A dict of files, see _create_archive_directory
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
+    :return: generator of bytes
+    """
+    if compression is None:
+        compression = compression_options('zip')
+
+    stream = _StreamBuffer()
+    writer = _ZipWriter(stream)
+    for _ in _iter_zip_writes(writer, files, compression):
+        if stream.size >= _stream_chunk_size:
+            yield stream.drain()
+
+    writer.close()
+    yield stream.drain()
+
+
+def create_archive_buffer(files, archive_name, compression=None):
+    """
+    Creates a zip file of the desired files with the desired structure entirely in memory, or in a temporary file
+    for large packages. No directory tree is created
+    :param files: A dict of files, see create_archive
+    :param archive_name: the name of the archive to create
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
+    :return: file object positioned at the start of the zip archive or None on error
+    """
+    log.info('create_archive_buffer with name %s' % archive_name)
+
+    try:
+        if not os.path.exists(_archive_dir):
+            os.makedirs(_archive_dir)
+
+        zip_buffer = tempfile.SpooledTemporaryFile(max_size=_spool_max_size, dir=_archive_dir)
+        _write_zip(zip_buffer, files, compression)
+        zip_buffer.seek(0)
+        return zip_buffer
+    except (ValueError, OSError, zipfile.BadZipFile) as e:
+        log.error('Could not make zip archive')
+        log.error(e)
+        return None
+
+
 def _create_archive_directory(files, archive_name):
     """
     Creates a directory structure from the given files dict
@@ -33,7 +505,9 @@ def _create_archive_directory(files, archive_name):
                     }
                 }
     Each key of the dict is a filename that will be created. The contents of the file will be retrieved from the cache
-    system using the cache_utils library. The file will be placed in the relative path given by the 'archive_path'
+    system using the cache_utils library, or taken from a 'contents' key in place of the 'key' if present. A
+    'source_path' key in place of the 'key' links an existing file, such as a software image, into the directory. The
+    file will be placed in the relative path given by the 'archive_path'
     :param archive_name: the name of the archive to create
     :return: path to the newly created directory or None on error
     """
@@ -61,15 +535,15 @@ def _create_archive_directory(files, archive_name):
         os.makedirs(content_dir)
 
     # iterate through the content updates that is needed for licensed features
-    for package_type in ['appthreat', 'antivirus', 'wildfire', 'wildfire2', 'app']:
+    for package_type in _content_update_types:
         # grab the latest version in the update cache dir (populated manually or via another container volume mount)
         latest_update = check_latest_update(package_type)
         # we have an update
         if latest_update is not None:
-            # craft the absolute path to where we want to copy the file
+            # craft the absolute path to where we want to place the file
             destination_file = os.path.join(content_dir, os.path.basename(latest_update))
-            # copy the file from the content cache dir into the archive dir
-            shutil.copyfile(latest_update, destination_file)
+            # link the file from the content cache dir into the archive dir, only copying it as a last resort
+            file_utils.link_or_copy(latest_update, destination_file)
 
     software_dir = os.path.join(archive_base_dir, archive_name, 'software')
     if not os.path.exists(software_dir):
@@ -90,9 +564,12 @@ def _create_archive_directory(files, archive_name):
             log.error('Could not create archive subdirectory')
             return None
         try:
-            with open(os.path.abspath(archive_file), 'w') as tmp_file:
-                contents = cache_utils.get(files[f]['key'])
-                tmp_file.write(contents)
+            if 'source_path' in files[f]:
+                file_utils.link_or_copy(files[f]['source_path'], archive_file)
+            else:
+                with open(os.path.abspath(archive_file), 'w') as tmp_file:
+                    for chunk in _iter_file_contents(files[f]):
+                        tmp_file.write(chunk)
         except OSError:
             log.error('Could not write archive file into directory')
             return None
@@ -100,7 +577,7 @@ def _create_archive_directory(files, archive_name):
     return archive_file_path
 
 
-def create_archive(files, archive_name):
+def create_archive(files, archive_name, compression=None):
     """
     Creates a zip file of the desired files with the desired structure.
     :param files: A dict of files with the following structure:
@@ -114,22 +591,99 @@ def create_archive(files, archive_name):
     Each key of the dict is a filename that will be created. The contents of the file will be retrieved from the cache
     system using the cache_utils library. The file will be placed in the relative path given by the 'archive_path'
     :param archive_name: the name of the archive to create
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
     :return: path to the newly created archive or None on error
     """
 
+    archive_base_dir = os.path.join(_archive_dir, str(uuid.uuid4()))
+    zip_file = os.path.join(archive_base_dir, archive_name + '.zip')
+
+    try:
+        os.makedirs(archive_base_dir)
+        with open(zip_file, 'wb') as zip_file_object:
+            _write_zip(zip_file_object, files, compression)
+    except (ValueError, OSError, zipfile.BadZipFile) as e:
+        log.error('Could not make zip archive')
+        log.error(e)
+        return None
+
+    log.info('Created %s successfully' % zip_file)
+    return zip_file
+
+
+def configure(**options):
+    """
+    Sets the archive options. See the 'archive' section of conf/configuration.yaml
+    :param options: dict of archive options
+    :return: None
+    """
+    __options.update(options)
+
+
+def _iso_entries(files):
+    """
+    Lists the members of the bootstrap package as entries for iso_utils.build_layout. Rendered files are read into
+    memory, content updates are referenced by path and only read while the image is written
+    :param files: A dict of files, see create_iso
+    :return: list of (path, source) tuples
+    """
+    entries = list()
+    for name, source_path, file_entry in _archive_members(files):
+        if source_path is not None:
+            entries.append((name, source_path))
+        elif file_entry is not None:
+            entries.append((name, ''.join(_iter_file_contents(file_entry)).encode('utf-8')))
+        else:
+            entries.append((name, None))
+
+    return entries
+
+
+def iter_iso(files):
+    """
+    Generates an ISO image of the bootstrap package piece by piece with the built in ISO9660 writer. The image has
+    the same layout as the mkisofs builds, volume id 'bootstrap' with Joliet and Rock Ridge extensions
+    :param files: A dict of files, see create_iso
+    :return: generator of bytes
+    """
+    layout = iso_utils.build_layout(_iso_entries(files), volume_id='bootstrap', application_id='bootstrap',
+                                    timestamp=_archive_mtime())
+    return iso_utils.iter_image(layout)
+
+
+def _create_iso_mkisofs(files, archive_name):
+    """
+    Creates an ISO image using the mkisofs binary, only used when 'iso_mkisofs_fallback' is configured and the built
+    in writer fails
+    :param files: A dict of files, see create_iso
+    :param archive_name: the name of the archive to create
+    :return: path to the newly created ISO image or None on error
+    """
     archive_file_path = _create_archive_directory(files, archive_name)
     if archive_file_path is None:
         log.error('Could not create archive directory structure')
         return None
 
+    iso_image = archive_file_path + '.iso'
+    mkisofs = shutil.which('mkisofs')
+    if mkisofs is None:
+        print('No mkisofs binary available to create ISO images')
+        return None
+
     try:
-        zip_file = shutil.make_archive(archive_file_path, 'zip', root_dir=archive_file_path)
-    except [ValueError, OSError]:
-        log.error('Could not make zip archive')
+        subprocess.run([mkisofs, '-J', '-R', '-quiet', '-V', 'bootstrap', '-A', 'bootstrap', '-ldots', '-l',
+                        '-allow-lowercase', '-allow-multidot', '-o', iso_image, archive_file_path],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as cpe:
+        print("Could not make ISO Image!")
+        log.error(cpe.stderr)
+        return None
+    except (ValueError, OSError):
+        print("Could not make ISO Image")
+        log.error('Could not make ISO image')
         return None
 
-    log.info('Created %s successfully' % zip_file)
-    return zip_file
+    return iso_image
 
 
 def create_iso(files, archive_name):
@@ -149,36 +703,368 @@ def create_iso(files, archive_name):
     :return: path to the newly created ISO image or None on error
     """
 
-    archive_file_path = _create_archive_directory(files, archive_name)
-    if archive_file_path is None:
-        log.error('Could not create archive directory structure')
-        return None
-
-    iso_image = archive_file_path + '.iso'
+    iso_image = os.path.join(_archive_dir, str(uuid.uuid4()), archive_name + '.iso')
     try:
-        has_mkisofs = os.system('which mkisofs')
-        if has_mkisofs != 0:
-            print('No mkisofs binary available to create ISO images')
+        _write_chunks(iter_iso(files), iso_image)
+    except (ValueError, OSError, struct.error) as e:
+        log.error('Could not make ISO image')
+        log.error(e)
+        if not __options['iso_mkisofs_fallback']:
             return None
 
-        rv = os.system(
-            'mkisofs -J -R -v -V bootstrap -A bootstrap -ldots -l '
-            '-allow-lowercase -allow-multidot -o %s %s' % (iso_image, archive_file_path)
-        )
-        if rv != 0:
-            print("Cold not make ISO Image!")
+        iso_image = _create_iso_mkisofs(files, archive_name)
+        if iso_image is None:
             return None
 
-    except [ValueError, OSError]:
-        print("Could not make ISO Image")
+    log.info('Created %s successfully' % iso_image)
+    return iso_image
+
+
+def create_iso_buffer(files, archive_name):
+    """
+    Creates an ISO image of the desired files with the desired structure in memory, or in a temporary file for large
+    packages. No directory tree is created unless the mkisofs fallback is used
+    :param files: A dict of files, see create_iso
+    :param archive_name: the name of the archive to create
+    :return: file object positioned at the start of the ISO image or None on error
+    """
+    log.info('create_iso_buffer with name %s' % archive_name)
+
+    try:
+        return _spool(iter_iso(files))
+    except (ValueError, OSError, struct.error) as e:
         log.error('Could not make ISO image')
+        log.error(e)
+        if not __options['iso_mkisofs_fallback']:
+            return None
+
+    iso_image = _create_iso_mkisofs(files, archive_name)
+    if iso_image is None:
         return None
 
-    log.info('Created %s successfully' % iso_image)
-    return iso_image
+    return open(iso_image, 'rb')
 
 
-def create_tgz(files, archive_name):
+def _iter_tar(files, compression):
+    """
+    Generates an uncompressed tar stream of the bootstrap package. Member names are relative to './' like those
+    created by 'tar -C archive_dir -c .'. The contents of large static files are replaced by their precompressed
+    member from the member store, and the contents of files that are already compressed are marked to be stored,
+    see compression_utils.iter_gzip
+    :param files: A dict of files, see create_tgz
+    :param compression: dict of compression options, see compression_options
+    :return: generator of bytes and dicts with a 'stored' or a 'gzip_member' key
+    """
+    mtime = _archive_mtime()
+
+    root = tarfile.TarInfo('.')
+    root.type = tarfile.DIRTYPE
+    root.mode = 0o755
+    root.mtime = mtime
+    yield root.tobuf(tarfile.DEFAULT_FORMAT)
+
+    for name, source_path, file_entry in _archive_members(files):
+        info = tarfile.TarInfo('./' + name.rstrip('/'))
+        info.mtime = mtime
+
+        if source_path is None and file_entry is None:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            yield info.tobuf(tarfile.DEFAULT_FORMAT)
+            continue
+
+        info.mode = 0o644
+        if source_path is not None:
+            info.size = os.path.getsize(source_path)
+            yield info.tobuf(tarfile.DEFAULT_FORMAT)
+            precompressed = None
+            if compression['level'] > 0:
+                stored = _store_compressed(source_path, compression)
+                # members that are stored only keep their crc in the member store and are copied in stored blocks
+                member = _precompressed_member(source_path, 0 if stored else compression['level'])
+                if member is not None:
+                    precompressed = {'gzip_member': member_store.iter_gzip_member(member)}
+                elif stored:
+                    precompressed = {'stored': file_utils.iter_file(source_path)}
+
+            if precompressed is not None:
+                yield precompressed
+            else:
+                # content updates and software images can be very large, map them instead of reading them whole
+                for chunk in file_utils.iter_file(source_path):
+                    yield chunk
+        else:
+            contents = ''.join(_iter_file_contents(file_entry)).encode('utf-8')
+            info.size = len(contents)
+            yield info.tobuf(tarfile.DEFAULT_FORMAT)
+            yield contents
+
+        remainder = info.size % tarfile.BLOCKSIZE
+        if remainder:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+    # end of archive marker, padded out to a full record
+    yield tarfile.NUL * tarfile.RECORDSIZE
+
+
+def _iter_base64(chunks):
+    """
+    Base64 encodes a stream of bytes incrementally. Output lines are wrapped at 76 characters, matching the base64
+    command line utility
+    :param chunks: iterable of bytes
+    :return: generator of ascii bytes
+    """
+    # encodebytes emits one full 76 character line per 57 input bytes, so encoding whole lines at a time gives the
+    # same output as encoding everything at once
+    line_size = 57
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        aligned = len(pending) - len(pending) % line_size
+        if aligned:
+            yield base64.encodebytes(pending[:aligned])
+            pending = pending[aligned:]
+
+    if pending:
+        yield base64.encodebytes(pending)
+
+
+def iter_tgz(files, compression=None):
+    """
+    Generates a gzipped tarball of the bootstrap package piece by piece, no files are written to disk
+    :param files: A dict of files, see create_tgz
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
+    :return: generator of bytes
+    """
+    if compression is None:
+        compression = compression_options('tgz')
+
+    return compression_utils.iter_gzip(_iter_tar(files, compression), compression['level'], compression['threads'],
+                                       compression['parallel_min_size'])
+
+
+def iter_encoded_tgz(files, compression=None):
+    """
+    Generates a base64 encoded gzipped tarball of the bootstrap package piece by piece, suitable for writing directly
+    to a response body or joining into a JSON value
+    :param files: A dict of files, see create_tgz
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
+    :return: generator of ascii bytes
+    """
+    if compression is None:
+        compression = compression_options('encoded_tgz')
+
+    return _iter_base64(iter_tgz(files, compression))
+
+
+def _spool(chunks):
+    """
+    Collects a stream of bytes into a file object, kept in memory unless it grows past _spool_max_size
+    :param chunks: iterable of bytes
+    :return: file object positioned at the start of the data
+    """
+    if not os.path.exists(_archive_dir):
+        os.makedirs(_archive_dir)
+
+    spooled_file = tempfile.SpooledTemporaryFile(max_size=_spool_max_size, dir=_archive_dir)
+    for chunk in chunks:
+        spooled_file.write(chunk)
+
+    spooled_file.seek(0)
+    return spooled_file
+
+
+def create_tgz_buffer(files, archive_name, compression=None):
+    """
+    Creates a gzipped tarball of the desired files with the desired structure in memory, or in a temporary file for
+    large packages. No directory tree is created
+    :param files: A dict of files, see create_tgz
+    :param archive_name: the name of the archive to create
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
+    :return: file object positioned at the start of the tgz archive or None on error
+    """
+    log.info('create_tgz_buffer with name %s' % archive_name)
+
+    try:
+        return _spool(iter_tgz(files, compression))
+    except (ValueError, OSError, zlib.error) as e:
+        log.error('Could not make tgz image')
+        log.error(e)
+        return None
+
+
+def create_encoded_tgz_buffer(files, archive_name, compression=None):
+    """
+    Creates a base64 encoded tar.gz archive in memory, or in a temporary file for large packages
+    :param files: dict of files to encode in the archive
+    :param archive_name: name of the archive
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
+    :return: file object positioned at the start of the ascii encoded archive or None on error
+    """
+    log.info('create_encoded_tgz_buffer with name %s' % archive_name)
+
+    try:
+        return _spool(iter_encoded_tgz(files, compression))
+    except (ValueError, OSError, zlib.error) as e:
+        log.error('Could not make encoded tgz image')
+        log.error(e)
+        return None
+
+
+def _write_chunks(chunks, file_path):
+    """
+    Writes a stream of bytes to a new file
+    :param chunks: iterable of bytes
+    :param file_path: path of the file to create
+    :return: None
+    """
+    archive_base_dir = os.path.dirname(file_path)
+    if not os.path.exists(archive_base_dir):
+        os.makedirs(archive_base_dir)
+
+    with open(file_path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def _coalesce(chunks):
+    """
+    Joins small pieces of a stream into pieces of at least _stream_chunk_size bytes, so a streamed response is not
+    sent as thousands of tiny chunks. Errors are logged here, as they can only end the response once it has started
+    :param chunks: iterable of bytes or memoryviews
+    :return: generator of bytes
+    """
+    pending = list()
+    pending_size = 0
+    try:
+        for chunk in chunks:
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= _stream_chunk_size:
+                yield b''.join(pending)
+                pending = list()
+                pending_size = 0
+    except (ValueError, OSError, zlib.error, zipfile.BadZipFile) as e:
+        log.error('Could not stream archive')
+        log.error(e)
+        raise
+
+    if pending:
+        yield b''.join(pending)
+
+
+def stream_archive(files, archive_type, compression=None):
+    """
+    Generates an archive of the bootstrap package to send directly as a response body. Nothing is staged on disk and
+    content updates and software images are read from their source paths as the archive is sent
+    :param files: A dict of files, see create_archive
+    :param archive_type: 'zip', 'iso', 'tgz' or 'encoded_tgz'
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
+    :return: tuple of a generator of bytes and the size of the archive, or None when it is not known up front
+    """
+    log.info('stream_archive with type %s' % archive_type)
+
+    if archive_type == 'iso':
+        layout = iso_utils.build_layout(_iso_entries(files), volume_id='bootstrap', application_id='bootstrap',
+                                        timestamp=_archive_mtime())
+        return _coalesce(iso_utils.iter_image(layout)), layout['size']
+
+    if archive_type == 'tgz':
+        return _coalesce(iter_tgz(files, compression)), None
+
+    if archive_type == 'encoded_tgz':
+        return _coalesce(iter_encoded_tgz(files, compression)), None
+
+    return _coalesce(iter_zip(files, compression)), None
+
+
+def artifacts_enabled():
+    """
+    Checks if completed archives are retained, see the 'artifact_ttl' archive option
+    :return: boolean
+    """
+    return __options['artifact_ttl'] > 0
+
+
+def artifact_fingerprint(files, archive_type, compression=None):
+    """
+    Describes everything besides the request parameters and templates that goes into an archive: the archive type,
+    the compression settings, the archive options that change the output, and the versions of the content updates
+    and software images. See bootstrapper_utils.artifact_key
+    :param files: A dict of files, see create_archive
+    :param archive_type: 'zip', 'iso', 'tgz' or 'encoded_tgz'
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
+    :return: dict that can be serialized to JSON
+    """
+    if compression is None and archive_type in ('zip', 'tgz', 'encoded_tgz'):
+        compression = compression_options(archive_type)
+
+    content_updates = dict()
+    for package_type, latest in list_content_updates().items():
+        if latest is not None:
+            content_updates[package_type] = [latest['name'], latest['version'], latest['sha256']]
+
+    sources = list()
+    for f in sorted(files):
+        if 'source_path' in files[f]:
+            stat = os.stat(files[f]['source_path'])
+            sources.append([files[f]['archive_path'], f, stat.st_size, stat.st_mtime_ns])
+
+    return {
+        'archive_type': archive_type,
+        'compression': compression,
+        'options': dict((k, __options[k]) for k in ('archive_mtime', 'store_extensions', 'precompressed_members',
+                                                     'precompressed_min_size')),
+        'content_updates': content_updates,
+        'sources': sources
+    }
+
+
+def save_artifact(files, archive_type, file_name, mime_type, compression=None, key=None):
+    """
+    Builds an archive straight into the artifact store, where it is kept for 'artifact_ttl' seconds. Expired and least
+    recently used archives are removed first. When 'artifact_cache' is set and a key is given, the archive is stored
+    under a build id derived from the key, and a previous build with the same key is returned without building
+    anything
+    :param files: A dict of files, see create_archive
+    :param archive_type: 'zip', 'iso', 'tgz' or 'encoded_tgz'
+    :param file_name: file name of the archive
+    :param mime_type: mime type of the archive
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
+    :param key: hex digest of all the inputs of the archive, see bootstrapper_utils.artifact_key
+    :return: dict describing the archive, see artifact_store.store, or None on error
+    """
+    log.info('save_artifact with name %s' % file_name)
+
+    build_id = None
+    if key is not None and __options['artifact_cache']:
+        build_id = key[:32]
+        artifact = artifact_store.load(__options['artifact_dir'], build_id, touch=True)
+        if artifact is not None:
+            log.info('Found %s in the artifact store' % file_name)
+            return artifact
+
+    try:
+        artifact_store.prune(__options['artifact_dir'], __options['artifact_max_bytes'])
+        chunks, size = stream_archive(files, archive_type, compression)
+        return artifact_store.store(chunks, __options['artifact_dir'], file_name, mime_type,
+                                    __options['artifact_ttl'], build_id)
+    except (ValueError, OSError, zlib.error, zipfile.BadZipFile) as e:
+        log.error('Could not save archive')
+        log.error(e)
+        return None
+
+
+def get_artifact(build_id):
+    """
+    Looks up an archive kept by save_artifact
+    :param build_id: build id of the archive
+    :return: dict describing the archive, see artifact_store.store, or None if it is unknown or has expired
+    """
+    return artifact_store.load(__options['artifact_dir'], build_id)
+
+
+def create_tgz(files, archive_name, compression=None):
     """
     Creates an gzipped tarball of the desired files with the desired structure.
     :param files: A dict of files with the following structure:
@@ -192,153 +1078,288 @@ def create_tgz(files, archive_name):
     Each key of the dict is a filename that will be created. The contents of the file will be retrieved from the cache
     system using the cache_utils library. The file will be placed in the relative path given by the 'archive_path'
     :param archive_name: the name of the archive to create
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
     :return: path to the newly created tgz archive or None on error
     """
 
-    archive_file_path = _create_archive_directory(files, archive_name)
-    if archive_file_path is None:
-        log.error('Could not create archive directory structure')
-        return None
-
-    tar_file = archive_file_path + '.tgz'
+    tar_file = os.path.join(_archive_dir, str(uuid.uuid4()), archive_name + '.tgz')
     try:
-        rv = os.system(
-            f'tar -C {archive_file_path} -czvf {tar_file} .'
-        )
-        if rv != 0:
-            print("Cold not make tgz Image!")
-            return None
-
-    except [ValueError, OSError]:
+        _write_chunks(iter_tgz(files, compression), tar_file)
+    except (ValueError, OSError, zlib.error) as e:
         print("Could not make tgz Image")
         log.error('Could not make tgz image')
+        log.error(e)
         return None
 
-    # tar_file = archive_file_path + '.tgz'
-    # tar = tarfile.open(tar_file, "w:gz", compresslevel=1)
-    # tar.add(archive_file_path, arcname='./')
-
     log.info('Created %s successfully' % tar_file)
     return tar_file
 
 
-def create_encoded_tgz(files, archive_name):
+def create_encoded_tgz(files, archive_name, compression=None):
     """
     Creates a base64 encoded tar.gz archive containing the user-data package. This is useful for openstack deployments
     using nova boot, openstack server create, HEAT, and Tosca templates.
     :param files: dict of files to encode in the archive
     :param archive_name: name of the archive
-    :return: ascii encoded string containing a tar.gz archive
+    :param compression: dict of compression options, see compression_options. Defaults to the configured ones
+    :return: path to the ascii encoded file containing a tar.gz archive or None on error
+    """
+
+    encoded_file_path = os.path.join(_archive_dir, str(uuid.uuid4()), archive_name + '.tgz.base64')
+    try:
+        _write_chunks(iter_encoded_tgz(files, compression), encoded_file_path)
+    except (ValueError, OSError, zlib.error) as e:
+        print("Could not make encoded tgz Image")
+        log.error('Could not make encoded tgz image')
+        log.error(e)
+        return None
+
+    return encoded_file_path
+
+
+def _cloud_members(files):
+    """
+    Lists the members of a bootstrap package for upload to cloud storage, without staging anything on disk. Rendered
+    files are uploaded from memory and content updates and software images straight from their source paths
+    :param files: A dict of files, see _create_archive_directory
+    :return: list of (name, source_path, data) tuples. Directories end with a / and have neither a source_path nor
+    data, other members have either a source_path to read or data holding the rendered bytes
     """
+    members = list()
+    for name, source_path, file_entry in _archive_members(files):
+        if file_entry is not None:
+            members.append((name, None, ''.join(_iter_file_contents(file_entry)).encode('utf-8')))
+        else:
+            members.append((name, source_path, None))
+
+    return members
 
-    tgz_file = create_tgz(files, archive_name)
-    encoded_file_path = tgz_file + '.base64'
 
+def _shared_uploads(members, prefix, shared_prefix):
+    """
+    Lists the uploads of a bootstrap package placed under a prefix of a shared bucket or file share
+    :param members: list of members, see _cloud_members
+    :param prefix: prefix of the package, either empty or ending with a /
+    :param shared_prefix: prefix holding the content updates and software images shared between packages, None
+    uploads them under the prefix of the package
+    :return: list of (name, source_path, data, shared_name) tuples, shared_name is the name of the shared copy of a
+    source_path or None
+    """
+    uploads = list()
+    for name, source_path, data in members:
+        shared_name = None
+        if source_path is not None and shared_prefix:
+            shared_name = '{0}/{1}'.format(shared_prefix.strip('/'), name)
+        uploads.append((prefix + name, source_path, data, shared_name))
+
+    return uploads
+
+
+def _s3_object_size(client, bucket_name, key):
     try:
-        rv = os.system(
-            f'base64 {tgz_file} > {encoded_file_path}'
-        )
-        if rv != 0:
-            print("Cold not make encoded tgz Image!")
+        return client.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+    except ClientError as ce:
+        if ce.response.get('Error', dict()).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
             return None
+        raise
 
-    except [ValueError, OSError]:
-        print("Could not make tgz Image")
-        log.error('Could not make tgz image')
-        return None
 
-    return encoded_file_path
+def _upload_s3_object(client, bucket_name, key, source_path=None, data=None, shared_key=None):
+    """
+    Uploads one object into an S3 bucket. Files are streamed from disk, larger ones in parallel multipart uploads
+    :param client: boto3 S3 client
+    :param bucket_name: name of the bucket
+    :param key: object key, directories end with a /
+    :param source_path: path of the file to upload
+    :param data: bytes to upload, when neither source_path nor data is given an empty directory object is created
+    :param shared_key: key of the shared copy of source_path in the bucket. The file is uploaded there once and
+    copied into key on the server
+    :return: the object key
+    """
+    transfer_config = cloud_utils.s3_transfer_config()
+    if source_path is None:
+        client.put_object(Bucket=bucket_name, Body=data or b'', Key=key)
+    elif shared_key is not None:
+        cloud_utils.upload_shared(('s3', bucket_name, shared_key), os.path.getsize(source_path),
+                                  lambda: _s3_object_size(client, bucket_name, shared_key),
+                                  lambda: client.upload_file(source_path, bucket_name, shared_key,
+                                                             Config=transfer_config))
+        log.debug('copying %s/%s to %s' % (bucket_name, shared_key, key))
+        client.copy({'Bucket': bucket_name, 'Key': shared_key}, bucket_name, key, Config=transfer_config)
+    else:
+        log.debug('uploading %s to %s/%s' % (source_path, bucket_name, key))
+        client.upload_file(source_path, bucket_name, key, Config=transfer_config)
 
+    return key
 
-def create_s3_bucket(files, bucket_prefix, location, access_key, secret_key):
-    archive_file_path = _create_archive_directory(files, bucket_prefix)
 
-    bucket_name = bucket_prefix.lower() + "-" + str(uuid.uuid4())
+def create_s3_bucket(files, bucket_prefix, location, access_key, secret_key):
+    options = cloud_utils.get_options('s3')
+    if options['shared_bucket']:
+        # every package gets its own prefix in the shared bucket
+        bucket_name = options['shared_bucket']
+        prefix = bucket_prefix.lower() + "-" + str(uuid.uuid4()) + '/'
+    else:
+        bucket_name = bucket_prefix.lower() + "-" + str(uuid.uuid4())
+        prefix = ''
 
     try:
-        client = boto3.client('s3',
-                              region_name=location,
-                              aws_access_key_id=access_key,
-                              aws_secret_access_key=secret_key)
+        client = cloud_utils.get_s3_client(location, access_key, secret_key)
 
-    except ClientError as ce:
+    except (BotoCoreError, ClientError) as ce:
         print('Error: authenticating to AWS')
         return str(ce)
 
     try:
-        print('creating bucket {}'.format(bucket_name))
-        if location == 'us-east-1':
-            response = client.create_bucket(
+        if prefix:
+            print('using bucket {0} with prefix {1}'.format(bucket_name, prefix))
+        elif location == 'us-east-1':
+            print('creating bucket {}'.format(bucket_name))
+            client.create_bucket(
                 ACL='private',
                 Bucket=bucket_name
             )
         else:
-            response = client.create_bucket(
+            print('creating bucket {}'.format(bucket_name))
+            client.create_bucket(
                 ACL='private',
                 Bucket=bucket_name,
                 CreateBucketConfiguration={
                     'LocationConstraint': location
                 },
             )
-        print(response)
-
-        for d in ['config', 'content', 'software', 'license']:
-            print('creating directory of type: {}'.format(d))
-            top_level_dir = '{}/'.format(d)
-            response = client.put_object(Bucket=bucket_name, Body='', Key=top_level_dir)
-            print(response)
-
-            d_dir = os.path.join(archive_file_path, d)
-            for filename in os.listdir(d_dir):
-                print('creating file: {0}'.format(filename))
-                key = '{}/{}'.format(d, filename)
-                file_path = os.path.join(d_dir, filename)
-                with open(file_path, 'rb') as file_object:
-                    contents = file_object.read()
-                    print('{} {} {}'.format(file_path, bucket_name, key))
-                    response = client.put_object(Bucket=bucket_name, Body=contents, Key=key)
-                    print(response)
+
+        uploads = _shared_uploads(_cloud_members(files), prefix, prefix and options['shared_prefix'])
+        print('uploading {} objects'.format(len(uploads)))
+        cloud_utils.run_uploads('s3', lambda upload: _upload_s3_object(client, bucket_name, *upload), uploads)
 
     except IOError as ioe:
         print(ioe)
         return 'Error: Could not read local files for upload'
 
-    except ClientError as ce:
+    except (BotoCoreError, ClientError, S3UploadFailedError) as ce:
         print('Error creating bucket!')
         print(ce)
         return str(ce)
 
     print('all done')
+    if prefix:
+        return 'S3 bucket {0} prefix {1} created successfully'.format(bucket_name, prefix.rstrip('/'))
     return 'S3 bucket {} created successfully'.format(bucket_name)
 
 
-def create_azure_fileshare(files, share_prefix, account_name, account_key):
-    # generate a unique share name to avoid overlaps in shared infra
-    share_name = "{0}-{1}".format(share_prefix.lower(), str(uuid.uuid4()))
-    print('using share_name of: {}'.format(share_name))
+def _azure_file_size(file_service, share_name, name):
+    directory_name, file_name = posixpath.split(name)
+    try:
+        return file_service.get_file_properties(share_name, directory_name, file_name).properties.content_length
+    except AzureMissingResourceHttpError:
+        return None
 
-    archive_file_path = _create_archive_directory(files, share_prefix)
 
-    try:
-        # ignore SSL warnings - bad form, but SSL Decrypt causes issues with this
-        s = requests.Session()
-        s.verify = False
+def _copy_azure_file(file_service, share_name, source_name, name):
+    """
+    Copies a file within a file share on the server and waits for the copy to finish, polling less often the longer
+    it takes. A copy still pending after the 'copy_timeout' azure option is aborted
+    """
+    directory_name, file_name = posixpath.split(name)
+    source_url = file_service.make_file_url(share_name, *posixpath.split(source_name))
+    copy = file_service.copy_file(share_name, directory_name, file_name, source_url)
+    deadline = time.time() + cloud_utils.get_options('azure')['copy_timeout']
+    delay = 1
+    while copy.status == 'pending':
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            try:
+                file_service.abort_copy_file(share_name, directory_name, file_name, copy.id)
+            except AzureException as ae:
+                log.error('Could not abort copy of %s to %s: %s' % (source_name, name, ae))
+            raise AzureException('Copy of {0} to {1} did not finish in time'.format(source_name, name))
+
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, _azure_copy_max_delay)
+        copy = file_service.get_file_properties(share_name, directory_name, file_name).properties.copy
+
+    if copy.status != 'success':
+        raise AzureException('Copy of {0} to {1} {2}'.format(source_name, name, copy.status))
+
+
+def _upload_azure_file(file_service, share_name, name, source_path=None, data=None, shared_name=None):
+    """
+    Uploads one file into an Azure file share, larger files are sent as ranges on several connections at once
+    :param file_service: azure.storage.file.FileService
+    :param share_name: name of the file share
+    :param name: path of the file in the share, its directory must exist already
+    :param source_path: path of the file to upload
+    :param data: bytes to upload in place of a source_path
+    :param shared_name: path of the shared copy of source_path in the share. The file is uploaded there once and
+    copied into name on the server
+    :return: the file name
+    """
+    directory_name, file_name = posixpath.split(name)
+    max_connections = cloud_utils.get_options('azure')['max_connections']
+    if source_path is None:
+        file_service.create_file_from_bytes(share_name, directory_name, file_name, data,
+                                            max_connections=max_connections)
+    elif shared_name is not None:
+        shared_directory, shared_file = posixpath.split(shared_name)
+        cloud_utils.upload_shared(('azure', file_service.account_name, share_name, shared_name),
+                                  os.path.getsize(source_path),
+                                  lambda: _azure_file_size(file_service, share_name, shared_name),
+                                  lambda: file_service.create_file_from_path(share_name, shared_directory, shared_file,
+                                                                             source_path,
+                                                                             max_connections=max_connections))
+        log.debug('copying %s/%s to %s' % (share_name, shared_name, name))
+        _copy_azure_file(file_service, share_name, shared_name, name)
+    else:
+        log.debug('uploading %s to %s/%s' % (source_path, share_name, name))
+        file_service.create_file_from_path(share_name, directory_name, file_name, source_path,
+                                           max_connections=max_connections)
 
-        file_service = FileService(account_name=account_name, account_key=account_key, request_session=s)
+    return name
 
-        # print(file_service)
-        if not file_service.exists(share_name):
-            file_service.create_share(share_name)
 
-        for d in ['config', 'content', 'software', 'license']:
-            print('creating directory of type: {}'.format(d))
-            if not file_service.exists(share_name, directory_name=d):
-                file_service.create_directory(share_name, d)
+def create_azure_fileshare(files, share_prefix, account_name, account_key):
+    options = cloud_utils.get_options('azure')
+    if options['shared_share']:
+        # every package gets its own directory in the shared file share
+        share_name = options['shared_share']
+        prefix = "{0}-{1}/".format(share_prefix.lower(), str(uuid.uuid4()))
+        print('using share_name of: {0} with directory {1}'.format(share_name, prefix))
+    else:
+        # generate a unique share name to avoid overlaps in shared infra
+        share_name = "{0}-{1}".format(share_prefix.lower(), str(uuid.uuid4()))
+        prefix = ''
+        print('using share_name of: {}'.format(share_name))
+
+    try:
+        file_service = cloud_utils.get_file_service(account_name, account_key)
+
+        if not prefix:
+            # the share name is unique, creating it without checking if it exists saves a round trip
+            file_service.create_share(share_name)
 
-            d_dir = os.path.join(archive_file_path, d)
-            for filename in os.listdir(d_dir):
-                print('creating file: {0}'.format(filename))
-                file_service.create_file_from_path(share_name, d, filename, os.path.join(d_dir, filename))
+        uploads = _shared_uploads(_cloud_members(files), prefix, prefix and options['shared_prefix'])
+        directories = set()
+        for name, source_path, data, shared_name in uploads:
+            paths = [name.rstrip('/') if name.endswith('/') else posixpath.dirname(name)]
+            if shared_name is not None:
+                paths.append(posixpath.dirname(shared_name))
+
+            # include the parents of nested paths, the file service does not create them
+            for path in paths:
+                parts = path.split('/') if path else list()
+                directories.update('/'.join(parts[:i]) for i in range(1, len(parts) + 1))
+
+        print('creating directories')
+        # parent directories have to exist first, directories of the same depth are created together. Shared
+        # directories exist already after the first package
+        for depth in sorted(set(d.count('/') for d in directories)):
+            cloud_utils.run_uploads('azure', lambda d: file_service.create_directory(share_name, d),
+                                    sorted(d for d in directories if d.count('/') == depth))
+
+        uploads = [upload for upload in uploads if not upload[0].endswith('/')]
+        print('uploading {} files'.format(len(uploads)))
+        cloud_utils.run_uploads('azure', lambda upload: _upload_azure_file(file_service, share_name, *upload), uploads)
 
     except AttributeError as ae:
         # this can be returned on bad auth information
@@ -353,18 +1374,80 @@ def create_azure_fileshare(files, share_prefix, account_name, account_key):
         return str(ve)
 
     print('all done')
+    if prefix:
+        return 'Azure file-share {0} directory {1} created successfully'.format(share_name, prefix.rstrip('/'))
     return 'Azure file-share {} created successfully'.format(share_name)
 
 
-def create_gcp_bucket(files, bucket_prefix, project_id, access_token):
-    archive_file_path = _create_archive_directory(files, bucket_prefix)
+def _gcp_blob_size(bucket, blob_name):
+    blob = bucket.get_blob(blob_name)
+    if blob is None:
+        return None
+    return blob.size
 
+
+def _upload_gcp_blob(bucket, blob_name, source_path=None, data=None, shared_name=None):
+    """
+    Uploads one blob into a GCS bucket, larger files in resumable uploads sent chunk by chunk
+    :param bucket: google.cloud.storage.Bucket
+    :param blob_name: name of the blob, directories end with a /
+    :param source_path: path of the file to upload
+    :param data: bytes to upload, when neither source_path nor data is given an empty directory blob is created
+    :param shared_name: name of the shared copy of source_path in the bucket. The file is uploaded there once and
+    rewritten into blob_name on the server
+    :return: dict with the 'name', 'size' in bytes and upload time in 'seconds' of the blob
+    """
+    started = time.time()
+    if source_path is None and data is None:
+        size = 0
+        bucket.blob(blob_name).upload_from_string('', content_type='application/x-www-form-urlencoded;charset=UTF-8')
+    elif source_path is None:
+        size = len(data)
+        content_type = mimetypes.guess_type(blob_name)[0] or 'application/octet-stream'
+        bucket.blob(blob_name).upload_from_string(data, content_type=content_type)
+    elif shared_name is not None:
+        size = os.path.getsize(source_path)
+        cloud_utils.upload_shared(('gcp', bucket.name, shared_name), size, lambda: _gcp_blob_size(bucket, shared_name),
+                                  lambda: bucket.blob(shared_name, chunk_size=cloud_utils.gcs_chunk_size(size))
+                                  .upload_from_filename(source_path))
+        log.debug('copying %s/%s to %s' % (bucket.name, shared_name, blob_name))
+        # large blobs may take several rewrite calls
+        blob = bucket.blob(blob_name)
+        token, _, _ = blob.rewrite(bucket.blob(shared_name))
+        while token is not None:
+            token, _, _ = blob.rewrite(bucket.blob(shared_name), token=token)
+    else:
+        size = os.path.getsize(source_path)
+        log.debug('uploading %s to %s/%s' % (source_path, bucket.name, blob_name))
+        blob = bucket.blob(blob_name, chunk_size=cloud_utils.gcs_chunk_size(size))
+        blob.upload_from_filename(source_path)
+
+    return {'name': blob_name, 'size': size, 'seconds': round(time.time() - started, 3)}
+
+
+def create_gcp_bucket(files, bucket_prefix, project_id, access_token, timings=None):
+    """
+    Creates a new GCS bucket holding the bootstrap package, or a new prefix in the configured shared bucket
+    :param files: A dict of files, see _create_archive_directory
+    :param bucket_prefix: prefix of the bucket name, a unique suffix is added to it
+    :param project_id: GCP project id
+    :param access_token: OAuth2 access token
+    :param timings: optional list, extended with a dict per uploaded blob with its 'name', 'size' and 'seconds'
+    :return: message for the response
+    """
+    options = cloud_utils.get_options('gcp')
     try:
-        credentials = Credentials(access_token)
-        client = storage.Client(project_id, credentials)
+        client = cloud_utils.get_gcp_client(project_id, access_token)
 
-        bucket_name = '{0}-{1}'.format(bucket_prefix, uuid.uuid4())
-        bucket = client.create_bucket(bucket_name)
+        if options['shared_bucket']:
+            # every package gets its own prefix in the shared bucket
+            bucket_name = options['shared_bucket']
+            prefix = '{0}-{1}/'.format(bucket_prefix, uuid.uuid4())
+            bucket = client.bucket(bucket_name)
+        else:
+            bucket_name = '{0}-{1}'.format(bucket_prefix, uuid.uuid4())
+            prefix = ''
+            bucket = client.create_bucket(bucket_name)
 
     except GoogleAuthError as gae:
         print(gae)
@@ -378,37 +1461,60 @@ def create_gcp_bucket(files, bucket_prefix, project_id, access_token):
         print(ve)
         return str(ve)
 
-    for d in ['config', 'content', 'software', 'license']:
-        print('creating directory of type: {}'.format(d))
-        d_dir_blob = bucket.blob('{}/'.format(d))
-        d_dir_blob.upload_from_string('', content_type='application/x-www-form-urlencoded;charset=UTF-8')
-        d_dir = os.path.join(archive_file_path, d)
-        for filename in os.listdir(d_dir):
-            print('creating file: {0}'.format(filename))
-            d_dir_file = bucket.blob('{0}/{1}'.format(d, filename))
-            d_dir_file.upload_from_filename(os.path.join(d_dir, filename))
+    try:
+        uploads = _shared_uploads(_cloud_members(files), prefix, prefix and options['shared_prefix'])
+        print('uploading {} blobs'.format(len(uploads)))
+        results = cloud_utils.run_uploads('gcp', lambda upload: _upload_gcp_blob(bucket, *upload), uploads)
+
+    except IOError as ioe:
+        print(ioe)
+        return 'Error: Could not read local files for upload'
+
+    except (GoogleAuthError, GoogleAPIError) as gae:
+        print(gae)
+        return str(gae)
+
+    if timings is not None:
+        timings.extend(results)
 
     print('all done')
+    if prefix:
+        return 'GCP Bucket {0} prefix {1} created successfully'.format(bucket_name, prefix.rstrip('/'))
     return 'GCP Bucket {} created successfully'.format(bucket_name)
 
 
+def get_software_image(image_name):
+    """
+    Finds a PAN-OS software image staged in the software image directory
+    :param image_name: file name of the image, for example PanOS_vm-9.0.0
+    :return: absolute path to the image or None if it is not available
+    """
+    image_path = os.path.join(_software_image_dir, os.path.basename(image_name))
+    if not os.path.isfile(image_path):
+        return None
+
+    return os.path.abspath(image_path)
+
+
 def check_latest_update(package_type):
     """
     Checks the content update directory for the specified package type (appthread, contents, etc)
-    If files are found, it will return a path to the file with the highest sequence number
+    If files are found, it will return a path to the file with the highest version number
     :param package_type: appthreat, contents, wildfire, etc
-    :return: absolute path to the file with the highest sequence number or None if no updates are available
+    :return: absolute path to the file with the highest version number or None if no updates are available
     """
-    package_dir = os.path.join(_content_update_dir, package_type)
-    if not os.path.exists(package_dir):
-        # there's nothing here to see, move along
+    latest = content_catalog.get_latest(os.path.join(_content_update_dir, package_type))
+    if latest is None:
         return None
 
-    all_files = os.listdir(package_dir)
-    if len(all_files) > 0:
-        all_files.sort()
-        latest = all_files[-1]
-        # return the full path here
-        return os.path.join(package_dir, latest)
-    else:
-        return None
+    return latest['path']
+
+
+def list_content_updates():
+    """
+    Lists the content updates that will be included in every bootstrap package
+    :return: dict of package type to a dict with 'name', 'path', 'version', 'size', 'mtime' and 'sha256' keys, or None
+    if there is no update of that type
+    """
+    return dict((package_type, content_catalog.get_latest(os.path.join(_content_update_dir, package_type)))
+                for package_type in _content_update_types)
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+from . import file_utils
+
+# build ids are uuid4 hex strings, anything else is never looked up on disk
+_build_id_re = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _meta_path(store_dir, build_id):
+    # kept inside the build directory, so a build directory that exists is always complete
+    return os.path.join(store_dir, build_id, 'meta.json')
+
+
+def store(chunks, store_dir, file_name, mime_type, ttl, build_id=None):
+    """
+    Writes a completed archive into the store under a build id, so it can be downloaded again, or resumed, until it
+    expires. The sha256 of the archive is computed while it is written and used as its strong ETag
+    :param chunks: iterable of bytes of the archive
+    :param store_dir: directory holding the retained archives
+    :param file_name: file name of the archive, used as the attachment name when it is downloaded
+    :param mime_type: mime type of the archive
+    :param ttl: seconds the archive is kept for
+    :param build_id: 32 character hex build id, such as one derived from the inputs of a deterministic build. A new
+    random id is used if not given. When another request stores the same build id first, its archive is kept
+    :return: dict with 'build_id', 'path', 'file_name', 'mime_type', 'size', 'etag', 'created' and 'expires' keys
+    """
+    if build_id is None:
+        build_id = uuid.uuid4().hex
+    elif not _build_id_re.match(build_id):
+        raise ValueError('Invalid build id %s' % build_id)
+
+    # built under a temporary name, so a build is only visible once it is complete
+    build_dir = os.path.join(store_dir, build_id)
+    tmp_dir = os.path.join(store_dir, '.%s.%s' % (build_id, uuid.uuid4().hex))
+    os.makedirs(tmp_dir)
+
+    digest = hashlib.sha256()
+    try:
+        with open(os.path.join(tmp_dir, os.path.basename(file_name)), 'wb') as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+            size = f.tell()
+
+        created = time.time()
+        artifact = {
+            'build_id': build_id,
+            'path': os.path.join(build_dir, os.path.basename(file_name)),
+            'file_name': os.path.basename(file_name),
+            'mime_type': mime_type,
+            'size': size,
+            'etag': digest.hexdigest(),
+            'created': created,
+            'expires': created + ttl
+        }
+
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(artifact, f)
+
+        try:
+            os.rename(tmp_dir, build_dir)
+        except OSError:
+            # an identical build finished first and is kept. One that has expired is kept for another ttl seconds,
+            # one without metadata is being pruned and is replaced
+            existing = load(store_dir, build_id) or _renew(store_dir, build_id, ttl)
+            if existing is None:
+                _remove(build_dir, _meta_path(store_dir, build_id))
+                try:
+                    os.rename(tmp_dir, build_dir)
+                except OSError:
+                    existing = load(store_dir, build_id)
+                    if existing is None:
+                        raise
+
+            if existing is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return existing
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    return artifact
+
+
+def _renew(store_dir, build_id, ttl):
+    """
+    Keeps an expired archive that is still complete for another ttl seconds
+    :return: dict as returned from load, or None if the archive or its metadata is gone
+    """
+    meta_path = _meta_path(store_dir, build_id)
+    try:
+        with open(meta_path, 'r') as f:
+            artifact = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not os.path.exists(artifact['path']):
+        return None
+
+    artifact['expires'] = time.time() + ttl
+    tmp_path = '%s.%s.tmp' % (meta_path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        json.dump(artifact, f)
+    os.replace(tmp_path, meta_path)
+    return artifact
+
+
+def load(store_dir, build_id, touch=False):
+    """
+    Looks up a retained archive
+    :param store_dir: directory holding the retained archives
+    :param build_id: build id returned from store
+    :param touch: mark the archive as recently used, so prune removes it last when the store is too large
+    :return: dict as returned from store, or None if the build id is unknown or has expired
+    """
+    if not _build_id_re.match(build_id):
+        return None
+
+    try:
+        with open(_meta_path(store_dir, build_id), 'r') as f:
+            artifact = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if artifact['expires'] <= time.time() or not os.path.exists(artifact['path']):
+        return None
+
+    if touch:
+        os.utime(_meta_path(store_dir, build_id))
+
+    return artifact
+
+
+def prune(store_dir, max_bytes=0):
+    """
+    Removes expired archives, along with builds that were never completed and are older than a day. Then removes the
+    least recently used archives until the store is smaller than max_bytes
+    :param store_dir: directory holding the retained archives
+    :param max_bytes: maximum size in bytes of the store, 0 only removes expired archives
+    :return: number of builds removed
+    """
+    if not os.path.exists(store_dir):
+        return 0
+
+    now = time.time()
+    removed = 0
+    artifacts = list()
+    total = 0
+    with os.scandir(store_dir) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+
+            if not _build_id_re.match(entry.name):
+                # a build still being written, or left over from a failed one
+                if entry.name.startswith('.') and entry.stat().st_mtime < now - 86400:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+                continue
+
+            meta_path = _meta_path(store_dir, entry.name)
+            try:
+                with open(meta_path, 'r') as f:
+                    artifact = json.load(f)
+                expired = artifact['expires'] <= now
+            except (OSError, ValueError, KeyError):
+                expired = entry.stat().st_mtime < now - 86400
+                artifact = None
+
+            if expired:
+                _remove(entry.path, meta_path)
+                removed += 1
+            elif artifact is not None:
+                artifacts.append((os.stat(meta_path).st_mtime, entry.path, meta_path, artifact['size']))
+                total += artifact['size']
+
+    if max_bytes > 0:
+        for _, build_dir, meta_path, size in sorted(artifacts):
+            if total <= max_bytes:
+                break
+
+            _remove(build_dir, meta_path)
+            total -= size
+            removed += 1
+
+    return removed
+
+
+def _remove(build_dir, meta_path):
+    # the metadata goes first, so the build is no longer found while its files are removed
+    try:
+        os.remove(meta_path)
+    except OSError:
+        pass
+    shutil.rmtree(build_dir, ignore_errors=True)
+
+
+def iter_range(artifact, start, stop):
+    """
+    Reads part of a retained archive. The archive is opened before this returns, so one removed by prune fails here
+    rather than part way through a response. Once open it is read to the end even if it is removed meanwhile
+    :param artifact: dict as returned from load
+    :param start: offset of the first byte
+    :param stop: offset after the last byte
+    :return: generator of bytes
+    :raises FileNotFoundError: if the archive has been removed
+    """
+    chunks = file_utils.iter_file(artifact['path'], offset=start, length=stop - start)
+    # the first chunk opens and maps the file
+    first = next(chunks, None)
+    return _iter_bytes(first, chunks)
+
+
+def _iter_bytes(first, chunks):
+    if first is None:
+        return
+
+    yield bytes(first)
+    for chunk in chunks:
+        yield bytes(chunk)
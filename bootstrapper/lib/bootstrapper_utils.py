@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 from base64 import urlsafe_b64decode
@@ -7,18 +8,21 @@ import requests
 import yaml
 from yaml.scanner import ScannerError
 from flask import Flask
+from flask import current_app
 from flask import g
 from flask import render_template
-from flask import render_template_string
 from flask import request
+from jinja2 import TemplateError
 from jinja2 import TemplateSyntaxError
 from jinja2 import meta
 from requests.exceptions import HTTPError
 from sqlalchemy.exc import SQLAlchemyError
 from werkzeug.exceptions import BadRequest
 
+from bootstrapper.lib import archive_utils
 from bootstrapper.lib import cache_utils
 from bootstrapper.lib import openstack_utils
+from bootstrapper.lib import template_cache
 from bootstrapper.lib.db import db_session
 from bootstrapper.lib.db_models import Template
 from bootstrapper.lib.exceptions import InvalidConfigurationError
@@ -28,6 +32,11 @@ from ..lib import jinja2_filters
 
 app = Flask(__name__)
 
+# jinja environment used only to parse templates for their variables
+_parse_env = jinja2.Environment()
+for _f in jinja2_filters.defined_filters:
+    _parse_env.filters[_f] = getattr(jinja2_filters, _f)
+
 
 def load_defaults():
     """
@@ -99,12 +108,15 @@ def import_template(template, template_name, description, template_type='bootstr
             # print('Adding new record to db')
             unescaped_template = unescape(template)
             t = Template(name=template_name, description=description, template=unescaped_template, type=template_type)
+            _index_template_variables(t)
             db_session.add(t)
             db_session.commit()
 
         else:
             print('template exists in db')
 
+        template_cache.invalidate(template_name)
+        template_cache.precompile(template_name, t.template)
         return True
     except SQLAlchemyError as sqe:
         print('Could not import file')
@@ -129,6 +141,7 @@ def edit_template(template, template_name, description, template_type='bootstrap
             print('Adding new record to db')
             unescaped_template = unescape(template)
             t = Template(name=template_name, description=description, template=unescaped_template, type=template_type)
+            _index_template_variables(t)
             db_session.add(t)
             db_session.commit()
 
@@ -136,9 +149,12 @@ def edit_template(template, template_name, description, template_type='bootstrap
             t.description = description
             t.template = template
             t.template_type = template_type
+            _index_template_variables(t)
             db_session.add(t)
             db_session.commit()
 
+        template_cache.invalidate(template_name)
+        template_cache.precompile(template_name, t.template)
         return True
     except SQLAlchemyError as sqe:
         print('Could not import file')
@@ -159,6 +175,7 @@ def delete_template(file_name):
             db_session.delete(t)
             db_session.commit()
 
+        template_cache.invalidate(file_name)
         return True
     except SQLAlchemyError as sqe:
         print('Could not delete template!')
@@ -240,8 +257,9 @@ def get_template(template_name):
 
 def get_required_vars_from_template(template_name):
     """
-    Parse the template and return a list of all the variables defined therein
-    :param template_name: relative path to the application root to a jinja2 template
+    Return all the variables defined in the template. The variables are indexed when the template is imported or
+    edited, templates from older databases are parsed and indexed on first use
+    :param template_name: name of the template in the db
     :return: set of variable named defined in the template
     """
 
@@ -254,22 +272,15 @@ def get_required_vars_from_template(template_name):
             print('Could not load template %s' % template_name)
             return template_variables
 
-        # get the jinja environment to use it's parse function
-        env = jinja2.Environment()
-
-        # load all our custom filters
-        for f in jinja2_filters.defined_filters:
-            env.filters[f] = getattr(jinja2_filters, f)
+        if t.variables is None:
+            print('Indexing variables for template %s' % template_name)
+            _index_template_variables(t)
+            db_session.add(t)
+            db_session.commit()
 
-        # env.filters['sha512_hash'] = jinja2_filters.sha512_hash
-        # parse returns an AST that can be send to the meta module
-        ast = env.parse(t.template)
-        # return a set of all variable defined in the template
-        template_variables = meta.find_undeclared_variables(ast)
+        if t.variables is not None:
+            template_variables = set(json.loads(t.variables))
 
-    except TemplateSyntaxError as tse:
-        print('Could not parse template')
-        print(tse)
     except SQLAlchemyError as sqe:
         print('Could not load template variables')
         print(sqe)
@@ -277,20 +288,57 @@ def get_required_vars_from_template(template_name):
         return template_variables
 
 
-def verify_data(template, available_vars):
+def rebuild_template_variables():
+    """
+    Re-parses every template in the db and rebuilds the index of variables defined therein. Useful after upgrading
+    an existing database
+    :return: number of templates indexed
+    """
+    indexed = 0
+    try:
+        for t in Template.query.all():
+            _index_template_variables(t)
+            db_session.add(t)
+            indexed += 1
+
+        db_session.commit()
+    except SQLAlchemyError as sqe:
+        print('Could not rebuild template variables')
+        print(sqe)
+
+    return indexed
+
+
+def _index_template_variables(t):
+    """
+    Parses the text of the template model and stores a json encoded list of all undeclared variables on the model
+    :param t: Template model object
+    :return: None
+    """
+    try:
+        # parse returns an AST that can be send to the meta module
+        ast = _parse_env.parse(t.template)
+        # store a list of all variable defined in the template
+        t.variables = json.dumps(sorted(meta.find_undeclared_variables(ast)))
+    except TemplateSyntaxError as tse:
+        print('Could not parse template %s' % t.name)
+        print(tse)
+        t.variables = None
+
+
+def verify_data(template_name, available_vars):
     """
-    Verify all the required variables have been posted from the user
-    :param template: jinja2 template to check
+    Verify all the required variables have been posted from the user. Missing variables are only reported, templates
+    render them as empty values as they always have
+    :param template_name: name of the template to check
     :param available_vars: dict of all available variables from the posted data and also the defaults
-    :return:
+    :return: True
     """
-    vs = get_required_vars_from_template(template)
+    vs = get_required_vars_from_template(template_name)
     print(vs)
     for r in vs:
-        print("checking var: %s" % r)
         if r not in available_vars:
             print("template variable %s is not defined!!" % r)
-            return False
 
     return True
 
@@ -418,23 +466,30 @@ def _download_template(template_url):
         return None
 
 
-def build_base_configs(configuration_parameters):
+def build_base_configs(configuration_parameters, cache_files=True):
     """
     Takes a dict of parameters and builds the base configurations
     :param configuration_parameters:  Simple dict of parameters
+    :param cache_files: store each rendered file in the cache and include the 'key' and 'url' to retrieve it. When
+    False, each file has a 'contents' key instead, holding a string or a generator that renders the file as it is
+    consumed, and any software images named in the 'software_image' parameter are included with a 'source_path' key.
+    Use False when the files are only going to be written into an archive
     :return: dict containing 'bootstrap.xml', 'authcodes', and 'init-cfg-static.txt' keys
     """
 
     print('here we go')
     config = load_config()
     # first create an init-cfg.txt from the supplied parameters
-    init_cfg_key = create_init_cfg(configuration_parameters)
+    init_cfg = create_init_cfg(configuration_parameters, cache_file=cache_files)
 
     base_config = dict()
     base_config['init-cfg.txt'] = dict()
-    base_config['init-cfg.txt']['key'] = init_cfg_key
     base_config['init-cfg.txt']['archive_path'] = 'config'
-    base_config['init-cfg.txt']['url'] = config["base_url"] + '/get/' + init_cfg_key
+    if cache_files:
+        base_config['init-cfg.txt']['key'] = init_cfg
+        base_config['init-cfg.txt']['url'] = config["base_url"] + '/get/' + init_cfg
+    else:
+        base_config['init-cfg.txt']['contents'] = init_cfg
 
     # use a consistent variable name for authcodes, but keep the old auth_key for backwards compat
     if 'auth_code' in configuration_parameters:
@@ -447,24 +502,122 @@ def build_base_configs(configuration_parameters):
         configuration_parameters['auth_key'] = configuration_parameters['authcodes']
 
     if 'auth_key' in configuration_parameters:
-        authcode = render_template('panos/authcodes', **configuration_parameters)
-        authcode_key = cache_utils.set(authcode)
         base_config['authcodes'] = dict()
-        base_config['authcodes']['key'] = authcode_key
         base_config['authcodes']['archive_path'] = 'license'
-        base_config['authcodes']['url'] = config["base_url"] + '/get/' + init_cfg_key
+        if cache_files:
+            authcode_key = render_to_cache('panos/authcodes', None, configuration_parameters)
+            base_config['authcodes']['key'] = authcode_key
+            base_config['authcodes']['url'] = config["base_url"] + '/get/' + init_cfg
+        else:
+            base_config['authcodes']['contents'] = render_to_stream('panos/authcodes', None, configuration_parameters)
 
-    bootstrap_cache_key = create_bootstrap_xml(configuration_parameters)
-    if bootstrap_cache_key is not None:
+    bootstrap_xml = create_bootstrap_xml(configuration_parameters, cache_file=cache_files)
+    if bootstrap_xml is not None:
         base_config['bootstrap.xml'] = dict()
-        base_config['bootstrap.xml']['key'] = bootstrap_cache_key
         base_config['bootstrap.xml']['archive_path'] = 'config'
-        base_config['bootstrap.xml']['url'] = config["base_url"] + '/get/' + bootstrap_cache_key
+        if cache_files:
+            base_config['bootstrap.xml']['key'] = bootstrap_xml
+            base_config['bootstrap.xml']['url'] = config["base_url"] + '/get/' + bootstrap_xml
+        else:
+            base_config['bootstrap.xml']['contents'] = bootstrap_xml
+
+    # software images are only referenced in place, they are never rendered or cached
+    if 'software_image' in configuration_parameters and not cache_files:
+        software_images = configuration_parameters['software_image']
+        if isinstance(software_images, str):
+            software_images = [i.strip() for i in software_images.split(',') if i.strip() != '']
+
+        for image_name in software_images:
+            image_path = archive_utils.get_software_image(image_name)
+            if image_path is None:
+                raise RequiredParametersError('Could not find software image %s' % image_name)
+
+            base_config[os.path.basename(image_path)] = dict()
+            base_config[os.path.basename(image_path)]['archive_path'] = 'software'
+            base_config[os.path.basename(image_path)]['source_path'] = image_path
 
     return base_config
 
 
-def create_init_cfg(configuration_parameters):
+def artifact_key(configuration_parameters, base_config, archive_type, compression=None):
+    """
+    Hashes everything that goes into a bootstrap archive, so identical requests can be served from the artifact store:
+    the request parameters, the templates and defaults they are rendered with, the content update and software image
+    versions, the archive type and the compression settings
+    :param configuration_parameters: Simple dict of parameters, after build_base_configs
+    :param base_config: dict returned from build_base_configs
+    :param archive_type: 'zip', 'iso', 'tgz' or 'encoded_tgz'
+    :param compression: dict of compression options, see archive_utils.compression_options
+    :return: hex digest, or None if a template, or one it includes, imports or extends, renders differently every
+    time, for example with a salted hash, or references a template that cannot be resolved
+    """
+    # these only change how the archive is sent, not what is in it
+    payload = dict((k, v) for k, v in configuration_parameters.items() if k not in ('stream', 'response_format'))
+
+    templates = dict()
+    for template_name in ('Default Init-Cfg', configuration_parameters.get('init_cfg_template', None),
+                          configuration_parameters.get('bootstrap_template', None)):
+        if template_name in (None, '', 'None') or template_name in templates:
+            continue
+        template_string = get_template(template_name)
+        if template_string is not None and not template_cache.is_deterministic(template_string):
+            return None
+        templates[template_name] = None if template_string is None else template_cache.fingerprint(template_string)
+
+    # templates rendered from the templates directory
+    file_templates = list()
+    if 'authcodes' in base_config:
+        file_templates.append('panos/authcodes')
+    if 'heat-template.yaml' in base_config:
+        file_templates.extend(['openstack/heat.yaml', 'openstack/heat-environment.yaml'])
+
+    for template_name in file_templates:
+        template_source = current_app.jinja_loader.get_source(current_app.jinja_env, template_name)[0]
+        if not template_cache.is_deterministic(template_source):
+            return None
+        templates[template_name] = template_cache.fingerprint(template_source)
+
+    key = {
+        'payload': payload,
+        'templates': templates,
+        'defaults': load_defaults(),
+        'archive': archive_utils.artifact_fingerprint(base_config, archive_type, compression)
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_compression_options(configuration_parameters, archive_type):
+    """
+    Resolves the compression settings for an archive, applying the optional 'archive_options' parameter on top of the
+    configured settings of the archive type
+    :param configuration_parameters: Simple dict of parameters, 'archive_options' may be a dict or a JSON string when
+    posted as form data, for example {"level": 0} or {"level": 9, "threads": 4}
+    :param archive_type: 'zip', 'tgz' or 'encoded_tgz'
+    :return: dict of compression options, see archive_utils.compression_options
+    """
+    overrides = configuration_parameters.get('archive_options', None)
+    if isinstance(overrides, str):
+        try:
+            overrides = json.loads(overrides)
+        except ValueError:
+            raise RequiredParametersError('Could not parse archive_options')
+
+    if overrides is not None and not isinstance(overrides, dict):
+        raise RequiredParametersError('archive_options must be an object')
+
+    try:
+        return archive_utils.compression_options(archive_type, overrides)
+    except (TypeError, ValueError) as e:
+        raise RequiredParametersError('Invalid archive_options: %s' % e)
+
+
+def create_init_cfg(configuration_parameters, cache_file=True):
+    """
+    Renders the init-cfg.txt file from the requested init_cfg_template, or decodes a user supplied init_cfg_str
+    :param configuration_parameters: dict of parameters
+    :param cache_file: store the file in the cache
+    :return: cache key of the file if cache_file is True, otherwise a string or generator of the file contents
+    """
     if 'init_cfg_str' in configuration_parameters:
         # user has supplied a base64 encoded init-cfg.txt file for our use
         init_cfg_str = configuration_parameters['init_cfg_str']
@@ -511,15 +664,28 @@ def create_init_cfg(configuration_parameters):
             print("Not all required keys are present for build_base_config!!")
             raise RequiredParametersError("Not all required keys are present for init-cfg.txt!!")
 
-        init_cfg_contents = render_template_string(init_cfg_template, **configuration_parameters)
+        if not cache_file:
+            return render_to_stream(init_cfg_name, init_cfg_template, configuration_parameters)
+
+        return render_to_cache(init_cfg_name, init_cfg_template, configuration_parameters)
 
     print(init_cfg_contents)
+    if not cache_file:
+        return init_cfg_contents
+
     init_cfg_key = cache_utils.set(init_cfg_contents)
 
     return init_cfg_key
 
 
-def create_bootstrap_xml(configuration_parameters):
+def create_bootstrap_xml(configuration_parameters, cache_file=True):
+    """
+    Renders the bootstrap.xml file from the requested bootstrap_template, or decodes a user supplied bootstrap_str
+    :param configuration_parameters: dict of parameters
+    :param cache_file: store the file in the cache
+    :return: cache key of the file if cache_file is True, otherwise a string or generator of the file contents. None
+    if no bootstrap.xml was requested
+    """
 
     if 'bootstrap_str' in configuration_parameters \
             and configuration_parameters['bootstrap_str'] != 'None' \
@@ -528,6 +694,9 @@ def create_bootstrap_xml(configuration_parameters):
         bootstrap_str = configuration_parameters['bootstrap_str']
         bootstrap_bytes = urlsafe_b64decode(bootstrap_str)
         bootstrap_contents = bootstrap_bytes.decode('utf-8')
+        if not cache_file:
+            return bootstrap_contents
+
         return cache_utils.set(bootstrap_contents)
 
     elif 'bootstrap_template' in configuration_parameters \
@@ -546,17 +715,89 @@ def create_bootstrap_xml(configuration_parameters):
             raise TemplateNotFoundError('Could not load bootstrap template!')
 
         # print("checking bootstrap required_variables")
-        if not verify_data(bootstrap_template, bootstrap_config):
+        if not verify_data(bootstrap_template_name, bootstrap_config):
             raise RequiredParametersError('Not all required keys for bootstrap.xml are present')
 
-        bootstrap_contents = render_template_string(bootstrap_template, **bootstrap_config)
+        if not cache_file:
+            return render_to_stream(bootstrap_template_name, bootstrap_template, bootstrap_config)
+
         # set the bootstrap_xml file in the cache and return the key
-        return cache_utils.set(bootstrap_contents)
+        return render_to_cache(bootstrap_template_name, bootstrap_template, bootstrap_config)
     else:
         return None
 
 
-def build_openstack_heat(base_config, posted_json, archive=False):
+def render_to_cache(template_name, template_string, context):
+    """
+    Renders a template and sets the rendered output in the cache. When the 'render_memo' configuration option is
+    enabled, a render of the same template with the same parameters re-uses the previously rendered output and cache key
+    :param template_name: name of the template in the db, or path of the template in the templates directory
+    :param template_string: string of the template text, or None to render from the templates directory
+    :param context: dict of variables to interpolate into the template
+    :return: key of the rendered output in the cache
+    """
+    if template_string is None:
+        template_source = current_app.jinja_loader.get_source(current_app.jinja_env, template_name)[0]
+    else:
+        template_source = template_string
+
+    if not template_cache.memo_enabled() or not template_cache.is_deterministic(template_source):
+        return cache_utils.set(_render(template_name, template_string, context))
+
+    key = template_cache.memo_key(template_source, context)
+    memoized = template_cache.get_memo(key)
+    if memoized is not None:
+        contents, cache_key = memoized
+        if cache_utils.has(cache_key):
+            return cache_key
+    else:
+        contents = _render(template_name, template_string, context)
+
+    cache_key = cache_utils.set(contents)
+    template_cache.set_memo(key, contents, cache_key)
+    return cache_key
+
+
+def render_to_stream(template_name, template_string, context):
+    """
+    Renders a template piece by piece, without storing the output in the cache. When the 'render_memo' configuration
+    option is enabled, a previously memoized render is returned as is
+    :param template_name: name of the template in the db, or path of the template in the templates directory
+    :param template_string: string of the template text, or None to render from the templates directory
+    :param context: dict of variables to interpolate into the template
+    :return: generator of rendered strings, or a string of a memoized render
+    """
+    if template_cache.memo_enabled() and template_string is not None \
+            and template_cache.is_deterministic(template_string):
+        memoized = template_cache.get_memo(template_cache.memo_key(template_string, context))
+        if memoized is not None:
+            return memoized[0]
+
+    if template_string is None:
+        template = current_app.jinja_env.get_template(template_name)
+        context = dict(context)
+        current_app.update_template_context(context)
+        return template.generate(context)
+
+    return template_cache.generate(template_name, template_string, **context)
+
+
+def _render(template_name, template_string, context):
+    if template_string is None:
+        return render_template(template_name, **context)
+
+    return template_cache.render(template_name, template_string, **context)
+
+
+def build_openstack_heat(base_config, posted_json, archive=False, cache_files=True):
+    """
+    Adds the rendered openstack HEAT template and environment to the base config
+    :param base_config: dict returned from build_base_configs
+    :param posted_json: dict of parameters
+    :param archive: the HEAT template will be included in an archive alongside the base config files
+    :param cache_files: store the rendered files in the cache, see build_base_configs
+    :return: base_config dict
+    """
     defaults = load_defaults()
 
     if not openstack_utils.verify_data(posted_json):
@@ -574,18 +815,17 @@ def build_openstack_heat(base_config, posted_json, archive=False):
         openstack_config['bootstrap_xml'] = base_config['bootstrap.xml']['url']
         openstack_config['authcodes'] = base_config['authcodes']['url']
 
-    heat_env = render_template('openstack/heat-environment.yaml', **openstack_config)
-    heat = render_template('openstack/heat.yaml', **base_config)
-
-    he_key = cache_utils.set(heat_env)
-    h_key = cache_utils.set(heat)
+    if cache_files:
+        he = dict(key=render_to_cache('openstack/heat-environment.yaml', None, openstack_config))
+        h = dict(key=render_to_cache('openstack/heat.yaml', None, openstack_config))
+    else:
+        he = dict(contents=render_to_stream('openstack/heat-environment.yaml', None, openstack_config))
+        h = dict(contents=render_to_stream('openstack/heat.yaml', None, openstack_config))
 
-    base_config['heat-environment.yaml'] = dict()
-    base_config['heat-environment.yaml']['key'] = he_key
+    base_config['heat-environment.yaml'] = he
     base_config['heat-environment.yaml']['archive_path'] = '.'
 
-    base_config['heat-template.yaml'] = dict()
-    base_config['heat-template.yaml']['key'] = h_key
+    base_config['heat-template.yaml'] = h
     base_config['heat-template.yaml']['archive_path'] = '.'
 
     return base_config
@@ -605,7 +845,42 @@ def compile_template(configuration_parameters):
     if template is None:
         raise TemplateNotFoundError('Could not load %s' % template_name)
 
-    return render_template_string(template, **configuration_parameters)
+    return template_cache.render(template_name, template, **configuration_parameters)
+
+
+def compile_template_batch(template_name, parameter_sets):
+    """
+    Renders a single template against many sets of parameters. The template is loaded and compiled only once. Each
+    set of parameters is seeded with the defaults from conf/defaults.yaml and checked with verify_data, as a single
+    bootstrap template render is
+    :param template_name: name of the template in the db
+    :param parameter_sets: iterable of dicts of variables to interpolate into the template. Items that could not be
+    parsed may be passed as None and will be reported as errors
+    :return: generator of dicts containing 'index' and 'success' keys, and either 'rendered' or 'message'
+    """
+    template = get_template(template_name)
+    if template is None:
+        raise TemplateNotFoundError('Could not load %s' % template_name)
+
+    defaults = load_defaults()
+    compiled = template_cache.get_compiled_template(template_name, template)
+
+    for index, parameters in enumerate(parameter_sets):
+        if not isinstance(parameters, dict):
+            yield dict(index=index, success=False, message='Could not parse parameter set')
+            continue
+
+        context = generate_boostrap_config_with_defaults(defaults, dict(parameters, bootstrap_template=template_name))
+        if not verify_data(template_name, context):
+            yield dict(index=index, success=False, message='Not all required keys are present')
+            continue
+
+        try:
+            rendered = template_cache.render_compiled(compiled, **context)
+            yield dict(index=index, success=True, rendered=rendered)
+        except TemplateError as te:
+            print(te)
+            yield dict(index=index, success=False, message='Could not render template: %s' % te)
 
 
 def normalize_input_params(r: request) -> dict:
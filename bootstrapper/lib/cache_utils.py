@@ -1,36 +1,351 @@
-
+from werkzeug.contrib.cache import BaseCache
 from werkzeug.contrib.cache import FileSystemCache
+from werkzeug.contrib.cache import MemcachedCache
+from werkzeug.contrib.cache import RedisCache
+from collections import OrderedDict
+from time import time
 import os
+import pickle
+import sqlite3
+import threading
 import uuid
 
 # cache the cache yo
 __cache = None
 
+# cache options, see the 'cache' section of conf/configuration.yaml
+__options = {
+    'backend': 'filesystem',
+    'default_timeout': 300,
+    'memory_max_bytes': 64 * 1024 * 1024,
+    'cache_dir': '/tmp/bootstrapper/cache',
+    'sqlite_path': '/tmp/bootstrapper/cache.db',
+    'redis_url': 'redis://127.0.0.1:6379/0',
+    'memcached_servers': ['127.0.0.1:11211'],
+    'max_connections': 16,
+    'key_prefix': 'bootstrapper:'
+}
+
+
+class MemoryLRUCache(BaseCache):
+    """
+    Simple in process cache bounded by the approximate size in bytes of the cached objects. Least recently used
+    objects are evicted first
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size_of(value):
+        if isinstance(value, (str, bytes)):
+            return len(value)
+
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def _remove(self, key):
+        expires, value, size = self._cache.pop(key)
+        self.stats['bytes'] -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._cache.get(key, None)
+            if entry is not None and (entry[0] == 0 or entry[0] > time()):
+                self._cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+
+            if entry is not None:
+                self._remove(key)
+
+            self.stats['misses'] += 1
+            return None
+
+    def set(self, key, value, timeout=None):
+        size = self._size_of(value)
+        if size > self.max_bytes:
+            return False
+
+        timeout = self._normalize_timeout(timeout)
+        expires = time() + timeout if timeout != 0 else 0
+
+        with self._lock:
+            if key in self._cache:
+                self._remove(key)
+
+            self._cache[key] = (expires, value, size)
+            self.stats['bytes'] += size
+            while self.stats['bytes'] > self.max_bytes:
+                self._remove(next(iter(self._cache)))
+                self.stats['evictions'] += 1
+
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._cache:
+                self._remove(key)
+                return True
+
+        return False
+
+    def has(self, key):
+        with self._lock:
+            entry = self._cache.get(key, None)
+            return entry is not None and (entry[0] == 0 or entry[0] > time())
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.stats['bytes'] = 0
+
+        return True
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache stored in a single SQLite database file, which can be shared by all workers on a host or placed on shared
+    storage. Each thread uses its own connection
+    """
+
+    def __init__(self, path, default_timeout=300, prune_interval=256):
+        BaseCache.__init__(self, default_timeout)
+        self.path = path
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._sets = 0
+
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                               '(key TEXT PRIMARY KEY, expires REAL NOT NULL, value BLOB NOT NULL)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+
+        return connection
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time() + timeout if timeout != 0 else 0
+
+    def _prune(self, connection):
+        self._sets += 1
+        if self._sets % self.prune_interval == 0:
+            connection.execute('DELETE FROM cache WHERE expires != 0 AND expires <= ?', (time(),))
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        if not keys:
+            return []
+
+        connection = self._connection()
+        rows = connection.execute(
+            'SELECT key, value FROM cache WHERE key IN (%s) AND (expires = 0 OR expires > ?)'
+            % ','.join('?' * len(keys)), keys + (time(),)
+        ).fetchall()
+        found = dict((k, pickle.loads(v)) for k, v in rows)
+        return [found.get(k, None) for k in keys]
+
+    def set(self, key, value, timeout=None):
+        return self.set_many({key: value}, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        expires = self._expires(timeout)
+        rows = [(k, expires, pickle.dumps(v, pickle.HIGHEST_PROTOCOL)) for k, v in mapping.items()]
+        try:
+            with self._connection() as connection:
+                connection.executemany('INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?, ?, ?)', rows)
+                self._prune(connection)
+            return True
+        except sqlite3.Error:
+            return False
+
+    def add(self, key, value, timeout=None):
+        try:
+            with self._connection() as connection:
+                connection.execute('DELETE FROM cache WHERE key = ? AND expires != 0 AND expires <= ?',
+                                   (key, time()))
+                cursor = connection.execute('INSERT OR IGNORE INTO cache (key, expires, value) VALUES (?, ?, ?)',
+                                            (key, self._expires(timeout), pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+                return cursor.rowcount == 1
+        except sqlite3.Error:
+            return False
+
+    def delete(self, key):
+        with self._connection() as connection:
+            cursor = connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+            return cursor.rowcount == 1
+
+    def has(self, key):
+        row = self._connection().execute('SELECT 1 FROM cache WHERE key = ? AND (expires = 0 OR expires > ?)',
+                                         (key, time())).fetchone()
+        return row is not None
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache')
+        return True
+
+
+class TieredCache(BaseCache):
+    """
+    Two tier cache with a fast in process tier in front of a slower shared tier. Writes go through to both tiers
+    with the same timeout, reads are served from the first tier holding the key
+    """
+
+    def __init__(self, memory, backing, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.memory = memory
+        self.backing = backing
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+
+        return self.backing.get(key)
+
+    def get_many(self, *keys):
+        values = [self.memory.get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if missing:
+            found = dict(zip(missing, self.backing.get_many(*missing)))
+            values = [found[key] if value is None else value for key, value in zip(keys, values)]
+
+        return values
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        self.memory.set(key, value, timeout)
+        return self.backing.set(key, value, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        for key, value in mapping.items():
+            self.memory.set(key, value, timeout)
+        return self.backing.set_many(mapping, timeout)
+
+    def add(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        if not self.backing.add(key, value, timeout):
+            return False
+
+        self.memory.set(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        self.memory.delete(key)
+        return self.backing.delete(key)
+
+    def has(self, key):
+        return self.memory.has(key) or self.backing.has(key)
+
+    def clear(self):
+        self.memory.clear()
+        return self.backing.clear()
+
+
+def configure(**options):
+    """
+    Sets the cache options and discards the current cache object. See the 'cache' section of conf/configuration.yaml
+    :param options: dict of cache options
+    :return: None
+    """
+    global __cache
+
+    __options.update(options)
+    __cache = None
+
+
+def _create_backend(options):
+    """
+    Creates the shared cache backend selected by the 'backend' option
+    :param options: dict of cache options
+    :return: cache object
+    """
+    backend = options['backend']
+    default_timeout = options['default_timeout']
+
+    if backend == 'filesystem':
+        if not os.path.exists(options['cache_dir']):
+            os.makedirs(options['cache_dir'])
+
+        return FileSystemCache(cache_dir=options['cache_dir'], threshold=256, default_timeout=default_timeout,
+                               mode=0o600)
+
+    elif backend == 'sqlite':
+        cache_db_dir = os.path.dirname(options['sqlite_path'])
+        if not os.path.exists(cache_db_dir):
+            os.makedirs(cache_db_dir)
+
+        return SQLiteCache(options['sqlite_path'], default_timeout=default_timeout)
+
+    elif backend == 'redis':
+        import redis
+        # all threads share a bounded pool of connections
+        pool = redis.ConnectionPool.from_url(options['redis_url'], max_connections=options['max_connections'])
+        return RedisCache(host=redis.Redis(connection_pool=pool), default_timeout=default_timeout,
+                          key_prefix=options['key_prefix'])
+
+    elif backend == 'memcached':
+        from pymemcache import serde
+        from pymemcache.client.hash import HashClient
+        servers = [tuple(s.rsplit(':', 1)) for s in options['memcached_servers']]
+        client = HashClient([(host, int(port)) for host, port in servers], use_pooling=True,
+                            max_pool_size=options['max_connections'], serde=serde.pickle_serde,
+                            default_noreply=False)
+        return MemcachedCache(servers=client, default_timeout=default_timeout, key_prefix=options['key_prefix'])
+
+    raise ValueError('Unknown cache backend %s' % backend)
+
 
 def __get_cache():
     """
-    Simple wrapper around SimpleCache
-    This should make it easy to swap out cache implementations later if needed
+    Returns the cache object, creating it from the configured options on first use. Unless the 'memory' backend is
+    selected, an in memory tier is placed in front of the shared backend
     :return: cache object
     """
     global __cache
 
-    if not os.path.exists('/tmp/bootstrapper/cache'):
-        os.makedirs('/tmp/bootstrapper/cache')
-
     if __cache is not None:
         return __cache
 
-    try:
-        __cache = FileSystemCache(cache_dir='/tmp/bootstrapper/cache/', threshold=256, default_timeout=300, mode=0o600)
+    default_timeout = __options['default_timeout']
+    memory_max_bytes = __options['memory_max_bytes']
+
+    if __options['backend'] == 'memory':
+        __cache = MemoryLRUCache(max_bytes=memory_max_bytes, default_timeout=default_timeout)
         return __cache
-    except OSError:
-        raise
+
+    backend = _create_backend(__options)
+    if memory_max_bytes > 0:
+        memory_cache = MemoryLRUCache(max_bytes=memory_max_bytes, default_timeout=default_timeout)
+        __cache = TieredCache(memory_cache, backend, default_timeout=default_timeout)
+    else:
+        __cache = backend
+
+    return __cache
 
 
 def set(obj):
     """
-    sets an object in the cache for 300 seconds
+    sets an object in the cache for the configured default_timeout, 300 seconds by default
     :param obj: hashable object
     :return: key used to later retrieve the object or None on error
     """
@@ -50,3 +365,55 @@ def get(key):
     """
     c = __get_cache()
     return c.get(key)
+
+
+def set_many(objs):
+    """
+    sets many objects in the cache with a single call to the backend
+    :param objs: list of hashable objects
+    :return: list of keys used to later retrieve the objects or None on error
+    """
+    keys = [str(uuid.uuid4()) for _ in objs]
+    c = __get_cache()
+    if c.set_many(dict(zip(keys, objs))):
+        return keys
+    else:
+        return None
+
+
+def get_many(keys):
+    """
+    Retrieves many objects with a single call to the backend
+    :param keys: list of keys that were returned from the set operations
+    :return: list of objects in the same order as the keys, with None for each object not found
+    """
+    c = __get_cache()
+    return c.get_many(*keys)
+
+
+def has(key):
+    """
+    Checks if the given key is still present in the cache
+    :param key: key that was returned from the set operation
+    :return: boolean
+    """
+    c = __get_cache()
+    return c.has(key)
+
+
+def stats():
+    """
+    Returns the hit / miss / eviction counters of the in memory cache or cache tier
+    :return: dict containing 'hits', 'misses', 'evictions', 'bytes', and 'max_bytes' keys or an empty dict if no in
+    memory cache is used
+    """
+    c = __get_cache()
+    if isinstance(c, TieredCache):
+        c = c.memory
+
+    if not isinstance(c, MemoryLRUCache):
+        return dict()
+
+    s = dict(c.stats)
+    s['max_bytes'] = c.max_bytes
+    return s
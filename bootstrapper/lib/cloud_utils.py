@@ -0,0 +1,342 @@
+import hashlib
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import requests
+from azure.storage.file import FileService
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage
+from google.oauth2.credentials import Credentials
+
+# cloud upload options, see the 'cloud' section of conf/configuration.yaml
+__options = {
+    's3': {
+        # number of files uploaded at the same time per bucket
+        'max_workers': 8,
+        # files larger than multipart_threshold bytes are uploaded in parts of multipart_chunksize bytes, with up to
+        # max_concurrency parts of one file in flight at once
+        'multipart_threshold': 8 * 1024 * 1024,
+        'multipart_chunksize': 8 * 1024 * 1024,
+        'max_concurrency': 4,
+        # send requests to an S3 compatible endpoint instead of AWS, such as a local moto or minio server
+        'endpoint_url': None,
+        # existing bucket holding every bootstrap package under its own prefix, instead of a new bucket per package.
+        # Content updates and software images are uploaded once under shared_prefix and copied from there
+        'shared_bucket': None,
+        'shared_prefix': 'shared'
+    },
+    'azure': {
+        # number of files uploaded, or directories created, at the same time per file share
+        'max_workers': 8,
+        # number of ranges of one file uploaded at once, files smaller than 4MiB are always sent in one request
+        'max_connections': 4,
+        # file service endpoint to use instead of Azure, such as http://127.0.0.1:10004/<account> for a local emulator
+        'file_endpoint': None,
+        # SSL decryption on the path to Azure breaks certificate checks, so they are off unless enabled here
+        'verify_ssl': False,
+        # existing file share holding every bootstrap package in its own directory, instead of a new share per package.
+        # Content updates and software images are uploaded once under shared_prefix and copied from there
+        'shared_share': None,
+        'shared_prefix': 'shared',
+        # seconds to wait for a server side copy out of shared_prefix before it is aborted
+        'copy_timeout': 600
+    },
+    'gcp': {
+        # number of blobs uploaded at the same time per bucket
+        'max_workers': 8,
+        # files larger than resumable_threshold bytes are sent in resumable uploads of chunk_size bytes, which is
+        # rounded down to a multiple of 256KiB
+        'resumable_threshold': 8 * 1024 * 1024,
+        'chunk_size': 8 * 1024 * 1024,
+        # send requests to a GCS compatible endpoint instead of Google, such as a local fake-gcs-server. Needs
+        # google-cloud-storage 1.24 or later
+        'api_endpoint': None,
+        # existing bucket holding every bootstrap package under its own prefix, instead of a new bucket per package.
+        # Content updates and software images are uploaded once under shared_prefix and copied from there
+        'shared_bucket': None,
+        'shared_prefix': 'shared'
+    }
+}
+
+# resumable uploads to GCS are sent in chunks of a multiple of this size
+_gcs_chunk_multiple = 256 * 1024
+# most clients kept at once, the least recently used one is dropped after that. GCP access tokens expire after an hour
+# so their clients are not used for long
+_max_clients = 64
+
+# clients keyed by provider, endpoint, region and credentials. Clients are thread safe and keep their connection pool
+# between requests, creating them is not thread safe and slow
+__clients = OrderedDict()
+# upload thread pools keyed by provider
+__pools = dict()
+# connection pool shared by the sessions of every GCP client
+__gcp_adapter = None
+# one lock per shared object, so concurrent builds do not upload the same content update twice. Entries go away once
+# no upload of the object is running
+__shared = weakref.WeakValueDictionary()
+__lock = threading.Lock()
+
+log = logging.getLogger(__name__)
+
+
+def configure(**options):
+    """
+    Sets the cloud upload options. See the 'cloud' section of conf/configuration.yaml
+    :param options: dict with a dict of options per provider
+    :return: None
+    """
+    global __gcp_adapter
+
+    with __lock:
+        for provider, settings in options.items():
+            __options.setdefault(provider, dict()).update(settings or dict())
+
+        # pools and clients are sized from the options, build them again on next use
+        for pool in __pools.values():
+            pool.shutdown(wait=False)
+        __pools.clear()
+        __clients.clear()
+        __gcp_adapter = None
+
+
+def get_options(provider):
+    """
+    Returns the upload options of a cloud provider
+    :param provider: one of 's3', 'azure' or 'gcp'
+    :return: dict of options
+    """
+    return dict(__options[provider])
+
+
+def _client_key(provider, *args):
+    """
+    Builds the key of a pooled client, secrets are hashed so they are not kept in the key in clear text
+    """
+    return (provider,) + args[:-1] + (hashlib.sha256(str(args[-1]).encode('utf-8')).hexdigest(),)
+
+
+def _pooled_client(key, create):
+    """
+    Returns the pooled client for a key, calling create to build it on first use. Clients are built outside the lock,
+    so slow setup does not hold up other lookups. When two threads build the same client at once the first one stored
+    is kept. Evicting a client only drops the reference of the pool, threads still holding it keep using it until
+    their transfer is done and it is garbage collected
+    """
+    with __lock:
+        client = __clients.get(key, None)
+        if client is not None:
+            __clients.move_to_end(key)
+            return client
+
+    client = create()
+    with __lock:
+        client = __clients.setdefault(key, client)
+        __clients.move_to_end(key)
+        while len(__clients) > _max_clients:
+            __clients.popitem(last=False)
+
+        return client
+
+
+def _connection_pool_size(options, connections_key=None):
+    """
+    Returns the number of connections to keep open for the upload threads, with connections_key naming the option of
+    the number of connections each upload uses
+    """
+    connections = max(int(options[connections_key]), 1) if connections_key else 1
+    return max(int(options['max_workers']) * connections, 10)
+
+
+def get_s3_client(region, access_key, secret_key):
+    """
+    Returns the pooled S3 client for a region and set of credentials, creating it on first use. The connection pool of
+    the client is large enough for every upload thread
+    :param region: AWS region name
+    :param access_key: AWS access key id
+    :param secret_key: AWS secret access key
+    :return: boto3 S3 client
+    """
+    options = get_options('s3')
+
+    def create():
+        return boto3.client('s3',
+                            region_name=region,
+                            endpoint_url=options['endpoint_url'],
+                            aws_access_key_id=access_key,
+                            aws_secret_access_key=secret_key,
+                            config=Config(max_pool_connections=_connection_pool_size(options, 'max_concurrency')))
+
+    return _pooled_client(_client_key('s3', options['endpoint_url'], region, access_key, secret_key), create)
+
+
+def get_file_service(account_name, account_key):
+    """
+    Returns the pooled Azure FileService for a storage account, creating it on first use. Every FileService of an
+    account shares one requests session, so connections are kept open between requests and uploads
+    :param account_name: storage account name
+    :param account_key: storage account key
+    :return: azure.storage.file.FileService
+    """
+    options = get_options('azure')
+
+    def create():
+        session = requests.Session()
+        session.verify = options['verify_ssl']
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=_connection_pool_size(options, 'max_connections'))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        if options['file_endpoint']:
+            connection_string = 'DefaultEndpointsProtocol={0};AccountName={1};AccountKey={2};FileEndpoint={3}'
+            protocol = options['file_endpoint'].split(':', 1)[0]
+            return FileService(connection_string=connection_string.format(protocol, account_name, account_key,
+                                                                          options['file_endpoint']),
+                               request_session=session)
+
+        return FileService(account_name=account_name, account_key=account_key, request_session=session)
+
+    return _pooled_client(_client_key('azure', options['file_endpoint'], account_name, account_key), create)
+
+
+def _gcp_adapter(options):
+    """
+    Returns the connection pool shared by the sessions of every GCP client, creating it on first use
+    """
+    global __gcp_adapter
+
+    with __lock:
+        if __gcp_adapter is None:
+            __gcp_adapter = requests.adapters.HTTPAdapter(pool_maxsize=_connection_pool_size(options))
+
+        return __gcp_adapter
+
+
+def get_gcp_client(project_id, access_token):
+    """
+    Returns the pooled GCS client for a project and access token, creating it on first use. The sessions of all GCS
+    clients share one connection pool, large enough for every upload thread
+    :param project_id: GCP project id
+    :param access_token: OAuth2 access token
+    :return: google.cloud.storage.Client
+    """
+    options = get_options('gcp')
+
+    def create():
+        adapter = _gcp_adapter(options)
+        credentials = Credentials(access_token)
+        session = AuthorizedSession(credentials)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        if options['api_endpoint']:
+            return storage.Client(project_id, credentials, _http=session,
+                                  client_options={'api_endpoint': options['api_endpoint']})
+
+        return storage.Client(project_id, credentials, _http=session)
+
+    return _pooled_client(_client_key('gcp', options['api_endpoint'], project_id, access_token), create)
+
+
+def gcs_chunk_size(size):
+    """
+    Returns the chunk size of the resumable upload of a file, or None if the file is small enough for a single request
+    :param size: size of the file in bytes
+    :return: chunk size in bytes, a multiple of 256KiB, or None
+    """
+    options = get_options('gcp')
+    if size <= options['resumable_threshold']:
+        return None
+
+    return max(int(options['chunk_size']) // _gcs_chunk_multiple, 1) * _gcs_chunk_multiple
+
+
+def s3_transfer_config():
+    """
+    Returns the multipart settings for S3 uploads. Files are read from disk part by part, never whole
+    :return: boto3 TransferConfig
+    """
+    options = get_options('s3')
+    return TransferConfig(multipart_threshold=options['multipart_threshold'],
+                          multipart_chunksize=options['multipart_chunksize'],
+                          max_concurrency=options['max_concurrency'],
+                          use_threads=options['max_concurrency'] > 1)
+
+
+def _get_pool(provider):
+    with __lock:
+        pool = __pools.get(provider, None)
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=max(int(__options[provider]['max_workers']), 1))
+            __pools[provider] = pool
+
+        return pool
+
+
+def run_uploads(provider, upload, items):
+    """
+    Calls upload once per item on the bounded upload pool of a provider, which is shared by all requests so the
+    number of uploads in flight stays bounded under load
+    :param provider: one of 's3', 'azure' or 'gcp'
+    :param upload: function called with each item
+    :param items: list of arguments for upload
+    :return: list of the results of upload, in the order of items
+    :raises: the first exception raised by an upload, after every upload has finished
+    """
+    futures = [_get_pool(provider).submit(upload, item) for item in items]
+
+    results = list()
+    error = None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            log.error('Upload failed: %s' % e)
+            results.append(None)
+            if error is None:
+                error = e
+
+    if error is not None:
+        raise error
+
+    return results
+
+
+class _SharedLock(object):
+    """
+    Lock of one shared object. Locks can not be weakly referenced, so they are held by this
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+
+def upload_shared(key, size, stored_size, upload):
+    """
+    Uploads a file shared by the bootstrap packages in a shared bucket or file share, unless it is stored already.
+    Content updates and software images carry their version in their name, so a stored object of the same name and
+    size is the same file
+    :param key: tuple naming the shared object, such as (provider, bucket, object key)
+    :param size: size in bytes of the local file
+    :param stored_size: function returning the size in bytes of the stored object, or None if there is none
+    :param upload: function uploading the local file
+    :return: True if the file was uploaded, False if the stored object was kept
+    """
+    with __lock:
+        shared = __shared.get(key, None)
+        if shared is None:
+            shared = _SharedLock()
+            __shared[key] = shared
+
+    with shared.lock:
+        if stored_size() == size:
+            return False
+
+        log.info('uploading shared file %s' % '/'.join(key[1:]))
+        upload()
+        return True
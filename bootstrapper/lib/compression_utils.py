@@ -0,0 +1,267 @@
+import os
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import member_store
+
+# compression settings used when an archive type has none configured, see the 'archive' section of
+# conf/configuration.yaml
+default_options = {
+    # zlib compression level, 0 stores everything
+    'level': 6,
+    # store content updates and software images that are already compressed instead of compressing them again
+    'store_compressed': True,
+    # number of threads compressing a tgz archive, 0 uses one per cpu and 1 compresses in the request thread
+    'threads': 0,
+    # tgz archives switch to compressing on multiple threads after this many bytes
+    'parallel_min_size': 16 * 1024 * 1024
+}
+
+# file extensions of formats that are already compressed
+default_store_extensions = ['.gz', '.tgz', '.zip', '.bz2', '.xz', '.7z', '.zst', '.iso']
+
+# magic numbers of gzip, zip, bzip2, xz, 7z and zstd
+_compressed_magic = (b'\x1f\x8b', b'PK\x03\x04', b'BZh', b'\xfd7zXZ\x00', b"7z\xbc\xaf'\x1c", b'\x28\xb5\x2f\xfd')
+
+# input is split into blocks of this size when compressing on multiple threads
+_block_size = 1024 * 1024
+# deflate looks back at most this far, each block is primed with this much of the data before it
+_window_size = 32 * 1024
+# an empty final deflate block, ends a stream whose blocks were each compressed with a sync flush
+_final_block = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+
+_max_threads = 64
+
+__pool = None
+__lock = threading.Lock()
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+
+    if str(value).lower() in ('true', 'yes', '1'):
+        return True
+    if str(value).lower() in ('false', 'no', '0'):
+        return False
+
+    raise ValueError('Invalid boolean value %s' % value)
+
+
+def resolve_options(configured=None, overrides=None):
+    """
+    Merges the configured compression settings of an archive type with the overrides from a request
+    :param configured: dict of settings from the configuration file
+    :param overrides: dict of settings from the request, values may be strings when posted as form data
+    :return: dict with 'level', 'store_compressed', 'threads' and 'parallel_min_size' keys
+    :raises ValueError: if a setting is unknown or out of range
+    """
+    options = dict(default_options)
+    for settings in (configured, overrides):
+        if not settings:
+            continue
+
+        for key, value in settings.items():
+            if key not in default_options:
+                raise ValueError('Unknown compression option %s' % key)
+            options[key] = value
+
+    options['level'] = int(options['level'])
+    if not 0 <= options['level'] <= 9:
+        raise ValueError('Compression level must be between 0 and 9')
+
+    options['threads'] = int(options['threads'])
+    if not 0 <= options['threads'] <= _max_threads:
+        raise ValueError('Compression threads must be between 0 and %s' % _max_threads)
+
+    options['parallel_min_size'] = int(options['parallel_min_size'])
+    if options['parallel_min_size'] < 0:
+        raise ValueError('Compression parallel_min_size must not be negative')
+
+    options['store_compressed'] = _to_bool(options['store_compressed'])
+    return options
+
+
+def is_compressed(name, head, store_extensions=None):
+    """
+    Checks if a file is already compressed, by its extension or by the magic number at the start of its contents
+    :param name: file name
+    :param head: first bytes of the file
+    :param store_extensions: list of extensions, defaults to default_store_extensions
+    :return: boolean
+    """
+    if store_extensions is None:
+        store_extensions = default_store_extensions
+
+    if os.path.splitext(name)[1].lower() in store_extensions:
+        return True
+
+    return bytes(head[:8]).startswith(_compressed_magic)
+
+
+def is_compressed_file(path, store_extensions=None):
+    """
+    Checks if a file on disk is already compressed, see is_compressed
+    :param path: path of the file
+    :param store_extensions: list of extensions, defaults to default_store_extensions
+    :return: boolean
+    """
+    with open(path, 'rb') as f:
+        head = f.read(8)
+
+    return is_compressed(os.path.basename(path), head, store_extensions)
+
+
+def _get_pool():
+    global __pool
+
+    with __lock:
+        if __pool is None:
+            __pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+        return __pool
+
+
+def _deflate_block(data, compresslevel, zdict):
+    """
+    Compresses one block of a parallel gzip stream. The block ends on a byte boundary without a final deflate block,
+    so blocks can be concatenated. Priming the compressor with the 32KiB before the block keeps the compression ratio
+    close to that of a single compressor
+    """
+    if zdict:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def iter_gzip(chunks, compresslevel=6, threads=0, parallel_min_size=default_options['parallel_min_size']):
+    """
+    Compresses a stream of bytes into a single gzip stream. Once more than parallel_min_size bytes have been
+    compressed, the rest of the input is split into blocks that are compressed on a thread pool like pigz does, zlib
+    releases the GIL while compressing. Dicts in the stream hold either a 'stored' iterable of bytes, which is added
+    to the stream without compression, or a 'gzip_member' iterable of bytes that is already gzip compressed, such as a
+    precompressed member. A 'gzip_member' ends the current gzip stream and is copied in as is, gzip readers treat
+    concatenated members as one stream
+    :param chunks: iterable of bytes or dicts with a 'stored' or a 'gzip_member' key
+    :param compresslevel: zlib compression level from 0 to 9
+    :param threads: number of threads compressing blocks in parallel, 0 uses one per cpu and 1 never compresses in
+    parallel
+    :param parallel_min_size: number of bytes compressed in the calling thread before switching to parallel blocks
+    :return: generator of bytes
+    """
+    if threads == 0:
+        threads = os.cpu_count() or 1
+
+    started = False
+    for chunk in chunks:
+        if isinstance(chunk, dict) and 'gzip_member' in chunk:
+            if started:
+                for piece in _finish_stream(compressor, pending, block, block_level, window, crc, size):
+                    yield piece
+                started = False
+
+            for piece in chunk['gzip_member']:
+                yield piece
+            continue
+
+        if not started:
+            yield member_store.gzip_header
+            started = True
+            crc = 0
+            size = 0
+            # compressor used until parallel_min_size bytes have been compressed
+            compressor = None
+            compressor_level = compresslevel
+            # blocks submitted to the thread pool, in stream order
+            pending = None
+            block = bytearray()
+            block_level = compresslevel
+            window = b''
+
+        if isinstance(chunk, dict):
+            pieces, level = chunk['stored'], 0
+        else:
+            pieces, level = (chunk,), compresslevel
+
+        for data in pieces:
+            if not len(data):
+                continue
+
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+
+            if pending is None:
+                if compressor is not None and compressor_level != level:
+                    yield compressor.flush(zlib.Z_SYNC_FLUSH)
+                    compressor = None
+
+                if compressor is None:
+                    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+                    compressor_level = level
+
+                compressed = compressor.compress(data)
+                if compressed:
+                    yield compressed
+
+                if threads > 1 and size >= parallel_min_size:
+                    yield compressor.flush(zlib.Z_SYNC_FLUSH)
+                    compressor = None
+                    pending = deque()
+                    window = bytes(data[-_window_size:])
+                continue
+
+            if block and block_level != level:
+                window = _submit_block(pending, block, block_level, window)
+                block = bytearray()
+
+            block_level = level
+            block += data
+            while len(block) >= _block_size:
+                window = _submit_block(pending, block[:_block_size], block_level, window)
+                del block[:_block_size]
+
+                # bound the memory held by blocks waiting to be written
+                while len(pending) > 2 * threads:
+                    yield pending.popleft().result()
+
+    if started:
+        for piece in _finish_stream(compressor, pending, block, block_level, window, crc, size):
+            yield piece
+
+
+def _submit_block(pending, block, compresslevel, window):
+    """
+    Queues a block for compression on the thread pool
+    :return: the last 32KiB of the block, the dictionary for the next block
+    """
+    data = bytes(block)
+    pending.append(_get_pool().submit(_deflate_block, data, compresslevel, window if compresslevel > 0 else b''))
+    return data[-_window_size:]
+
+
+def _finish_stream(compressor, pending, block, block_level, window, crc, size):
+    """
+    Writes out the remaining blocks, the final deflate block and the gzip trailer
+    :return: generator of bytes
+    """
+    if pending is None:
+        if compressor is not None:
+            yield compressor.flush()
+        else:
+            yield _final_block
+    else:
+        if block:
+            _submit_block(pending, block, block_level, window)
+
+        while pending:
+            yield pending.popleft().result()
+
+        yield _final_block
+
+    yield struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)
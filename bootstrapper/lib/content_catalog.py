@@ -0,0 +1,180 @@
+import hashlib
+import os
+import re
+import threading
+import uuid
+
+from . import file_utils
+
+# trailing numeric components of PAN-OS content file names, for example the 8000-5000 in panupv2-all-contents-8000-5000
+_version_re = re.compile(r'(?:-\d+)+$')
+
+# sha256 of files keyed by (path, size, mtime), shared on disk by every worker so large files are hashed only once
+_digest_dir = '/var/tmp/bootstrapper/digests'
+
+# latest content update per package directory, keyed by the absolute path of the directory
+__catalog = dict()
+# digests read from or written to _digest_dir by this process
+__digests = dict()
+__lock = threading.Lock()
+
+
+def parse_version(file_name):
+    """
+    Parses the version of a PAN-OS content update from its file name. Versions compare numerically, so 10000-5000
+    is newer than 9999-5000
+    :param file_name: file name such as panupv2-all-contents-8000-5000 or panup-all-wildfire-400000-400500
+    :return: tuple of ints, empty if the file name does not end in a version
+    """
+    match = _version_re.search(file_name)
+    if match is None:
+        return tuple()
+
+    return tuple(int(n) for n in match.group(0).strip('-').split('-'))
+
+
+def sha256_file(path):
+    """
+    Computes the sha256 digest of a file
+    :param path: path of the file
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    for chunk in file_utils.iter_file(path):
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _digest_path(key):
+    name = hashlib.sha256(('%s:%d:%d' % key).encode('utf-8')).hexdigest()
+    return os.path.join(_digest_dir, name)
+
+
+def file_digest(path, stat=None):
+    """
+    Returns the sha256 digest of a file, hashing it only if no worker has hashed the same path, size and mtime before.
+    Digests are kept in small files in _digest_dir
+    :param path: path of the file
+    :param stat: os.stat_result of the file, taken again when not given
+    :return: hex digest
+    """
+    if stat is None:
+        stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with __lock:
+        digest = __digests.get(key, None)
+    if digest is not None:
+        return digest
+
+    digest_path = _digest_path(key)
+    try:
+        with open(digest_path, 'r') as f:
+            digest = f.read().strip()
+    except OSError:
+        digest = None
+
+    if not digest:
+        digest = sha256_file(path)
+        after = os.stat(path)
+        if (after.st_size, after.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            # changed while it was read, the digest belongs to neither version
+            return digest
+
+        # written under a temporary name first, so other workers never read a partial digest
+        try:
+            os.makedirs(_digest_dir, exist_ok=True)
+            temp_path = '%s.%s.tmp' % (digest_path, uuid.uuid4().hex)
+            with open(temp_path, 'w') as f:
+                f.write(digest)
+            os.replace(temp_path, digest_path)
+        except OSError:
+            pass
+
+    with __lock:
+        __digests[key] = digest
+
+    return digest
+
+
+def _scan(package_dir):
+    """
+    Finds the newest content update in the directory and describes it
+    :param package_dir: directory of a single package type
+    :return: dict with 'name', 'path', 'version', 'size', 'mtime' and 'sha256' keys or None if the directory is empty
+    """
+    candidates = list()
+    with os.scandir(package_dir) as entries:
+        for entry in entries:
+            # skip partial downloads and anything else that is hidden
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            candidates.append((parse_version(entry.name), entry.name))
+
+    if not candidates:
+        return None
+
+    version, name = max(candidates)
+    return _describe(os.path.join(package_dir, name), version)
+
+
+def _describe(path, version):
+    stat = os.stat(path)
+    return {
+        'name': os.path.basename(path),
+        'path': path,
+        'version': '-'.join(str(v) for v in version),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'sha256': file_digest(path, stat)
+    }
+
+
+def get_latest(package_dir):
+    """
+    Returns the newest content update in the directory. The directory is only listed again when its mtime changes,
+    which happens whenever a file is added, removed or renamed in it
+    :param package_dir: directory of a single package type, for example /var/tmp/content_updates/antivirus
+    :return: dict with 'name', 'path', 'version', 'size', 'mtime' and 'sha256' keys or None if there are no updates
+    """
+    package_dir = os.path.abspath(package_dir)
+    try:
+        dir_mtime = os.stat(package_dir).st_mtime_ns
+    except OSError:
+        # there's nothing here to see, move along
+        with __lock:
+            __catalog.pop(package_dir, None)
+        return None
+
+    with __lock:
+        cached = __catalog.get(package_dir, None)
+
+    if cached is not None and cached['dir_mtime'] == dir_mtime:
+        latest = cached['latest']
+        if latest is None:
+            return None
+
+        # a file overwritten in place does not change the directory mtime
+        try:
+            stat = os.stat(latest['path'])
+            if stat.st_mtime_ns == latest['mtime'] and stat.st_size == latest['size']:
+                return latest
+        except OSError:
+            pass
+
+    latest = _scan(package_dir)
+    with __lock:
+        __catalog[package_dir] = {'dir_mtime': dir_mtime, 'latest': latest}
+
+    return latest
+
+
+def clear():
+    """
+    Forgets all cached directory listings and the digests held in memory, the next lookup of each directory scans it
+    again. Digests stored in _digest_dir are kept
+    :return: None
+    """
+    with __lock:
+        __catalog.clear()
+        __digests.clear()
@@ -1,4 +1,5 @@
 from sqlalchemy import create_engine
+from sqlalchemy import inspect
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -16,3 +17,25 @@ def init_db():
     # you will have to import them first before calling init_db()
     import bootstrapper.lib.db_models
     Base.metadata.create_all(bind=engine)
+
+
+def upgrade_db(bind=None):
+    """
+    Adds any columns that are missing from tables created by older versions of the bootstrapper. The existing columns
+    are read first, so nothing is altered once the database is up to date
+    :param bind: engine of the database, defaults to the bootstrapper database
+    :return: list of the names of the added columns
+    """
+    bind = bind or engine
+    import bootstrapper.lib.db_models
+    Base.metadata.create_all(bind=bind)
+
+    added = list()
+    columns = [c['name'] for c in inspect(bind).get_columns('templates')]
+    if 'variables' not in columns:
+        print('Adding variables column to templates table')
+        with bind.connect() as connection:
+            connection.execute('ALTER TABLE templates ADD COLUMN variables VARCHAR')
+        added.append('variables')
+
+    return added
@@ -13,6 +13,8 @@ class Template(Base):
     description = Column(String(120), unique=False)
     # actual text of the jinja template
     template = Column(String(), unique=False)
+    # json encoded list of the undeclared variables found in the template
+    variables = Column(String(), unique=False)
 
     def __init__(self, name=None, description=None, type='bootstrap', template=""):
         self.name = name
@@ -0,0 +1,93 @@
+import errno
+import fcntl
+import mmap
+import os
+import shutil
+
+# ioctl request to clone a file on filesystems with reflink support such as btrfs and xfs, from linux/fs.h
+_FICLONE = 0x40049409
+
+# large files are read in pieces of this size
+read_chunk_size = 1024 * 1024
+
+
+def iter_file(path, chunk_size=read_chunk_size, offset=0, length=None):
+    """
+    Reads a file piece by piece through a memory map, so the contents are handed to the consumer without being copied
+    into Python buffers. The mapping is released once the last chunk is no longer referenced
+    :param path: path of the file to read
+    :param chunk_size: size in bytes of each chunk
+    :param offset: offset of the first byte to read
+    :param length: number of bytes to read, defaults to the rest of the file
+    :return: generator of memoryview objects
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        stop = size if length is None else min(size, offset + length)
+        if stop <= offset:
+            return
+
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    for start in range(offset, stop, chunk_size):
+        yield view[start:min(start + chunk_size, stop)]
+
+
+def copy_file(source_path, destination_path):
+    """
+    Copies a file inside the kernel with os.sendfile, falling back to a buffered copy where sendfile is not
+    supported
+    :param source_path: path of the file to copy
+    :param destination_path: path of the new file
+    :return: None
+    """
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        size = os.fstat(source.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(destination.fileno(), source.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as oe:
+            if oe.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP) or offset != 0:
+                raise
+            shutil.copyfileobj(source, destination, read_chunk_size)
+
+
+def reflink_file(source_path, destination_path):
+    """
+    Creates a copy on write clone of a file
+    :param source_path: path of the file to clone
+    :param destination_path: path of the new file
+    :return: boolean, False if the filesystem does not support reflinks
+    """
+    try:
+        with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+            fcntl.ioctl(destination.fileno(), _FICLONE, source.fileno())
+        return True
+    except OSError:
+        if os.path.exists(destination_path):
+            os.remove(destination_path)
+        return False
+
+
+def link_or_copy(source_path, destination_path):
+    """
+    Places a file at the destination without copying its contents where possible. A hard link is tried first, then a
+    reflink, and finally a sendfile copy when the destination is on another filesystem that does not support reflinks
+    :param source_path: path of the existing file
+    :param destination_path: path of the new file
+    :return: None
+    """
+    try:
+        os.link(source_path, destination_path)
+        return
+    except OSError:
+        pass
+
+    if reflink_file(source_path, destination_path):
+        return
+
+    copy_file(source_path, destination_path)
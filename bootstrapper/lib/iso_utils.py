@@ -0,0 +1,460 @@
+import os
+import re
+import struct
+import time
+
+from . import file_utils
+
+# ISO9660 logical sector size
+sector_size = 2048
+
+# the first 16 sectors are reserved for the system area
+_system_area_sectors = 16
+
+# primary names follow mkisofs -l -allow-lowercase -allow-multidot -ldots, at most 31 characters of d-characters,
+# lowercase letters and dots
+_max_iso_name_length = 31
+_iso_name_re = re.compile(r'[^A-Za-z0-9_.]')
+_max_joliet_name_length = 64
+
+_rrip_id = b'RRIP_1991A'
+_rrip_description = b'THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT FOR POSIX FILE SYSTEM SEMANTICS'
+_rrip_source = b'PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE.  SEE PUBLISHER IDENTIFIER IN PRIMARY ' \
+               b'VOLUME DESCRIPTOR FOR CONTACT INFORMATION.'
+
+_dir_mode = 0o40755
+_file_mode = 0o100644
+
+
+def _both16(n):
+    return struct.pack('<H', n) + struct.pack('>H', n)
+
+
+def _both32(n):
+    return struct.pack('<I', n) + struct.pack('>I', n)
+
+
+def _sectors(size):
+    return (size + sector_size - 1) // sector_size
+
+
+def _record_date(t):
+    tm = time.gmtime(t)
+    return struct.pack('7B', tm.tm_year - 1900, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec, 0)
+
+
+def _volume_date(t):
+    return time.strftime('%Y%m%d%H%M%S00', time.gmtime(t)).encode('ascii') + b'\x00'
+
+
+def _text(value, length, joliet):
+    """
+    Encodes a descriptor text field, padded with spaces
+    """
+    if joliet:
+        encoded = value.encode('utf-16-be')[:length - length % 2]
+        return (encoded + b'\x00 ' * ((length - len(encoded)) // 2)).ljust(length, b'\x00')
+
+    return value.encode('ascii')[:length].ljust(length, b' ')
+
+
+def _iso_name(name, is_dir, used):
+    """
+    Returns a unique primary volume name for a directory entry
+    :param name: real name of the entry
+    :param is_dir: boolean
+    :param used: set of names already used in the same directory, the new name is added to it
+    :return: bytes
+    """
+    name = _iso_name_re.sub('_', name)
+    if is_dir:
+        base, extension = name[:_max_iso_name_length], None
+    else:
+        base, _, extension = name.rpartition('.') if '.' in name else (name, '', '')
+        extension = extension[:_max_iso_name_length - 1]
+        base = base[:_max_iso_name_length - 1 - len(extension)]
+
+    candidate = base if is_dir else '%s.%s' % (base, extension)
+    counter = 0
+    while candidate in used:
+        suffix = '%03d' % counter
+        counter += 1
+        truncated = base[:_max_iso_name_length - len(suffix) - (0 if is_dir else 1 + len(extension))]
+        candidate = truncated + suffix if is_dir else '%s%s.%s' % (truncated, suffix, extension)
+
+    used.add(candidate)
+    return (candidate if is_dir else candidate + ';1').encode('ascii')
+
+
+def _joliet_name(name, used):
+    """
+    Returns a unique Joliet name for a directory entry
+    :param name: real name of the entry
+    :param used: set of names already used in the same directory, the new name is added to it
+    :return: bytes
+    """
+    candidate = name[:_max_joliet_name_length]
+    counter = 0
+    while candidate in used:
+        suffix = '%03d' % counter
+        counter += 1
+        candidate = name[:_max_joliet_name_length - len(suffix)] + suffix
+
+    used.add(candidate)
+    return candidate.encode('utf-16-be')
+
+
+def _directory_record(identifier, extent, size, is_dir, date, system_use=b''):
+    pad = b'\x00' if len(identifier) % 2 == 0 else b''
+    length = 33 + len(identifier) + len(pad) + len(system_use)
+    if length % 2:
+        system_use += b'\x00'
+        length += 1
+
+    if length > 255:
+        raise ValueError('Directory record for %s is too long' % identifier)
+
+    return (struct.pack('<BB', length, 0) + _both32(extent) + _both32(size) + date +
+            struct.pack('<BBB', 0x02 if is_dir else 0x00, 0, 0) + _both16(1) + struct.pack('<B', len(identifier)) +
+            identifier + pad + system_use)
+
+
+def _rock_ridge(mode, links, date, name=None):
+    """
+    Builds the Rock Ridge system use entries of a directory record
+    :param mode: posix file mode
+    :param links: number of hard links
+    :param date: 7 byte recording date
+    :param name: real name of the entry or None for the '.' and '..' entries
+    :return: bytes
+    """
+    flags = 0x81 if name is None else 0x89
+    entries = b'RR' + struct.pack('<BBB', 5, 1, flags)
+    entries += b'PX' + struct.pack('<BB', 36, 1) + _both32(mode) + _both32(links) + _both32(0) + _both32(0)
+    entries += b'TF' + struct.pack('<BBB', 12, 1, 0x02) + date
+    if name is not None:
+        encoded = name.encode('utf-8')
+        entries += b'NM' + struct.pack('<BBB', 5 + len(encoded), 1, 0) + encoded
+
+    return entries
+
+
+def _extension_reference():
+    return (b'ER' + struct.pack('<BBBBBB', 8 + len(_rrip_id) + len(_rrip_description) + len(_rrip_source), 1,
+                                len(_rrip_id), len(_rrip_description), len(_rrip_source), 1) +
+            _rrip_id + _rrip_description + _rrip_source)
+
+
+def _root_system_use(ce_extent, date):
+    """
+    The '.' entry of the root directory announces SUSP with an SP entry and continues into the sector holding the
+    Rock Ridge extension reference
+    """
+    return (b'SP' + struct.pack('<BBBBB', 7, 1, 0xbe, 0xef, 0) +
+            b'CE' + struct.pack('<BB', 28, 1) + _both32(ce_extent) + _both32(0) + _both32(len(_extension_reference())) +
+            _rock_ridge(_dir_mode, 0, date))
+
+
+def _new_node(name, parent, is_dir, source=None, size=0):
+    return {
+        'name': name,
+        'parent': parent,
+        'is_dir': is_dir,
+        'children': list(),
+        'source': source,
+        'size': size
+    }
+
+
+def _build_tree(entries):
+    """
+    Builds the directory tree from the list of entries, creating any missing parent directories
+    :param entries: list of (path, source) tuples, see build_layout
+    :return: root node
+    """
+    root = _new_node('', None, True)
+    directories = {'': root}
+
+    def get_directory(path):
+        if path in directories:
+            return directories[path]
+
+        parent_path, _, name = path.rpartition('/')
+        parent = get_directory(parent_path)
+        node = _new_node(name, parent, True)
+        parent['children'].append(node)
+        directories[path] = node
+        return node
+
+    for path, source in entries:
+        path = path.strip('/')
+        if source is None:
+            get_directory(path)
+            continue
+
+        parent_path, _, name = path.rpartition('/')
+        parent = get_directory(parent_path)
+        if isinstance(source, bytes):
+            size = len(source)
+        else:
+            size = os.path.getsize(source)
+
+        parent['children'].append(_new_node(name, parent, False, source, size))
+
+    return root
+
+
+def _assign_names(directory):
+    iso_used = set()
+    joliet_used = set()
+    for child in directory['children']:
+        child['iso_name'] = _iso_name(child['name'], child['is_dir'], iso_used)
+        child['joliet_name'] = _joliet_name(child['name'], joliet_used)
+        if child['is_dir']:
+            _assign_names(child)
+
+
+def _path_table_order(root, name_key):
+    """
+    Lists the directories in path table order, by level then by parent then by name
+    """
+    ordered = [root]
+    index = 0
+    while index < len(ordered):
+        directory = ordered[index]
+        ordered.extend(sorted([c for c in directory['children'] if c['is_dir']], key=lambda c: c[name_key]))
+        index += 1
+
+    return ordered
+
+
+def _directory_records(layout, directory, joliet):
+    """
+    Builds the directory records of a directory
+    :param layout: layout from build_layout. Record lengths do not depend on the extents, so this is also used to
+    size the directories before the extents are known
+    :param directory: directory node
+    :param joliet: build the Joliet records instead of the primary records
+    :return: list of bytes
+    """
+    date = layout['date']
+    prefix = 'joliet_' if joliet else 'iso_'
+    name_key = prefix + 'name'
+    parent = directory['parent'] or directory
+    links = 2 + len([c for c in directory['children'] if c['is_dir']])
+    parent_links = 2 + len([c for c in parent['children'] if c['is_dir']])
+
+    if joliet:
+        self_use = parent_use = b''
+    elif directory['parent'] is None:
+        self_use = _root_system_use(layout.get('ce_extent', 0), date)
+        parent_use = _rock_ridge(_dir_mode, parent_links, date)
+    else:
+        self_use = _rock_ridge(_dir_mode, links, date)
+        parent_use = _rock_ridge(_dir_mode, parent_links, date)
+
+    records = [
+        _directory_record(b'\x00', directory.get(prefix + 'extent', 0), directory.get(prefix + 'size', 0), True,
+                          date, self_use),
+        _directory_record(b'\x01', parent.get(prefix + 'extent', 0), parent.get(prefix + 'size', 0), True,
+                          date, parent_use)
+    ]
+
+    for child in sorted(directory['children'], key=lambda c: c[name_key]):
+        if child['is_dir']:
+            extent = child.get(prefix + 'extent', 0)
+            size = child.get(prefix + 'size', 0)
+            links = 2 + len([c for c in child['children'] if c['is_dir']])
+            mode = _dir_mode
+        else:
+            extent = child.get('extent', 0)
+            size = child['size']
+            links = 1
+            mode = _file_mode
+
+        system_use = b'' if joliet else _rock_ridge(mode, links, date, child['name'])
+        records.append(_directory_record(child[name_key], extent, size, child['is_dir'], date, system_use))
+
+    return records
+
+
+def _pack_records(records):
+    """
+    Packs directory records into sectors, records may not span a sector boundary
+    :return: bytes padded to a whole number of sectors
+    """
+    data = bytearray()
+    for record in records:
+        remaining = sector_size - len(data) % sector_size
+        if len(record) > remaining:
+            data += b'\x00' * remaining
+        data += record
+
+    data += b'\x00' * (-len(data) % sector_size)
+    return bytes(data)
+
+
+def _path_table(directories, name_key, extent_key, big_endian):
+    numbers = dict((id(d), i + 1) for i, d in enumerate(directories))
+    fmt = '>IH' if big_endian else '<IH'
+    table = bytearray()
+    for directory in directories:
+        identifier = b'\x00' if directory['parent'] is None else directory[name_key]
+        parent = numbers[id(directory['parent'] or directory)]
+        table += struct.pack('<BB', len(identifier), 0) + struct.pack(fmt, directory[extent_key], parent) + identifier
+        if len(identifier) % 2:
+            table += b'\x00'
+
+    return bytes(table)
+
+
+def _volume_descriptor(layout, joliet):
+    prefix = 'joliet_' if joliet else 'iso_'
+    root = layout['root']
+    descriptor = bytearray(sector_size)
+    descriptor[0:7] = struct.pack('<B', 2 if joliet else 1) + b'CD001\x01'
+    descriptor[8:40] = _text('LINUX', 32, joliet)
+    descriptor[40:72] = _text(layout['volume_id'], 32, joliet)
+    descriptor[80:88] = _both32(layout['sectors'])
+    if joliet:
+        # UCS-2 level 3
+        descriptor[88:91] = b'%/E'
+    descriptor[120:124] = _both16(1)
+    descriptor[124:128] = _both16(1)
+    descriptor[128:132] = _both16(sector_size)
+    descriptor[132:140] = _both32(layout[prefix + 'path_table_size'])
+    descriptor[140:144] = struct.pack('<I', layout[prefix + 'l_path_table'])
+    descriptor[148:152] = struct.pack('>I', layout[prefix + 'm_path_table'])
+    descriptor[156:190] = _directory_record(b'\x00', root[prefix + 'extent'], root[prefix + 'size'], True,
+                                            layout['date'])
+    descriptor[190:318] = _text('', 128, joliet)
+    descriptor[318:446] = _text('', 128, joliet)
+    descriptor[446:574] = _text('', 128, joliet)
+    descriptor[574:702] = _text(layout['application_id'], 128, joliet)
+    descriptor[702:739] = _text('', 37, joliet)
+    descriptor[739:776] = _text('', 37, joliet)
+    descriptor[776:813] = _text('', 37, joliet)
+    volume_date = _volume_date(layout['time'])
+    descriptor[813:830] = volume_date
+    descriptor[830:847] = volume_date
+    descriptor[847:864] = b'0' * 16 + b'\x00'
+    descriptor[864:881] = b'0' * 16 + b'\x00'
+    descriptor[881] = 1
+    return bytes(descriptor)
+
+
+def build_layout(entries, volume_id='bootstrap', application_id='bootstrap', timestamp=None):
+    """
+    Plans an ISO9660 image with Joliet and Rock Ridge extensions, equivalent to
+    'mkisofs -J -R -V bootstrap -A bootstrap -ldots -l -allow-lowercase -allow-multidot'. Only file sizes are read
+    here, the contents are read when the image is written by iter_image
+    :param entries: list of (path, source) tuples. Paths are relative to the root of the image and use '/' as the
+    separator. The source is None for a directory, bytes for an in memory file, or the path to a file on disk
+    :param volume_id: volume identifier
+    :param application_id: application identifier
+    :param timestamp: time recorded for the volume and every file in seconds since the epoch, defaults to now
+    :return: dict describing the image, the total image size in bytes is in the 'size' key
+    """
+    now = time.time() if timestamp is None else timestamp
+    root = _build_tree(entries)
+    _assign_names(root)
+    layout = {
+        'root': root,
+        'volume_id': volume_id,
+        'application_id': application_id,
+        'time': now,
+        'date': _record_date(now)
+    }
+
+    iso_directories = _path_table_order(root, 'iso_name')
+    joliet_directories = _path_table_order(root, 'joliet_name')
+
+    # directory sizes do not depend on the extents, so they can be computed before allocating sectors
+    for directory in iso_directories:
+        directory['iso_size'] = len(_pack_records(_directory_records(layout, directory, False)))
+        directory['joliet_size'] = len(_pack_records(_directory_records(layout, directory, True)))
+
+    # path table sizes only depend on the names
+    for directory in iso_directories:
+        directory['iso_extent'] = directory['joliet_extent'] = 0
+    layout['iso_path_table_size'] = len(_path_table(iso_directories, 'iso_name', 'iso_extent', False))
+    layout['joliet_path_table_size'] = len(_path_table(joliet_directories, 'joliet_name', 'joliet_extent', False))
+
+    # primary, supplementary and terminator volume descriptors follow the system area
+    extent = _system_area_sectors + 3
+    for prefix in ('iso_', 'joliet_'):
+        path_table_sectors = _sectors(layout[prefix + 'path_table_size'])
+        layout[prefix + 'l_path_table'] = extent
+        layout[prefix + 'm_path_table'] = extent + path_table_sectors
+        extent += 2 * path_table_sectors
+
+    for directory in iso_directories:
+        directory['iso_extent'] = extent
+        extent += _sectors(directory['iso_size'])
+
+    for directory in joliet_directories:
+        directory['joliet_extent'] = extent
+        extent += _sectors(directory['joliet_size'])
+
+    # readers that stream the image expect continuation areas after the directory that refers to them
+    layout['ce_extent'] = extent
+    extent += 1
+
+    # file contents are shared by the primary and Joliet trees
+    files = list()
+    for directory in iso_directories:
+        for child in sorted(directory['children'], key=lambda c: c['iso_name']):
+            if not child['is_dir']:
+                child['extent'] = extent
+                extent += _sectors(child['size'])
+                files.append(child)
+
+    layout['iso_directories'] = iso_directories
+    layout['joliet_directories'] = joliet_directories
+    layout['files'] = files
+    layout['sectors'] = extent
+    layout['size'] = extent * sector_size
+    return layout
+
+
+def iter_image(layout):
+    """
+    Writes the ISO image planned by build_layout piece by piece
+    :param layout: dict returned from build_layout
+    :return: generator of bytes
+    """
+    yield b'\x00' * (_system_area_sectors * sector_size)
+    yield _volume_descriptor(layout, False)
+    yield _volume_descriptor(layout, True)
+    terminator = bytearray(sector_size)
+    terminator[0:7] = b'\xffCD001\x01'
+    yield bytes(terminator)
+
+    for prefix in ('iso_', 'joliet_'):
+        directories = layout[prefix + 'directories']
+        for big_endian in (False, True):
+            table = _path_table(directories, prefix + 'name', prefix + 'extent', big_endian)
+            yield table + b'\x00' * (-len(table) % sector_size)
+
+    for directory in layout['iso_directories']:
+        yield _pack_records(_directory_records(layout, directory, False))
+
+    for directory in layout['joliet_directories']:
+        yield _pack_records(_directory_records(layout, directory, True))
+
+    extension_reference = _extension_reference()
+    yield extension_reference + b'\x00' * (sector_size - len(extension_reference))
+
+    for node in layout['files']:
+        if isinstance(node['source'], bytes):
+            yield node['source']
+        else:
+            written = 0
+            for chunk in file_utils.iter_file(node['source']):
+                written += len(chunk)
+                yield chunk
+
+            if written != node['size']:
+                raise OSError('%s changed size while writing the ISO image' % node['source'])
+
+        yield b'\x00' * (-node['size'] % sector_size)
@@ -1,3 +1,8 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 from passlib.hash import md5_crypt
 from passlib.hash import des_crypt
 from passlib.hash import sha512_crypt
@@ -5,14 +10,104 @@ from passlib.hash import sha512_crypt
 
 defined_filters = ['md5_hash', 'des_hash', 'sha512_hash']
 
+# filters that return a different value for the same input, these use a random salt
+nondeterministic_filters = ['md5_hash', 'des_hash', 'sha512_hash']
+
+_algorithms = {
+    'md5': md5_crypt,
+    'des': des_crypt,
+    'sha512': sha512_crypt
+}
+
+# seconds to re-use the hash of an identical plaintext, 0 disables the memo
+_memo_ttl = 0
+# maximum number of hashes to keep in the memo
+_memo_max_entries = 1024
+# number of worker processes used to compute hashes, 0 computes them in the calling thread
+_process_pool_workers = 0
+
+__memo = dict()
+__lock = threading.Lock()
+__pool = None
+
+
+def configure(memo_ttl=0, process_pool_workers=0):
+    """
+    Configures how the hash filters compute their values. See the 'hash_filters' section of conf/configuration.yaml
+    :param memo_ttl: seconds to re-use the hash of an identical plaintext, 0 always generates a newly salted hash
+    :param process_pool_workers: number of worker processes used to compute hashes so concurrent renders are not
+    serialized behind the crypt rounds, 0 computes hashes in the calling thread
+    :return: None
+    """
+    global _memo_ttl, _process_pool_workers, __pool
+
+    with __lock:
+        _memo_ttl = memo_ttl or 0
+        __memo.clear()
+
+        if process_pool_workers != _process_pool_workers and __pool is not None:
+            __pool.shutdown(wait=False)
+            __pool = None
+
+        _process_pool_workers = process_pool_workers or 0
+
+
+def _get_pool():
+    global __pool
+
+    with __lock:
+        if __pool is None:
+            __pool = ProcessPoolExecutor(max_workers=_process_pool_workers)
+
+        return __pool
+
+
+def _hash(algorithm, txt):
+    return _algorithms[algorithm].hash(txt)
+
+
+def _crypt(algorithm, txt):
+    """
+    Computes the salted hash of the plaintext, re-using a previous hash of the same plaintext if the memo is enabled
+    :param algorithm: key of the _algorithms dict
+    :param txt: plaintext to hash
+    :return: crypt formatted hash string
+    """
+    ttl = _memo_ttl
+    if ttl > 0:
+        # only keep a digest of the plaintext around
+        key = (algorithm, hashlib.sha256(str(txt).encode('utf-8')).hexdigest())
+        now = time.time()
+        with __lock:
+            memoized = __memo.get(key, None)
+            if memoized is not None and memoized[1] > now:
+                return memoized[0]
+
+    if _process_pool_workers > 0:
+        hashed = _get_pool().submit(_hash, algorithm, txt).result()
+    else:
+        hashed = _hash(algorithm, txt)
+
+    if ttl > 0:
+        with __lock:
+            if len(__memo) >= _memo_max_entries:
+                for k in [k for k, v in __memo.items() if v[1] <= now]:
+                    del __memo[k]
+                while len(__memo) >= _memo_max_entries:
+                    del __memo[next(iter(__memo))]
+
+            __memo[key] = (hashed, now + ttl)
+
+    return hashed
+
 
 def md5_hash(txt):
-    return md5_crypt.hash(txt)
+    return _crypt('md5', txt)
 
 
 def des_hash(txt):
-    return des_crypt.hash(txt)
+    return _crypt('des', txt)
 
 
 def sha512_hash(txt):
-    return sha512_crypt.hash(txt)
\ No newline at end of file
+    return _crypt('sha512', txt)
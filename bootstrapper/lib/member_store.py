@@ -0,0 +1,200 @@
+import json
+import os
+import struct
+import threading
+import uuid
+import zlib
+
+from . import content_catalog
+from . import file_utils
+
+# gzip member header with no file name and no mtime, see RFC 1952
+gzip_header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03'
+
+# largest stored block of a deflate stream, see RFC 1951
+_stored_block_size = 65535
+
+# one lock per member being compressed, so concurrent builds do not compress the same file twice
+__building = dict()
+__lock = threading.Lock()
+
+
+def _member_paths(store_dir, digest, level):
+    base = os.path.join(store_dir, '%s-%d' % (digest, level))
+    return base + '.deflate', base + '.json'
+
+
+def _load(deflate_path, meta_path):
+    try:
+        with open(meta_path, 'r') as f:
+            member = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # level 0 members only keep the crc32 and size, their data is read from the source file
+    if member['level'] > 0:
+        if not os.path.exists(deflate_path):
+            return None
+        member['deflate_path'] = deflate_path
+
+    # mark the member as recently used for prune
+    os.utime(meta_path)
+    return member
+
+
+def _build(source_path, deflate_path, meta_path, level):
+    """
+    Compresses the source file into a raw deflate stream next to a small json file holding the crc32 and sizes.
+    Both are written to temporary names first, so readers in other processes never see partial members. At level 0
+    only the json file is written, the data stays in the source file
+    """
+    crc = 0
+    size = 0
+    suffix = '.%s.tmp' % uuid.uuid4()
+    if level == 0:
+        for chunk in file_utils.iter_file(source_path):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+        compressed_size = size
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        with open(deflate_path + suffix, 'wb') as f:
+            for chunk in file_utils.iter_file(source_path):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                f.write(compressor.compress(chunk))
+            f.write(compressor.flush())
+            compressed_size = f.tell()
+
+    member = {'crc32': crc, 'size': size, 'compressed_size': compressed_size, 'level': level}
+    with open(meta_path + suffix, 'w') as f:
+        json.dump(member, f)
+
+    if level > 0:
+        os.replace(deflate_path + suffix, deflate_path)
+        member['deflate_path'] = deflate_path
+    os.replace(meta_path + suffix, meta_path)
+    return member
+
+
+def get_member(source_path, store_dir, level=6, max_bytes=0):
+    """
+    Returns the precompressed copy of a file, compressing it into the store the first time it is requested. Members
+    are keyed by the sha256 of the file contents, so renamed or re-downloaded files are not compressed again. Level 0
+    suits files that are already compressed, only their crc32 and size are stored and their data is read from
+    source_path
+    :param source_path: path of the file
+    :param store_dir: directory holding the precompressed members
+    :param level: zlib compression level
+    :param max_bytes: prune the least recently used members after adding a new one to keep the store below this size,
+    0 never prunes
+    :return: dict with 'source_path', 'crc32', 'size', 'compressed_size' and 'level' keys, and above level 0 a
+    'deflate_path' to the raw deflate stream
+    """
+    digest = content_catalog.file_digest(source_path)
+    deflate_path, meta_path = _member_paths(store_dir, digest, level)
+
+    member = _load(deflate_path, meta_path)
+    if member is not None:
+        member['source_path'] = source_path
+        return member
+
+    with __lock:
+        building = __building.setdefault(deflate_path, threading.Lock())
+
+    with building:
+        member = _load(deflate_path, meta_path)
+        if member is None:
+            if not os.path.exists(store_dir):
+                os.makedirs(store_dir, exist_ok=True)
+            member = _build(source_path, deflate_path, meta_path, level)
+            if max_bytes > 0:
+                prune(store_dir, max_bytes, keep=(meta_path,))
+
+    with __lock:
+        __building.pop(deflate_path, None)
+
+    member['source_path'] = source_path
+    return member
+
+
+def iter_gzip_member(member):
+    """
+    Wraps a precompressed member into a complete gzip member, which can be concatenated with other gzip members.
+    The data of level 0 members is copied from their source file in stored deflate blocks
+    :param member: dict returned from get_member
+    :return: generator of bytes
+    """
+    yield gzip_header
+    if 'deflate_path' in member:
+        for chunk in file_utils.iter_file(member['deflate_path']):
+            yield chunk
+    else:
+        for chunk in _iter_stored_blocks(member['source_path'], member['size']):
+            yield chunk
+
+    yield struct.pack('<II', member['crc32'] & 0xffffffff, member['size'] & 0xffffffff)
+
+
+def _iter_stored_blocks(source_path, size):
+    """
+    Frames a file as a raw deflate stream of stored blocks, without compressing it
+    """
+    if size == 0:
+        yield b'\x01\x00\x00\xff\xff'
+        return
+
+    offset = 0
+    for chunk in file_utils.iter_file(source_path, length=size):
+        for start in range(0, len(chunk), _stored_block_size):
+            block = chunk[start:start + _stored_block_size]
+            offset += len(block)
+            yield struct.pack('<B2H', 1 if offset >= size else 0, len(block), len(block) ^ 0xffff)
+            yield bytes(block)
+
+
+def prune(store_dir, max_bytes, keep=()):
+    """
+    Removes the least recently used members until the store is smaller than max_bytes. Every member counts towards
+    the size of the store, members in use are never removed
+    :param store_dir: directory holding the precompressed members
+    :param max_bytes: maximum size in bytes of the store
+    :param keep: paths of member json files that are in use and must not be removed
+    :return: number of members removed
+    """
+    if not os.path.exists(store_dir):
+        return 0
+
+    with __lock:
+        building = set(__building)
+
+    members = list()
+    total = 0
+    with os.scandir(store_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.json'):
+                continue
+
+            deflate_path = entry.path[:-len('.json')] + '.deflate'
+            try:
+                size = os.path.getsize(deflate_path)
+            except OSError:
+                size = 0
+            total += size
+            if entry.path not in keep and deflate_path not in building:
+                members.append((entry.stat().st_mtime, entry.path, deflate_path, size))
+
+    removed = 0
+    for _, meta_path, deflate_path, size in sorted(members):
+        if total <= max_bytes:
+            break
+
+        for path in (meta_path, deflate_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+        removed += 1
+
+    return removed
@@ -0,0 +1,408 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+from jinja2 import TemplateError
+from jinja2 import meta
+from jinja2 import nodes
+
+from . import jinja2_filters
+
+# maximum number of compiled templates to keep around per process
+_max_templates = 64
+
+# compiled template bytecode is stored here so new workers do not need to compile templates again
+_bytecode_cache_dir = '/var/tmp/bootstrapper/jinja_cache'
+
+# maximum size in bytes of all memoized rendered templates per process
+_max_memo_bytes = 32 * 1024 * 1024
+
+# templates using any of these filters, directly or through an include, import or extends, render differently every
+# time and are excluded from the render memo and the artifact cache
+_nondeterministic_filters = frozenset(jinja2_filters.nondeterministic_filters)
+
+# render options, see the 'render_memo' option in conf/configuration.yaml
+__options = {
+    'render_memo': False
+}
+
+# compiled templates keyed by (template_name, content_hash, jinja environment id)
+__templates = OrderedDict()
+__lock = threading.Lock()
+__stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+# rendered output and cache key keyed by hash of (template, parameters, filters)
+__memo = OrderedDict()
+__memo_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+# results of _inspect keyed by (content_hash, jinja environment id), holding the uptodate checks of the templates they
+# reference
+__inspected = OrderedDict()
+
+__bytecode_cache = None
+
+
+def configure(**options):
+    """
+    Sets the render options. See the 'render_memo' option in conf/configuration.yaml
+    :param options: dict of render options
+    :return: None
+    """
+    __options.update(options)
+
+
+def memo_enabled():
+    """
+    Checks if renders of deterministic templates are memoized, see the 'render_memo' option
+    :return: boolean
+    """
+    return bool(__options['render_memo'])
+
+
+def content_hash(template_string):
+    """
+    Returns a stable hash of the template text, used to detect changed templates without a db lookup
+    :param template_string: string of the template text
+    :return: hex digest of the template text
+    """
+    return hashlib.sha256(template_string.encode('utf-8')).hexdigest()
+
+
+def get_bytecode_cache():
+    """
+    Returns the on disk jinja2 bytecode cache shared by all workers
+    :return: jinja2.FileSystemBytecodeCache
+    """
+    global __bytecode_cache
+
+    if __bytecode_cache is not None:
+        return __bytecode_cache
+
+    if not os.path.exists(_bytecode_cache_dir):
+        os.makedirs(_bytecode_cache_dir)
+
+    __bytecode_cache = FileSystemBytecodeCache(directory=_bytecode_cache_dir)
+    return __bytecode_cache
+
+
+def _load_template(env, template_name, template_string):
+    """
+    Loads the compiled template from the bytecode cache, compiling and storing it only if the cached bytecode is
+    missing or was compiled from different template text
+    :param env: jinja2 environment to compile against
+    :param template_name: name of the template in the db
+    :param template_string: string of the template text
+    :return: jinja2.Template
+    """
+    bytecode_cache = get_bytecode_cache()
+    bucket = bytecode_cache.get_bucket(env, template_name, None, template_string)
+    code = bucket.code
+    if code is None:
+        # compile without a name, keeping the same autoescape behaviour as flask.render_template_string
+        code = env.compile(template_string)
+        bucket.code = code
+        bytecode_cache.set_bucket(bucket)
+
+    return env.template_class.from_code(env, code, env.make_globals(None), None)
+
+
+def precompile(template_name, template_string, env=None):
+    """
+    Compiles the template into the bytecode cache ahead of its first use. Errors are not fatal here, the template
+    will simply be compiled again when rendered
+    :param template_name: name of the template in the db
+    :param template_string: string of the template text
+    :param env: jinja2 environment to compile against, defaults to the jinja_env of the current flask app
+    :return: boolean
+    """
+    try:
+        if env is None:
+            env = current_app.jinja_env
+
+        _load_template(env, template_name, template_string)
+        return True
+    except (TemplateError, RuntimeError, OSError) as e:
+        print('Could not precompile template %s' % template_name)
+        print(e)
+        return False
+
+
+def precompile_directory_templates(env, prefixes):
+    """
+    Compiles all templates found by the environments loader into the bytecode cache. The environment must be
+    configured to use the bytecode cache from get_bytecode_cache
+    :param env: jinja2 environment with a loader
+    :param prefixes: tuple of template path prefixes to compile, for example ('panos/', 'openstack/')
+    :return: None
+    """
+    for template_name in env.list_templates():
+        if template_name.startswith(prefixes):
+            try:
+                env.get_template(template_name)
+            except (TemplateError, OSError) as e:
+                print('Could not precompile template %s' % template_name)
+                print(e)
+
+
+def get_compiled_template(template_name, template_string, env=None):
+    """
+    Returns a compiled jinja2 Template object for the given template text. Compiled templates are kept in a process
+    wide LRU cache so the template is only lexed, parsed and compiled once. Templates missing from the LRU are loaded
+    from the on disk bytecode cache before falling back to compiling them
+    :param template_name: name of the template in the db
+    :param template_string: string of the template text
+    :param env: jinja2 environment to compile against, defaults to the jinja_env of the current flask app
+    :return: jinja2.Template
+    """
+    if env is None:
+        env = current_app.jinja_env
+
+    key = (template_name, content_hash(template_string), id(env))
+
+    with __lock:
+        template = __templates.get(key, None)
+        if template is not None:
+            __templates.move_to_end(key)
+            __stats['hits'] += 1
+            return template
+
+        __stats['misses'] += 1
+
+    template = _load_template(env, template_name, template_string)
+
+    with __lock:
+        __templates[key] = template
+        __templates.move_to_end(key)
+        while len(__templates) > _max_templates:
+            __templates.popitem(last=False)
+            __stats['evictions'] += 1
+
+    return template
+
+
+def render(template_name, template_string, **context):
+    """
+    Renders a template string using the compiled template cache. This is a drop in replacement for
+    flask.render_template_string
+    :param template_name: name of the template in the db
+    :param template_string: string of the template text
+    :param context: variables to interpolate into the template
+    :return: rendered template string
+    """
+    template = get_compiled_template(template_name, template_string)
+    return render_compiled(template, **context)
+
+
+def generate(template_name, template_string, **context):
+    """
+    Renders a template string piece by piece using the compiled template cache. The context is captured when this
+    is called, later changes to the passed variables are not reflected in the output
+    :param template_name: name of the template in the db
+    :param template_string: string of the template text
+    :param context: variables to interpolate into the template
+    :return: generator of rendered strings
+    """
+    template = get_compiled_template(template_name, template_string)
+    current_app.update_template_context(context)
+    return template.generate(context)
+
+
+def render_compiled(template, **context):
+    """
+    Renders a template previously returned from get_compiled_template
+    :param template: jinja2.Template
+    :param context: variables to interpolate into the template
+    :return: rendered template string
+    """
+    current_app.update_template_context(context)
+    return template.render(context)
+
+
+def _walk(env, ast, seen, sources, uptodate):
+    """
+    Checks a parsed template and every template it includes, imports or extends for non-deterministic filters
+    :return: boolean, False as soon as a filter is found or a referenced template cannot be resolved
+    """
+    for node in ast.find_all((nodes.Filter, nodes.Name, nodes.Const)):
+        # filters are also reachable by name, for example through map('md5_hash') or a filter block
+        value = node.value if isinstance(node, nodes.Const) else node.name
+        if isinstance(value, str) and value in _nondeterministic_filters:
+            return False
+
+    for name in meta.find_referenced_templates(ast):
+        if name is None or env.loader is None:
+            # the template name is only known at render time
+            return False
+        if name in seen:
+            continue
+        seen.add(name)
+
+        source, _, check = env.loader.get_source(env, name)
+        sources.append((name, content_hash(source)))
+        uptodate.append(check)
+        if not _walk(env, env.parse(source), seen, sources, uptodate):
+            return False
+
+    return True
+
+
+def _inspect(template_string, env=None):
+    """
+    Inspects a template and all the templates it references. Results are cached until one of the referenced templates
+    changes
+    :param template_string: string of the template text
+    :param env: jinja2 environment resolving the references, defaults to the jinja_env of the current flask app
+    :return: tuple of (deterministic, fingerprint), the fingerprint is a hash over the text of the template and of
+    every template it references
+    """
+    if env is None:
+        env = current_app.jinja_env
+
+    key = (content_hash(template_string), id(env))
+    with __lock:
+        inspected = __inspected.get(key, None)
+
+    if inspected is not None and all(check is None or check() for check in inspected[2]):
+        return inspected[0], inspected[1]
+
+    sources = [('', key[0])]
+    uptodate = list()
+    try:
+        deterministic = _walk(env, env.parse(template_string), set(), sources, uptodate)
+    except TemplateError:
+        # syntax errors and references to missing templates
+        deterministic = False
+
+    fingerprint = hashlib.sha256(json.dumps(sources).encode('utf-8')).hexdigest()
+    with __lock:
+        __inspected[key] = (deterministic, fingerprint, uptodate)
+        __inspected.move_to_end(key)
+        while len(__inspected) > _max_templates:
+            __inspected.popitem(last=False)
+
+    return deterministic, fingerprint
+
+
+def is_deterministic(template_string, env=None):
+    """
+    Checks if the template always renders the same output for the same parameters. Templates that use salted hash
+    filters, directly or through the templates they include, import or extend, do not. Templates referencing a
+    template that cannot be resolved, or whose name is only known at render time, are never considered deterministic
+    :param template_string: string of the template text
+    :param env: jinja2 environment resolving the references, defaults to the jinja_env of the current flask app
+    :return: boolean
+    """
+    return _inspect(template_string, env)[0]
+
+
+def fingerprint(template_string, env=None):
+    """
+    Returns a hash of the template text and of all the templates it includes, imports or extends, which changes
+    whenever any of them does
+    :param template_string: string of the template text
+    :param env: jinja2 environment resolving the references, defaults to the jinja_env of the current flask app
+    :return: hex digest
+    """
+    return _inspect(template_string, env)[1]
+
+
+def memo_key(template_string, context, env=None):
+    """
+    Builds a content addressed key for a render of the template with the given parameters
+    :param template_string: string of the template text
+    :param context: dict of variables to interpolate into the template
+    :param env: jinja2 environment resolving the references, defaults to the jinja_env of the current flask app
+    :return: hex digest
+    """
+    h = hashlib.sha256()
+    h.update(fingerprint(template_string, env).encode('utf-8'))
+    h.update(json.dumps(context, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8'))
+    h.update(','.join(sorted(jinja2_filters.defined_filters)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_memo(key):
+    """
+    Returns a previously memoized render
+    :param key: key returned from memo_key
+    :return: tuple of (rendered contents, cache key) or None if not found
+    """
+    with __lock:
+        memoized = __memo.get(key, None)
+        if memoized is None:
+            __memo_stats['misses'] += 1
+            return None
+
+        __memo.move_to_end(key)
+        __memo_stats['hits'] += 1
+        return memoized
+
+
+def set_memo(key, contents, cache_key):
+    """
+    Memoizes a rendered template and the cache key it was stored under. Least recently used renders are evicted once
+    the memo grows past _max_memo_bytes
+    :param key: key returned from memo_key
+    :param contents: rendered template string
+    :param cache_key: key returned from cache_utils.set
+    :return: None
+    """
+    size = len(contents)
+    if size > _max_memo_bytes:
+        return
+
+    with __lock:
+        previous = __memo.pop(key, None)
+        if previous is not None:
+            __memo_stats['bytes'] -= len(previous[0])
+
+        __memo[key] = (contents, cache_key)
+        __memo_stats['bytes'] += size
+        while __memo_stats['bytes'] > _max_memo_bytes:
+            _, evicted = __memo.popitem(last=False)
+            __memo_stats['bytes'] -= len(evicted[0])
+            __memo_stats['evictions'] += 1
+
+
+def invalidate(template_name):
+    """
+    Removes all compiled versions of the named template from the cache. Should be called whenever a template is
+    imported, edited, or deleted
+    :param template_name: name of the template in the db
+    :return: None
+    """
+    with __lock:
+        for key in [k for k in __templates if k[0] == template_name]:
+            del __templates[key]
+
+
+def clear():
+    """
+    Removes all compiled templates and memoized renders from the cache
+    :return: None
+    """
+    with __lock:
+        __templates.clear()
+        __inspected.clear()
+        __memo.clear()
+        __memo_stats['bytes'] = 0
+
+
+def stats():
+    """
+    Returns the hit / miss counters of the compiled template cache and the render memo
+    :return: dict containing 'hits', 'misses', 'evictions', 'size', 'max_size' and 'memo' keys
+    """
+    with __lock:
+        s = dict(__stats)
+        s['size'] = len(__templates)
+        s['max_size'] = _max_templates
+        s['memo'] = dict(__memo_stats)
+        s['memo']['size'] = len(__memo)
+        s['memo']['max_bytes'] = _max_memo_bytes
+
+    return s
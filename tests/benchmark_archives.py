@@ -0,0 +1,214 @@
+"""
+Benchmarks for the archive builders. These are not collected by pytest, run them directly:
+
+    python -m tests.benchmark_archives iso --iterations 20 --content-size 50000000
+
+The mkisofs comparison is skipped if no mkisofs binary is found on the path. The compression benchmark reports the
+time, throughput and size of zip and tgz archives for each compression level, with and without storing the already
+compressed software image, and single threaded versus parallel gzip. The s3 benchmark uploads the package to the
+S3 compatible server given with --endpoint-url, or to a local moto server if moto is installed, once with serial
+single part uploads and once with the configured workers and multipart settings. The azure benchmark does the same
+against the file service given with --azure-endpoint and --azure-account, such as a local storage emulator, and the
+gcp benchmark against the server given with --gcs-endpoint, such as a local fake-gcs-server
+"""
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import timeit
+
+from bootstrapper.lib import archive_utils
+from bootstrapper.lib import cloud_utils
+
+
+def _package(content_dir, content_size):
+    """
+    Creates a content update of the requested size and returns a files dict like the one from build_base_configs
+    """
+    archive_utils._content_update_dir = content_dir
+    os.makedirs(os.path.join(content_dir, 'antivirus'), exist_ok=True)
+    with open(os.path.join(content_dir, 'antivirus', 'panupv2-all-antivirus-3000-3500'), 'wb') as f:
+        # content updates compress about as well as text
+        line = b'signature %d threat-id %d action reset-both\n'
+        for i in range(0, content_size, len(line) * 1000):
+            f.write(b''.join(line % (i, j) for j in range(1000)))
+
+    # software images are gzip compressed already
+    software_image = os.path.join(content_dir, 'PanOS_vm-9.0.0')
+    with open(software_image, 'wb') as f:
+        f.write(b'\x1f\x8b\x08\x00' + os.urandom(content_size))
+
+    return {
+        'init-cfg.txt': {'archive_path': 'config', 'contents': 'type=dhcp-client\nhostname=benchmark\n'},
+        'bootstrap.xml': {'archive_path': 'config', 'contents': '<config version="8.1.0"></config>\n' * 400},
+        'authcodes': {'archive_path': 'license', 'contents': 'ABC123'},
+        'PanOS_vm-9.0.0': {'archive_path': 'software', 'source_path': software_image},
+    }
+
+
+# storage account name and key used by the azure benchmark
+__azure_account = None
+
+
+def _report(name, seconds, iterations):
+    print('%-24s %8.2f ms per archive' % (name, seconds * 1000 / iterations))
+
+
+def benchmark_iso(files, iterations):
+    _report('iso builtin', timeit.timeit(lambda: archive_utils.create_iso_buffer(files, 'benchmark').close(),
+                                         number=iterations), iterations)
+
+    if shutil.which('mkisofs') is None:
+        print('mkisofs not found, skipping the mkisofs comparison')
+        return
+
+    _report('iso mkisofs', timeit.timeit(lambda: archive_utils._create_iso_mkisofs(files, 'benchmark'),
+                                         number=iterations), iterations)
+
+
+def _archive_size(builder, files, compression):
+    archive = builder(files, 'benchmark', compression)
+    archive.seek(0, os.SEEK_END)
+    size = archive.tell()
+    archive.close()
+    return size
+
+
+def benchmark_compression(files, iterations):
+    # compress everything in the request, the member store would hide the cost of the large files
+    archive_utils.configure(precompressed_members=False)
+    input_size = sum(os.path.getsize(f['source_path']) for f in files.values() if 'source_path' in f)
+    input_size += os.path.getsize(archive_utils.check_latest_update('antivirus'))
+
+    builders = [('zip', archive_utils.create_archive_buffer, [0]), ('tgz', archive_utils.create_tgz_buffer,
+                                                                    [1, os.cpu_count() or 1])]
+    print('%-36s %10s %10s %12s' % ('archive', 'ms', 'MB/s', 'bytes'))
+    for (name, builder, thread_counts), level, store in itertools.product(builders, [0, 1, 6, 9], [True, False]):
+        for threads in thread_counts:
+            compression = {'level': level, 'store_compressed': store, 'threads': threads, 'parallel_min_size': 0}
+            seconds = timeit.timeit(lambda: builder(files, 'benchmark', compression).close(),
+                                    number=iterations) / iterations
+            label = '%s level=%d store=%s threads=%d' % (name, level, store, threads)
+            print('%-36s %10.2f %10.1f %12d' % (label, seconds * 1000, input_size / seconds / 1024 / 1024,
+                                                _archive_size(builder, files, compression)))
+
+
+def _moto_server():
+    """
+    Starts a local moto S3 server, returns None if moto is not installed
+    """
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        return None
+
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, 'http://%s:%d' % (host, port)
+
+
+def _benchmark_uploads(provider, create, files, iterations, serial):
+    """
+    Times uploads of the package with one file at a time and single connection transfers, then with the configured
+    number of workers and connections
+    """
+    input_size = sum(os.path.getsize(f['source_path']) for f in files.values() if 'source_path' in f)
+    input_size += os.path.getsize(archive_utils.check_latest_update('antivirus'))
+    configured = cloud_utils.get_options(provider)
+    try:
+        print('%-36s %10s %10s' % ('upload', 'ms', 'MB/s'))
+        for label, options in (('%s serial' % provider, dict(configured, **serial)), ('%s parallel' % provider,
+                                                                                     configured)):
+            cloud_utils.configure(**{provider: options})
+            seconds = timeit.timeit(create, number=iterations) / iterations
+            print('%-36s %10.2f %10.1f' % (label, seconds * 1000, input_size / seconds / 1024 / 1024))
+    finally:
+        cloud_utils.configure(**{provider: configured})
+
+
+def benchmark_s3(files, iterations):
+    server = None
+    if cloud_utils.get_options('s3')['endpoint_url'] is None:
+        started = _moto_server()
+        if started is None:
+            print('no --endpoint-url given and moto is not installed, skipping the s3 benchmark')
+            return
+        server, endpoint_url = started
+        cloud_utils.configure(s3={'endpoint_url': endpoint_url})
+
+    try:
+        _benchmark_uploads('s3', lambda: archive_utils.create_s3_bucket(files, 'benchmark', 'us-east-1', 'testing',
+                                                                        'testing'),
+                           files, iterations, {'max_workers': 1, 'max_concurrency': 1, 'multipart_threshold': 2 ** 40})
+    finally:
+        if server is not None:
+            cloud_utils.configure(s3={'endpoint_url': None})
+            server.stop()
+
+
+def benchmark_azure(files, iterations):
+    if not cloud_utils.get_options('azure')['file_endpoint'] or __azure_account is None:
+        print('no --azure-endpoint and --azure-account given, skipping the azure benchmark')
+        return
+
+    _benchmark_uploads('azure', lambda: archive_utils.create_azure_fileshare(files, 'benchmark', *__azure_account),
+                       files, iterations, {'max_workers': 1, 'max_connections': 1})
+
+
+def benchmark_gcp(files, iterations):
+    if not cloud_utils.get_options('gcp')['api_endpoint']:
+        print('no --gcs-endpoint given, skipping the gcp benchmark')
+        return
+
+    _benchmark_uploads('gcp', lambda: archive_utils.create_gcp_bucket(files, 'benchmark', 'benchmark', 'benchmark'),
+                       files, iterations, {'max_workers': 1, 'resumable_threshold': 2 ** 40})
+
+
+benchmarks = {
+    'compression': benchmark_compression,
+    'iso': benchmark_iso,
+    's3': benchmark_s3,
+    'azure': benchmark_azure,
+    'gcp': benchmark_gcp,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the archive builders')
+    parser.add_argument('benchmark', choices=sorted(benchmarks) + ['all'])
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--content-size', type=int, default=10 * 1024 * 1024,
+                        help='size in bytes of the content update added to each archive')
+    parser.add_argument('--endpoint-url', help='S3 compatible server used by the s3 benchmark')
+    parser.add_argument('--azure-endpoint', help='file service endpoint used by the azure benchmark, such as '
+                                                 'http://127.0.0.1:10004/<account name> for a local emulator')
+    parser.add_argument('--azure-account', help='storage account name and key used by the azure benchmark, as '
+                                                '<name>:<key>')
+    parser.add_argument('--gcs-endpoint', help='GCS compatible server used by the gcp benchmark, such as '
+                                               'http://127.0.0.1:4443 for a local fake-gcs-server')
+    args = parser.parse_args()
+    if args.gcs_endpoint:
+        cloud_utils.configure(gcp={'api_endpoint': args.gcs_endpoint})
+    if args.endpoint_url:
+        cloud_utils.configure(s3={'endpoint_url': args.endpoint_url})
+    if args.azure_endpoint:
+        cloud_utils.configure(azure={'file_endpoint': args.azure_endpoint})
+    if args.azure_account:
+        global __azure_account
+        __azure_account = args.azure_account.split(':', 1)
+
+    archive_dir = tempfile.mkdtemp()
+    archive_utils._archive_dir = archive_dir
+    try:
+        files = _package(os.path.join(archive_dir, 'content_updates'), args.content_size)
+        for name in sorted(benchmarks):
+            if args.benchmark in (name, 'all'):
+                benchmarks[name](files, args.iterations)
+    finally:
+        shutil.rmtree(archive_dir)
+
+
+if __name__ == '__main__':
+    main()
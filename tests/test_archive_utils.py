@@ -0,0 +1,254 @@
+import calendar
+import io
+import os
+import random
+import struct
+import tarfile
+import time
+import zipfile
+import zlib
+
+import pytest
+
+from bootstrapper.lib import archive_utils
+
+
+def _files(tmpdir):
+    image = tmpdir.join('PanOS_vm-9.0.0')
+    if not image.check():
+        image.write_binary(os.urandom(200000))
+    return {
+        'init-cfg.txt': {'archive_path': 'config', 'contents': 'type=dhcp-client\nhostname=panos-stream\n'},
+        'bootstrap.xml': {'archive_path': 'config', 'contents': iter(['<config>', '</config>'])},
+        'PanOS_vm-9.0.0': {'archive_path': 'software', 'source_path': str(image)},
+    }
+
+
+def test_iter_zip(tmpdir, monkeypatch):
+    """
+    Tests streamed zip archives use data descriptors and can be read back
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Iter Zip".center(79, '-'))
+
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(tmpdir.join('content_updates')))
+    monkeypatch.setattr(archive_utils, '_stream_chunk_size', 1024)
+    monkeypatch.setitem(archive_utils.__options, 'precompressed_members', False)
+
+    files = _files(tmpdir)
+    chunks = list(archive_utils.iter_zip(files))
+    assert len(chunks) > 1
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zf:
+        assert zf.testzip() is None
+        assert zf.getinfo('config/init-cfg.txt').flag_bits & 0x08
+        assert zf.read('config/bootstrap.xml') == b'<config></config>'
+        assert zf.read('software/PanOS_vm-9.0.0') == tmpdir.join('PanOS_vm-9.0.0').read_binary()
+        assert zf.getinfo('license/').is_dir()
+
+
+def test_iter_zip64(tmpdir, monkeypatch):
+    """
+    Tests streamed zip archives switch to zip64 for large members
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Iter Zip64".center(79, '-'))
+
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(tmpdir.join('content_updates')))
+    # pretend anything over 64KiB needs zip64 rather than writing 4GiB
+    monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 64 * 1024)
+
+    for precompressed in (True, False):
+        monkeypatch.setitem(archive_utils.__options, 'precompressed_members', precompressed)
+        monkeypatch.setitem(archive_utils.__options, 'precompressed_min_size', 0)
+        monkeypatch.setitem(archive_utils.__options, 'precompressed_dir', str(tmpdir.join('precompressed')))
+        data = b''.join(archive_utils.iter_zip(_files(tmpdir), {'level': 0 if precompressed else 6,
+                                                                'store_compressed': False}))
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert zf.getinfo('software/PanOS_vm-9.0.0').file_size == 200000
+            assert zf.read('software/PanOS_vm-9.0.0') == tmpdir.join('PanOS_vm-9.0.0').read_binary()
+
+
+def test_stream_archive(tmpdir, monkeypatch):
+    """
+    Tests every archive type can be streamed and the size of ISO images is known up front
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Stream Archive".center(79, '-'))
+
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(tmpdir.join('content_updates')))
+
+    chunks, size = archive_utils.stream_archive(_files(tmpdir), 'iso')
+    assert len(b''.join(chunks)) == size
+
+    chunks, size = archive_utils.stream_archive(_files(tmpdir), 'tgz')
+    assert size is None
+    with tarfile.open(fileobj=io.BytesIO(b''.join(chunks)), mode='r:gz') as tar:
+        assert tar.extractfile('./config/bootstrap.xml').read() == b'<config></config>'
+
+
+def test_deterministic_archives(tmpdir, monkeypatch):
+    """
+    Tests the same files always build byte for byte identical archives
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Deterministic Archives".center(79, '-'))
+
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(tmpdir.join('content_updates')))
+    monkeypatch.setitem(archive_utils.__options, 'artifact_cache', True)
+
+    for archive_type in ('zip', 'tgz', 'encoded_tgz', 'iso'):
+        builds = list()
+        for reverse in (False, True):
+            files = _files(tmpdir)
+            # the order of the files dict does not matter either
+            files = dict((k, files[k]) for k in sorted(files, reverse=reverse))
+            chunks, size = archive_utils.stream_archive(files, archive_type)
+            builds.append(b''.join(chunks))
+        assert builds[0] == builds[1]
+
+    with zipfile.ZipFile(io.BytesIO(b''.join(archive_utils.iter_zip(_files(tmpdir))))) as zf:
+        assert zf.getinfo('config/init-cfg.txt').date_time == (1980, 1, 1, 0, 0, 0)
+
+
+def test_archive_build_time(tmpdir, monkeypatch):
+    """
+    Tests archives built without the artifact cache carry the time they were built
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Archive Build Time".center(79, '-'))
+
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(tmpdir.join('content_updates')))
+    monkeypatch.setitem(archive_utils.__options, 'artifact_cache', False)
+
+    now = time.time()
+    with zipfile.ZipFile(io.BytesIO(b''.join(archive_utils.iter_zip(_files(tmpdir))))) as zf:
+        for info in zf.infolist():
+            built = calendar.timegm(info.date_time + (0, 0, 0))
+            # zip times have a two second resolution
+            assert now - 5 <= built <= time.time() + 5
+
+    with tarfile.open(fileobj=io.BytesIO(b''.join(archive_utils.iter_tgz(_files(tmpdir)))), mode='r:gz') as tf:
+        for member in tf.getmembers():
+            assert now - 5 <= member.mtime <= time.time() + 5
+
+
+def test_zip_compression_level(tmpdir, monkeypatch):
+    """
+    Tests the configured compression level is used for every zip member
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Zip Compression Level".center(79, '-'))
+
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(tmpdir.join('content_updates')))
+    monkeypatch.setitem(archive_utils.__options, 'precompressed_members', False)
+
+    words = ['deviceconfig', 'hostname', 'dns-server', 'panorama-server', 'op-command-modes', 'vm-auth-key']
+    generator = random.Random(0)
+    text = ' '.join(generator.choice(words) + str(generator.randint(0, 99)) for _ in range(50000))
+    image = tmpdir.join('PanOS_vm-9.0.0')
+    image.write(text)
+    files = {
+        'init-cfg.txt': {'archive_path': 'config', 'contents': text},
+        'PanOS_vm-9.0.0': {'archive_path': 'software', 'source_path': str(image)},
+    }
+
+    sizes = dict()
+    for level in (0, 1, 9):
+        data = b''.join(archive_utils.iter_zip(files, archive_utils.compression_options('zip', {'level': level})))
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert zf.testzip() is None
+            for name in ('config/init-cfg.txt', 'software/PanOS_vm-9.0.0'):
+                info = zf.getinfo(name)
+                assert info.compress_type == (zipfile.ZIP_STORED if level == 0 else zipfile.ZIP_DEFLATED)
+                assert zf.read(info) == text.encode('utf-8')
+                sizes[(level, name)] = info.compress_size
+        sizes[level] = len(data)
+
+    assert sizes[0] > sizes[1] > sizes[9]
+    for name in ('config/init-cfg.txt', 'software/PanOS_vm-9.0.0'):
+        assert sizes[(0, name)] > sizes[(1, name)] > sizes[(9, name)]
+
+
+def test_zip_writer_zip64_threshold(monkeypatch):
+    """
+    Tests members switch to zip64 just past the limit, in their local header, the central directory and the end
+    records, and members without a size hint that grow past it are refused
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Zip Writer Zip64 Threshold".center(79, '-'))
+
+    monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 1000)
+    date_time = (1980, 1, 1, 0, 0, 0)
+    at_limit = b'a' * 1000
+    over_limit = b'b' * 1001
+
+    output = io.BytesIO()
+    writer = archive_utils._ZipWriter(output)
+    list(writer.write_raw('at_limit', date_time, 0o644 << 16, zipfile.ZIP_STORED, zlib.crc32(at_limit), 1000, 1000,
+                          [at_limit]))
+    list(writer.write_raw('over_limit', date_time, 0o644 << 16, zipfile.ZIP_STORED, zlib.crc32(over_limit), 1001,
+                          1001, [over_limit]))
+    list(writer.write_stream('hinted', date_time, 0o644 << 16, zipfile.ZIP_DEFLATED, 6, [over_limit], 1001))
+    writer.close()
+    data = output.getvalue()
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        for name, contents, zip64 in (('at_limit', at_limit, False), ('over_limit', over_limit, True),
+                                      ('hinted', over_limit, True)):
+            info = zf.getinfo(name)
+            assert zf.read(info) == contents
+            version, flags, method, _, _, _, compressed_size, size, name_length, extra_length = \
+                struct.unpack('<5H3L2H', data[info.header_offset + 4:info.header_offset + 30])
+            assert version == (45 if zip64 else 20)
+            assert (size == 0xFFFFFFFF) is zip64
+            assert (extra_length == 20) is zip64
+        assert zf.getinfo('over_limit').extract_version == 45
+        # the central directory starts past the limit too
+        assert b'PK\x06\x06' in data and b'PK\x06\x07' in data
+
+    writer = archive_utils._ZipWriter(io.BytesIO())
+    with pytest.raises(ValueError):
+        list(writer.write_stream('unhinted', date_time, 0o644 << 16, zipfile.ZIP_STORED, 0, [over_limit]))
+
+
+def test_zip_non_ascii_names(tmpdir, monkeypatch):
+    """
+    Tests member names that are not ASCII are stored as UTF-8 and flagged so, ASCII names are left unflagged
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Zip Non ASCII Names".center(79, '-'))
+
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(tmpdir.join('content_updates')))
+    monkeypatch.setitem(archive_utils.__options, 'precompressed_members', False)
+    image = tmpdir.join('image')
+    image.write_binary(b'software image')
+    files = {
+        'init-cfg.txt': {'archive_path': 'config', 'contents': 'hostname=panos\n'},
+        'résumé.txt': {'archive_path': 'config', 'contents': 'café\n'},
+        '日本.bin': {'archive_path': 'software', 'source_path': str(image)},
+    }
+
+    with zipfile.ZipFile(io.BytesIO(b''.join(archive_utils.iter_zip(files)))) as zf:
+        assert zf.testzip() is None
+        assert not zf.getinfo('config/init-cfg.txt').flag_bits & 0x800
+        info = zf.getinfo('config/résumé.txt')
+        assert info.flag_bits & 0x800
+        assert zf.read(info) == 'café\n'.encode('utf-8')
+        assert zf.getinfo('software/日本.bin').flag_bits & 0x800
+        assert zf.read('software/日本.bin') == b'software image'
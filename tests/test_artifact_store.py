@@ -0,0 +1,101 @@
+import hashlib
+import os
+import threading
+
+from bootstrapper.lib import artifact_store
+
+
+def test_store_and_load(tmpdir):
+    """
+    Tests archives are kept under a build id until they expire
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Store Artifact".center(79, '-'))
+
+    store_dir = str(tmpdir.join('artifacts'))
+    os.makedirs(store_dir)
+    data = os.urandom(5000)
+
+    artifact = artifact_store.store([data[:1000], data[1000:]], store_dir, 'panos-01.zip', 'application/zip', 60)
+    assert artifact['size'] == len(data)
+    assert artifact['etag'] == hashlib.sha256(data).hexdigest()
+    assert artifact_store.load(store_dir, artifact['build_id']) == artifact
+    assert b''.join(artifact_store.iter_range(artifact, 100, 200)) == data[100:200]
+
+    assert artifact_store.load(store_dir, '../' + artifact['build_id']) is None
+    assert artifact_store.prune(store_dir) == 0
+
+    expired = artifact_store.store([data], store_dir, 'panos-02.zip', 'application/zip', 0)
+    assert artifact_store.load(store_dir, expired['build_id']) is None
+    assert artifact_store.prune(store_dir) == 1
+    assert os.listdir(store_dir) == [artifact['build_id']]
+
+
+def test_prune_size(tmpdir):
+    """
+    Tests the least recently used archives are removed once the store is too large
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Prune Artifacts By Size".center(79, '-'))
+
+    store_dir = str(tmpdir)
+    first = artifact_store.store([b'a' * 1000], store_dir, 'first.zip', 'application/zip', 60, 'a' * 32)
+    second = artifact_store.store([b'b' * 1000], store_dir, 'second.zip', 'application/zip', 60)
+    os.utime(os.path.join(store_dir, second['build_id'], 'meta.json'), (0, 0))
+
+    # storing the same build id again keeps the first build
+    again = artifact_store.store([b'c' * 1000], store_dir, 'first.zip', 'application/zip', 60, 'a' * 32)
+    assert again['etag'] == first['etag']
+
+    assert artifact_store.prune(store_dir, max_bytes=1500) == 1
+    assert artifact_store.load(store_dir, second['build_id']) is None
+    assert artifact_store.load(store_dir, first['build_id'], touch=True) == first
+
+
+def test_store_concurrently(tmpdir):
+    """
+    Tests identical builds stored at the same time keep one archive that both requests can send, and an expired
+    build in the way is kept for another ttl
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Store Artifacts Concurrently".center(79, '-'))
+
+    store_dir = str(tmpdir)
+    data = os.urandom(5000)
+    # both builds are written before either is renamed into place
+    barrier = threading.Barrier(2)
+
+    def chunks():
+        yield data[:1000]
+        barrier.wait(5)
+        yield data[1000:]
+
+    results = list()
+    errors = list()
+
+    def build():
+        try:
+            results.append(artifact_store.store(chunks(), store_dir, 'panos-01.zip', 'application/zip', 60, 'b' * 32))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=build) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert errors == []
+    assert results[0] == results[1]
+    assert artifact_store.load(store_dir, 'b' * 32) == results[0]
+    assert b''.join(artifact_store.iter_range(results[0], 0, len(data))) == data
+    assert os.listdir(store_dir) == ['b' * 32]
+
+    expired = artifact_store.store([b'c' * 1000], store_dir, 'expired.zip', 'application/zip', 0, 'c' * 32)
+    assert artifact_store.load(store_dir, 'c' * 32) is None
+    renewed = artifact_store.store([b'c' * 1000], store_dir, 'expired.zip', 'application/zip', 60, 'c' * 32)
+    assert renewed['path'] == expired['path']
+    assert artifact_store.load(store_dir, 'c' * 32) == renewed
@@ -1,7 +1,22 @@
+import base64
+import io
+import os
+import tarfile
+import zipfile
+
 import pytest
 from flask import json
+from flask import render_template_string
+from jinja2 import DictLoader
+from jinja2 import Environment
+from werkzeug.wsgi import FileWrapper
 
 from bootstrapper import bootstrapper
+from bootstrapper.lib import archive_utils
+from bootstrapper.lib import bootstrapper_utils
+from bootstrapper.lib import cache_utils
+from bootstrapper.lib import jinja2_filters
+from bootstrapper.lib import template_cache
 
 
 @pytest.fixture
@@ -44,6 +59,52 @@ def test_caching(client):
     assert b'CACHE TEST' in d
 
 
+def test_memory_cache_tier(client):
+    """
+    Tests objects are served from the in memory cache tier after they are set
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Memory Cache Tier".center(79, '-'))
+
+    r = client.get('/cache_stats')
+    before = json.loads(r.data)['stats']
+
+    params = {
+        'contents': 'MEMORY CACHE TEST'
+    }
+    r = client.post('/set', data=json.dumps(params), content_type='application/json')
+    key = json.loads(r.data)['key']
+    r = client.get('/get/%s' % key)
+    assert b'MEMORY CACHE TEST' in r.data
+
+    r = client.get('/cache_stats')
+    after = json.loads(r.data)['stats']
+    assert after['hits'] == before['hits'] + 1
+    assert after['bytes'] <= after['max_bytes']
+
+
+def test_memory_cache_eviction():
+    """
+    Tests the in memory cache tier evicts the least recently used objects once full and honors timeouts
+    :return: test assertions
+    """
+    print("Test: Memory Cache Eviction".center(79, '-'))
+
+    c = cache_utils.MemoryLRUCache(max_bytes=10)
+    assert c.set('a', '12345')
+    assert c.set('b', '12345')
+    assert c.get('a') == '12345'
+    assert c.set('c', '12345')
+    assert c.get('b') is None
+    assert c.get('a') == '12345'
+    assert c.stats['evictions'] == 1
+    assert not c.set('d', '12345678901')
+
+    assert c.set('e', '1', timeout=-1)
+    assert c.get('e') is None
+
+
 def test_build_openstack_archive(client):
     """
     Tests build openstack_configs
@@ -90,6 +151,113 @@ def test_build_openstack_archive(client):
     assert r.status_code == 200
 
 
+def test_build_zip(client):
+    """
+    Tests the zip archive is built in memory with the bootstrap package layout
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Build Zip Archive".center(79, '-'))
+
+    params = {
+        "hostname": "panos-test-zip",
+        "archive_type": "zip",
+        "dhcp_or_static": "dhcp-client",
+        "bootstrap_template": "None",
+        "init_cfg_template": "Default Init-Cfg",
+    }
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    assert r.mimetype == 'application/zip'
+    assert 'panos-test-zip.zip' in r.headers['Content-Disposition']
+
+    with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+        assert zf.testzip() is None
+        names = zf.namelist()
+        for d in ['config/', 'content/', 'software/', 'license/']:
+            assert d in names
+        assert 'hostname=panos-test-zip' in zf.read('config/init-cfg.txt').decode('utf-8')
+
+
+def test_build_zip_with_software_image(client, monkeypatch, tmpdir):
+    """
+    Tests software images are included in the archive from where they are staged
+    :param client: test client
+    :param monkeypatch: pytest monkeypatch
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Build Zip With Software Image".center(79, '-'))
+
+    monkeypatch.setattr(archive_utils, '_software_image_dir', str(tmpdir))
+    # software images are gzip compressed and are stored as is
+    image = b'\x1f\x8b\x08\x00' + b'PANOS IMAGE' * 1000
+    tmpdir.join('PanOS_vm-9.0.0').write_binary(image)
+
+    params = {
+        "hostname": "panos-test-software",
+        "archive_type": "zip",
+        "dhcp_or_static": "dhcp-client",
+        "init_cfg_template": "Default Init-Cfg",
+        "software_image": "PanOS_vm-9.0.0",
+    }
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+
+    with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+        assert zf.getinfo('software/PanOS_vm-9.0.0').compress_type == zipfile.ZIP_STORED
+        assert zf.read('software/PanOS_vm-9.0.0') == image
+
+    params['software_image'] = 'PanOS_vm-missing'
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 400
+
+
+def test_build_iso(client):
+    """
+    Tests the ISO image is built in process
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Build ISO Image".center(79, '-'))
+
+    params = {
+        "hostname": "panos-test-iso",
+        "archive_type": "iso",
+        "dhcp_or_static": "dhcp-client",
+        "bootstrap_template": "None",
+        "init_cfg_template": "Default Init-Cfg",
+    }
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    assert r.mimetype == 'application/iso-image'
+    assert 'panos-test-iso.iso' in r.headers['Content-Disposition']
+    assert r.data[16 * 2048:16 * 2048 + 6] == b'\x01CD001'
+    assert b'hostname=panos-test-iso' in r.data
+
+
+def test_build_base_configs_without_cache(client):
+    """
+    Tests files destined for an archive are rendered as they are consumed instead of being stored in the cache
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Build Base Configs Without Cache".center(79, '-'))
+
+    client.get('/')
+    with bootstrapper.app.test_request_context():
+        params = {
+            "hostname": "panos-test-stream",
+            "dhcp_or_static": "dhcp-client",
+            "auth_code": "ABC123",
+        }
+        base_config = bootstrapper_utils.build_base_configs(params, cache_files=False)
+        assert 'key' not in base_config['init-cfg.txt']
+        assert 'url' not in base_config['init-cfg.txt']
+        assert 'hostname=panos-test-stream' in ''.join(base_config['init-cfg.txt']['contents'])
+        assert 'ABC123' in ''.join(base_config['authcodes']['contents'])
+
+
 def test_build_tgz(client):
     """
     Tests build openstack_configs
@@ -108,6 +276,13 @@ def test_build_tgz(client):
     }
     r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
     assert r.status_code == 200
+    assert r.mimetype == 'application/gzip'
+
+    with tarfile.open(fileobj=io.BytesIO(r.data), mode='r:gz') as tar:
+        names = tar.getnames()
+        for d in ['./config', './content', './software', './license']:
+            assert tar.getmember(d).isdir()
+        assert './config/init-cfg.txt' in names
 
 
 def test_build_encoded_tgz(client):
@@ -128,6 +303,193 @@ def test_build_encoded_tgz(client):
     r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
     assert r.status_code == 200
 
+    with tarfile.open(fileobj=io.BytesIO(base64.b64decode(r.data)), mode='r:gz') as tar:
+        assert './config/init-cfg.txt' in tar.getnames()
+
+    params['response_format'] = 'json'
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    encoded = json.loads(r.data)['archive']
+    with tarfile.open(fileobj=io.BytesIO(base64.b64decode(encoded)), mode='r:gz') as tar:
+        init_cfg = tar.extractfile('./config/init-cfg.txt').read().decode('utf-8')
+        assert 'hostname=panos-test-targz' in init_cfg
+
+
+def test_build_archive_options(client):
+    """
+    Tests compression settings can be overridden per request
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Build Archive Options".center(79, '-'))
+
+    params = {
+        "hostname": "panos-test-options",
+        "archive_type": "zip",
+        "dhcp_or_static": "dhcp-client",
+        "init_cfg_template": "Default Init-Cfg",
+        "archive_options": {"level": 0},
+    }
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+        assert zf.getinfo('config/init-cfg.txt').compress_type == zipfile.ZIP_STORED
+
+    params['archive_type'] = 'tgz'
+    params['archive_options'] = '{"level": 9, "threads": 2}'
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(r.data), mode='r:gz') as tar:
+        assert './config/init-cfg.txt' in tar.getnames()
+
+    params['archive_options'] = {"level": 10}
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 400
+
+    # openstack archives take the same overrides and report bad ones the same way
+    params.update(archive_options={"level": 0}, management_ip='1.1.1.1', outside_ip='2.2.2.2', inside_ip='3.3.3.3')
+    r = client.post('/bootstrap_openstack', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+        assert zf.getinfo('config/init-cfg.txt').compress_type == zipfile.ZIP_STORED
+
+    params['archive_options'] = {"level": 10}
+    r = client.post('/bootstrap_openstack', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 400
+    assert b'Compression level must be between 0 and 9' in r.data
+
+
+def test_build_streamed(client):
+    """
+    Tests archives can be streamed while they are built
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Build Streamed Archive".center(79, '-'))
+
+    params = {
+        "hostname": "panos-test-stream",
+        "archive_type": "zip",
+        "dhcp_or_static": "dhcp-client",
+        "init_cfg_template": "Default Init-Cfg",
+        "stream": True,
+    }
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    assert r.mimetype == 'application/zip'
+    assert 'panos-test-stream.zip' in r.headers['Content-Disposition']
+    with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+        assert 'hostname=panos-test-stream' in zf.read('config/init-cfg.txt').decode('utf-8')
+
+    params['archive_type'] = 'tgz'
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(r.data), mode='r:gz') as tar:
+        assert './config/init-cfg.txt' in tar.getnames()
+
+    params['archive_type'] = 'iso'
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    assert int(r.headers['Content-Length']) == len(r.data)
+
+    r = client.post('/bootstrap_kvm', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    assert r.mimetype == 'application/iso-image'
+
+
+def test_archive_download(client, monkeypatch, tmpdir):
+    """
+    Tests retained archives can be downloaded again and resumed with Range requests
+    :param client: test client
+    :param monkeypatch: pytest monkeypatch
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Archive Download".center(79, '-'))
+
+    monkeypatch.setitem(archive_utils.__options, 'artifact_dir', str(tmpdir))
+    monkeypatch.setitem(archive_utils.__options, 'artifact_ttl', 60)
+
+    params = {
+        "hostname": "panos-test-download",
+        "archive_type": "zip",
+        "dhcp_or_static": "dhcp-client",
+        "init_cfg_template": "Default Init-Cfg",
+    }
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    archive = r.data
+    etag = r.headers['ETag']
+    url = '/archives/' + r.headers['X-Build-Id']
+
+    r = client.get(url, headers={'Range': 'bytes=10-99'})
+    assert r.status_code == 206
+    assert r.headers['Content-Range'] == 'bytes 10-99/%d' % len(archive)
+    assert r.data == archive[10:100]
+
+    r = client.get(url, headers={'Range': 'bytes=10-', 'If-Range': etag})
+    assert r.status_code == 206
+    assert r.data == archive[10:]
+
+    r = client.get(url, headers={'Range': 'bytes=10-', 'If-Range': '"changed"'})
+    assert r.status_code == 200
+    assert r.data == archive
+
+    assert client.get(url, headers={'Range': 'bytes=%d-' % len(archive)}).status_code == 416
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/archives/0123456789abcdef0123456789abcdef').status_code == 404
+
+    r = client.get(url, environ_overrides={'wsgi.file_wrapper': FileWrapper})
+    assert r.status_code == 200
+    assert r.data == archive
+
+    # pruned after it was looked up, the download fails before any header is sent
+    artifact = archive_utils.get_artifact(url.rsplit('/', 1)[1])
+    monkeypatch.setattr(archive_utils, 'get_artifact', lambda build_id: artifact)
+    os.remove(artifact['path'])
+    assert client.get(url, headers={'Range': 'bytes=10-99'}).status_code == 404
+    assert client.get(url, environ_overrides={'wsgi.file_wrapper': FileWrapper}).status_code == 404
+
+
+def test_artifact_cache(client, monkeypatch, tmpdir):
+    """
+    Tests identical requests are served from the artifact store
+    :param client: test client
+    :param monkeypatch: pytest monkeypatch
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Artifact Cache".center(79, '-'))
+
+    monkeypatch.setitem(archive_utils.__options, 'artifact_dir', str(tmpdir))
+    monkeypatch.setitem(archive_utils.__options, 'artifact_ttl', 60)
+    monkeypatch.setitem(archive_utils.__options, 'artifact_cache', True)
+
+    params = {
+        "hostname": "panos-test-cache",
+        "archive_type": "tgz",
+        "dhcp_or_static": "dhcp-client",
+        "init_cfg_template": "Default Init-Cfg",
+    }
+    first = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert first.status_code == 200
+
+    second = client.post('/generate_bootstrap_package', data=json.dumps(dict(reversed(list(params.items())))),
+                         content_type='application/json')
+    assert second.headers['X-Build-Id'] == first.headers['X-Build-Id']
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert second.data == first.data
+
+    params['hostname'] = 'panos-test-cache-2'
+    third = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert third.headers['X-Build-Id'] != first.headers['X-Build-Id']
+
+    # a template whose includes cannot be checked is always built again
+    monkeypatch.setattr(bootstrapper_utils, 'get_template', lambda name: "{% include 'missing.xml' %}")
+    with bootstrapper.app.app_context():
+        assert bootstrapper_utils.artifact_key(params, dict(), 'tgz') is None
+
 
 def test_render_template(client):
     """
@@ -161,6 +523,178 @@ def test_render_template(client):
     assert r.status_code == 200
 
 
+def test_template_cache(client):
+    """
+    Tests the compiled template cache is used for repeated renders of the same template
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Template Cache".center(79, '-'))
+
+    params = {
+        "hostname": "panos-test-cache",
+        "archive_type": "tgz",
+        "dhcp_or_static": "dhcp-client",
+        "init_cfg_template": "Default Init-Cfg",
+    }
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+
+    r = client.get('/template_cache_stats')
+    before = json.loads(r.data)['stats']
+
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+
+    r = client.get('/template_cache_stats')
+    after = json.loads(r.data)['stats']
+    assert after['hits'] > before['hits']
+    assert after['misses'] == before['misses']
+
+
+def test_template_bytecode_cache(client):
+    """
+    Tests templates are compiled into the on disk bytecode cache and render like render_template_string
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Template Bytecode Cache".center(79, '-'))
+
+    with bootstrapper.app.test_request_context():
+        template_string = '<hostname>{{ hostname }}</hostname>'
+        assert template_cache.precompile('bytecode', template_string)
+
+        env = bootstrapper.app.jinja_env
+        bucket = template_cache.get_bytecode_cache().get_bucket(env, 'bytecode', None, template_string)
+        assert bucket.code is not None
+
+        template_cache.clear()
+        rendered = template_cache.render('bytecode', template_string, hostname='a&b')
+        assert rendered == render_template_string(template_string, hostname='a&b')
+
+
+def test_render_memo(client, monkeypatch):
+    """
+    Tests identical renders re-use the memoized output and cache key, but salted hashes are always re-rendered
+    :param client: test client
+    :param monkeypatch: pytest monkeypatch fixture
+    :return: test assertions
+    """
+    print("Test: Render Memo".center(79, '-'))
+
+    # ensure the application and the custom jinja filters are initialized
+    client.get('/')
+
+    monkeypatch.setitem(template_cache.__options, 'render_memo', True)
+
+    with bootstrapper.app.test_request_context():
+        params = {'hostname': 'panos-test-memo'}
+        first = bootstrapper_utils.render_to_cache('memo', 'hostname={{ hostname }}', params)
+        second = bootstrapper_utils.render_to_cache('memo', 'hostname={{ hostname }}', params)
+        assert first == second
+
+        params = {'hostname': 'panos-test-memo-2'}
+        third = bootstrapper_utils.render_to_cache('memo', 'hostname={{ hostname }}', params)
+        assert third != first
+
+        first = bootstrapper_utils.render_to_cache('salted', '{{ hostname | sha512_hash }}', params)
+        second = bootstrapper_utils.render_to_cache('salted', '{{ hostname | sha512_hash }}', params)
+        assert first != second
+
+
+def test_is_deterministic():
+    """
+    Tests salted hash filters are found through includes, imports and extends, and unresolvable references are never
+    treated as deterministic
+    :return: test assertions
+    """
+    print("Test: Is Deterministic".center(79, '-'))
+
+    templates = {
+        'plain.xml': '<hostname>{{ hostname }}</hostname>',
+        'hashed.xml': '<phash>{{ password | md5_hash }}</phash>',
+        'macros.xml': '{% macro phash(p) %}{{ p | sha512_hash }}{% endmacro %}',
+        'base.xml': '<config>{% block body %}{% endblock %}</config>',
+    }
+    env = Environment(loader=DictLoader(templates))
+
+    assert template_cache.is_deterministic('{% include "plain.xml" %}', env)
+    assert template_cache.is_deterministic('{% extends "base.xml" %}{% block body %}x{% endblock %}', env)
+    assert not template_cache.is_deterministic('{{ password | des_hash }}', env)
+    assert not template_cache.is_deterministic('{{ passwords | map("md5_hash") | list }}', env)
+    assert not template_cache.is_deterministic('{% include "hashed.xml" %}', env)
+    assert not template_cache.is_deterministic('{% import "macros.xml" as m %}{{ m.phash(password) }}', env)
+    assert not template_cache.is_deterministic('{% include "missing.xml" %}', env)
+    assert not template_cache.is_deterministic('{% include template_name %}', env)
+
+    # the result follows changes to the included templates
+    fingerprint = template_cache.fingerprint('{% include "plain.xml" %}', env)
+    templates['plain.xml'] = '{{ password | md5_hash }}'
+    assert not template_cache.is_deterministic('{% include "plain.xml" %}', env)
+    assert template_cache.fingerprint('{% include "plain.xml" %}', env) != fingerprint
+
+
+def test_hash_filters():
+    """
+    Tests the hash filters memo and process pool modes
+    :return: test assertions
+    """
+    print("Test: Hash Filters".center(79, '-'))
+
+    try:
+        assert jinja2_filters.sha512_hash('password') != jinja2_filters.sha512_hash('password')
+
+        jinja2_filters.configure(memo_ttl=60)
+        hashed = jinja2_filters.sha512_hash('password')
+        assert hashed == jinja2_filters.sha512_hash('password')
+        assert hashed != jinja2_filters.sha512_hash('other-password')
+
+        jinja2_filters.configure(process_pool_workers=1)
+        assert jinja2_filters.md5_hash('password').startswith('$1$')
+    finally:
+        jinja2_filters.configure()
+
+
+def test_render_template_batch(client):
+    """
+    Tests rendering a template with many parameter sets, as a JSON list and as JSON lines
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Render Template Batch".center(79, '-'))
+
+    params = {
+        "template_name": "Default Init-Cfg",
+        "parameters": [
+            {"hostname": "panos-batch-1", "dhcp_or_static": "dhcp-client"},
+            {"dhcp_or_static": "dhcp-client"},
+            {"hostname": "panos-batch-3", "dhcp_or_static": "dhcp-client"},
+        ]
+    }
+    r = client.post('/get_template_variables', data=json.dumps({"template_name": "Default Init-Cfg"}),
+                    content_type='application/json')
+    required = json.loads(r.data)['payload']
+    for i in (0, 2):
+        for k in required:
+            params['parameters'][i].setdefault(k, '')
+
+    r = client.post('/render_template_batch', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    results = [json.loads(line) for line in r.data.splitlines()]
+    # missing variables are only reported, as they are for a single render
+    assert [res['success'] for res in results] == [True, True, True]
+    assert 'hostname=panos-batch-1' in results[0]['rendered']
+    assert 'hostname=panos-batch-1' not in results[1]['rendered']
+
+    body = '\n'.join([json.dumps(params['parameters'][0]), 'not json', json.dumps(params['parameters'][2])])
+    r = client.post('/render_template_batch?template_name=Default Init-Cfg', data=body,
+                    content_type='application/x-ndjson')
+    assert r.status_code == 200
+    results = [json.loads(line) for line in r.data.splitlines()]
+    assert [res['success'] for res in results] == [True, False, True]
+    assert 'hostname=panos-batch-3' in results[2]['rendered']
+
+
 def test_get_bootstrap_variables(client):
     """
     Tests the api to retrieve the list of variables in the bootstrap.xml template
@@ -198,6 +732,55 @@ def test_import_template(client):
     assert d['success'] is True
 
 
+def test_get_template_variables(client):
+    """
+    Tests the variables of an imported template are indexed and returned
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Get Template Variables".center(79, '-'))
+
+    params = {
+        "name": "TEST_VARIABLES",
+        "description": "ADDED BY PYTEST",
+        "template": "hostname={{ hostname }} {% if dns %}dns={{ dns | default('') }}{% endif %}"
+    }
+    r = client.post('/update_template', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+
+    params = {
+        "template_name": "TEST_VARIABLES"
+    }
+    r = client.post('/get_template_variables', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    d = json.loads(r.data)
+    assert set(d['payload']) == {'template_name', 'hostname', 'dns'}
+
+    r = client.post('/delete_template', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+
+
+def test_list_content_updates(client, monkeypatch, tmpdir):
+    """
+    Tests the content updates that will be bundled are listed
+    :param client: test client
+    :param monkeypatch: pytest monkeypatch
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: List Content Updates".center(79, '-'))
+
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(tmpdir))
+    tmpdir.mkdir('app').join('panupv2-all-apps-8000-5000').write_binary(b'APP')
+
+    r = client.get('/list_content_updates')
+    assert r.status_code == 200
+    updates = json.loads(r.data)['content_updates']
+    assert updates['app']['name'] == 'panupv2-all-apps-8000-5000'
+    assert updates['app']['size'] == 3
+    assert updates['antivirus'] is None
+
+
 def test_get_template(client):
     """
     Tests the api to retrieve template files
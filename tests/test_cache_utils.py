@@ -0,0 +1,136 @@
+import socketserver
+import threading
+import time
+
+import pytest
+
+from bootstrapper.lib import cache_utils
+
+
+class MemcachedStandIn(socketserver.ThreadingTCPServer):
+    """
+    Minimal memcached text protocol server, just enough of get / set / add / append / delete for the cache tests
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), MemcachedHandler)
+        self.data = dict()
+        self.lock = threading.Lock()
+
+
+class MemcachedHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, noreply, message):
+        if not noreply:
+            self.wfile.write(message)
+
+    def handle(self):
+        data = self.server.data
+        for line in self.rfile:
+            parts = line.split()
+            if not parts:
+                continue
+
+            command = parts[0]
+            with self.server.lock:
+                if command in (b'get', b'gets'):
+                    for key in parts[1:]:
+                        entry = data.get(key, None)
+                        if entry is not None and (entry[2] == 0 or entry[2] > time.time()):
+                            self.wfile.write(b'VALUE %s %s %d\r\n%s\r\n' % (key, entry[0], len(entry[1]), entry[1]))
+                    self.wfile.write(b'END\r\n')
+
+                elif command in (b'set', b'add', b'append'):
+                    key, flags, exptime, size = parts[1:5]
+                    noreply = len(parts) > 5
+                    value = self.rfile.read(int(size) + 2)[:-2]
+                    exptime = int(exptime)
+                    expires = 0 if exptime == 0 else time.time() + exptime
+                    exists = key in data and (data[key][2] == 0 or data[key][2] > time.time())
+                    if command == b'add' and exists or command == b'append' and not exists:
+                        self.reply(noreply, b'NOT_STORED\r\n')
+                    elif command == b'append':
+                        data[key] = (data[key][0], data[key][1] + value, data[key][2])
+                        self.reply(noreply, b'STORED\r\n')
+                    else:
+                        data[key] = (flags, value, expires)
+                        self.reply(noreply, b'STORED\r\n')
+
+                elif command == b'delete':
+                    noreply = len(parts) > 2
+                    self.reply(noreply, b'DELETED\r\n' if data.pop(parts[1], None) else b'NOT_FOUND\r\n')
+
+                else:
+                    self.wfile.write(b'ERROR\r\n')
+
+
+@pytest.fixture
+def cache_options():
+    """
+    Restores the configured cache options after each test
+    """
+    options = dict(cache_utils.__options)
+    yield
+    cache_utils.configure(**options)
+
+
+def _exercise_cache():
+    key = cache_utils.set('CACHE BACKEND TEST')
+    assert key is not None
+    assert cache_utils.get(key) == 'CACHE BACKEND TEST'
+    assert cache_utils.has(key)
+
+    keys = cache_utils.set_many(['ONE', {'two': 2}, 'THREE'])
+    assert cache_utils.get_many(keys) == ['ONE', {'two': 2}, 'THREE']
+    assert cache_utils.get_many([keys[0], 'not-a-key']) == ['ONE', None]
+    assert cache_utils.get('not-a-key') is None
+
+
+def test_memory_backend(cache_options):
+    cache_utils.configure(backend='memory')
+    _exercise_cache()
+
+
+def test_filesystem_backend(cache_options, tmpdir):
+    cache_utils.configure(backend='filesystem', cache_dir=str(tmpdir))
+    _exercise_cache()
+
+
+def test_sqlite_backend(cache_options, tmpdir):
+    cache_utils.configure(backend='sqlite', sqlite_path=str(tmpdir.join('cache.db')), memory_max_bytes=0)
+    _exercise_cache()
+
+    c = cache_utils.SQLiteCache(str(tmpdir.join('cache.db')))
+    assert c.set('expired', 'value', timeout=-1)
+    assert c.get('expired') is None
+    assert c.add('expired', 'value')
+    assert not c.add('expired', 'other value')
+    assert c.delete('expired')
+
+
+def test_redis_backend(cache_options):
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        host, port = server.server_address
+        cache_utils.configure(backend='redis', redis_url='redis://%s:%s/0' % (host, port), memory_max_bytes=0)
+        _exercise_cache()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_memcached_backend(cache_options):
+    pytest.importorskip('pymemcache')
+    server = MemcachedStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        host, port = server.server_address
+        cache_utils.configure(backend='memcached', memcached_servers=['%s:%s' % (host, port)], memory_max_bytes=0)
+        _exercise_cache()
+    finally:
+        server.shutdown()
+        server.server_close()
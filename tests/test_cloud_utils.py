@@ -0,0 +1,515 @@
+import base64
+import os
+import threading
+
+import pytest
+from azure.common import AzureException
+from azure.common import AzureMissingResourceHttpError
+from azure.storage.file.models import CopyProperties
+from azure.storage.file.models import File
+from azure.storage.file.models import FileProperties
+
+from bootstrapper.lib import archive_utils
+from bootstrapper.lib import cloud_utils
+
+
+def _files(tmpdir):
+    image = tmpdir.join('PanOS_vm-9.0.0')
+    image.write_binary(os.urandom(6 * 1024 * 1024))
+    return {
+        'init-cfg.txt': {'archive_path': 'config', 'contents': 'type=dhcp-client\nhostname=panos-cloud\n'},
+        'bootstrap.xml': {'archive_path': 'config', 'contents': '<config></config>'},
+        'PanOS_vm-9.0.0': {'archive_path': 'software', 'source_path': str(image)},
+    }
+
+
+def _content_update(tmpdir, monkeypatch):
+    content_dir = tmpdir.join('content_updates')
+    content_dir.join('antivirus', 'panupv2-all-antivirus-3000-3500').write_binary(b'threat-id 1\n' * 1000,
+                                                                                  ensure=True)
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(content_dir))
+
+
+def _record_shared(monkeypatch):
+    """
+    Records the key of every shared file and if it was uploaded or the stored copy was kept
+    """
+    uploaded = list()
+    upload_shared = cloud_utils.upload_shared
+
+    def record(key, size, stored_size, upload):
+        uploaded.append((key[-1], upload_shared(key, size, stored_size, upload)))
+        return uploaded[-1][1]
+
+    monkeypatch.setattr(cloud_utils, 'upload_shared', record)
+    return uploaded
+
+
+def test_get_s3_client():
+    """
+    Tests S3 clients are pooled per region and credentials
+    :return: test assertions
+    """
+    print("Test: Get S3 Client".center(79, '-'))
+
+    client = cloud_utils.get_s3_client('us-west-2', 'access', 'secret')
+    assert cloud_utils.get_s3_client('us-west-2', 'access', 'secret') is client
+    assert cloud_utils.get_s3_client('us-west-2', 'access', 'other') is not client
+    assert cloud_utils.get_s3_client('eu-west-1', 'access', 'secret') is not client
+
+
+def test_pooled_client(monkeypatch):
+    """
+    Tests clients are built without holding up other lookups, the first one stored is kept and the least recently
+    used one is evicted
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Pooled Client".center(79, '-'))
+
+    monkeypatch.setattr(cloud_utils, '_max_clients', 2)
+
+    def create():
+        # a lookup from another thread while this client is built does not wait for it
+        lookup = threading.Thread(target=cloud_utils._pooled_client, args=(('test', 'other'), object))
+        lookup.start()
+        lookup.join(5)
+        assert not lookup.is_alive()
+        return object()
+
+    client = cloud_utils._pooled_client(('test', 'slow'), create)
+    assert cloud_utils._pooled_client(('test', 'slow'), create) is client
+
+    new = cloud_utils._pooled_client(('test', 'new'), object)
+    assert cloud_utils._pooled_client(('test', 'slow'), object) is client
+    cloud_utils._pooled_client(('test', 'other'), object)
+    assert cloud_utils._pooled_client(('test', 'slow'), object) is client
+    # slow was used last, so new was evicted
+    assert cloud_utils._pooled_client(('test', 'new'), object) is not new
+
+
+def test_get_file_service(monkeypatch):
+    """
+    Tests Azure file services are pooled per account and can point at a local emulator
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Get File Service".center(79, '-'))
+
+    key = base64.b64encode(b'account key').decode('utf-8')
+    file_service = cloud_utils.get_file_service('bootstrapper', key)
+    assert cloud_utils.get_file_service('bootstrapper', key) is file_service
+    assert cloud_utils.get_file_service('other', key) is not file_service
+    assert file_service.make_file_url('share', 'config', 'init-cfg.txt').startswith('https://bootstrapper.file.')
+
+    monkeypatch.setitem(cloud_utils.__options, 'azure', dict(cloud_utils.__options['azure'],
+                                                              file_endpoint='http://127.0.0.1:10004/bootstrapper'))
+    emulated = cloud_utils.get_file_service('bootstrapper', key)
+    assert emulated is not file_service
+    assert emulated.make_file_url('share', 'config', 'init-cfg.txt') == \
+        'http://127.0.0.1:10004/bootstrapper/share/config/init-cfg.txt'
+
+
+def test_get_gcp_client(monkeypatch):
+    """
+    Tests GCS clients are pooled per project and token, can point at a local fake GCS server and only large files are
+    sent in resumable chunks
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Get GCP Client".center(79, '-'))
+
+    client = cloud_utils.get_gcp_client('project', 'token')
+    assert cloud_utils.get_gcp_client('project', 'token') is client
+    assert cloud_utils.get_gcp_client('project', 'other') is not client
+
+    monkeypatch.setitem(cloud_utils.__options, 'gcp', dict(cloud_utils.__options['gcp'],
+                                                            api_endpoint='http://127.0.0.1:4443',
+                                                            resumable_threshold=1024 * 1024, chunk_size=1000000))
+    assert cloud_utils.get_gcp_client('project', 'token')._connection.API_BASE_URL == 'http://127.0.0.1:4443'
+
+    assert cloud_utils.gcs_chunk_size(1024 * 1024) is None
+    assert cloud_utils.gcs_chunk_size(1024 * 1024 + 1) == 3 * 256 * 1024
+
+
+def test_run_uploads():
+    """
+    Tests uploads return their results in order and errors are raised once every upload is done
+    :return: test assertions
+    """
+    print("Test: Run Uploads".center(79, '-'))
+
+    assert cloud_utils.run_uploads('s3', lambda item: item * 2, [1, 2, 3]) == [2, 4, 6]
+
+    done = list()
+
+    def upload(item):
+        if item == 1:
+            raise IOError('upload failed')
+        done.append(item)
+
+    with pytest.raises(IOError):
+        cloud_utils.run_uploads('s3', upload, [0, 1, 2])
+    assert sorted(done) == [0, 2]
+
+
+def test_create_s3_bucket(tmpdir, monkeypatch):
+    """
+    Tests a bootstrap package is uploaded to S3, with large files in multipart uploads
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Create S3 Bucket".center(79, '-'))
+
+    moto = pytest.importorskip('moto')
+    mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_s3
+
+    monkeypatch.setattr(archive_utils, '_archive_dir', str(tmpdir.join('archives')))
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(tmpdir.join('content_updates')))
+    monkeypatch.setitem(cloud_utils.__options, 's3', dict(cloud_utils.__options['s3'], max_workers=4,
+                                                           multipart_threshold=5 * 1024 * 1024,
+                                                           multipart_chunksize=5 * 1024 * 1024))
+
+    with mock_aws():
+        response = archive_utils.create_s3_bucket(_files(tmpdir), 'panos-cloud', 'us-east-1', 'access', 'moto')
+        assert response.endswith('created successfully')
+
+        client = cloud_utils.get_s3_client('us-east-1', 'access', 'moto')
+        bucket_name = response.split()[2]
+        keys = [o['Key'] for o in client.list_objects_v2(Bucket=bucket_name)['Contents']]
+        assert sorted(keys) == ['config/', 'config/bootstrap.xml', 'config/init-cfg.txt', 'content/', 'license/',
+                                'software/', 'software/PanOS_vm-9.0.0']
+
+        image = client.get_object(Bucket=bucket_name, Key='software/PanOS_vm-9.0.0')
+        # multipart uploads have an ETag ending in the number of parts
+        assert image['ETag'].strip('"').endswith('-2')
+        assert image['Body'].read() == tmpdir.join('PanOS_vm-9.0.0').read_binary()
+        assert client.get_object(Bucket=bucket_name, Key='config/bootstrap.xml')['Body'].read() == b'<config></config>'
+
+    # nothing is staged on disk
+    assert not tmpdir.join('archives').check()
+
+
+def test_create_s3_bucket_shared(tmpdir, monkeypatch):
+    """
+    Tests packages are uploaded under their own prefix of a shared bucket, with content updates and software images
+    uploaded once and copied into each prefix
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Create S3 Bucket Shared".center(79, '-'))
+
+    moto = pytest.importorskip('moto')
+    mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_s3
+
+    _content_update(tmpdir, monkeypatch)
+    monkeypatch.setitem(cloud_utils.__options, 's3', dict(cloud_utils.__options['s3'], shared_bucket='bootstrap',
+                                                           multipart_threshold=5 * 1024 * 1024,
+                                                           multipart_chunksize=5 * 1024 * 1024))
+    uploaded = _record_shared(monkeypatch)
+
+    with mock_aws():
+        client = cloud_utils.get_s3_client('us-east-1', 'access', 'moto-shared')
+        client.create_bucket(Bucket='bootstrap')
+
+        files = _files(tmpdir)
+        prefixes = list()
+        for _ in range(2):
+            response = archive_utils.create_s3_bucket(files, 'panos-cloud', 'us-east-1', 'access', 'moto-shared')
+            assert response.startswith('S3 bucket bootstrap prefix panos-cloud-')
+            prefixes.append(response.split()[4])
+
+        assert sorted(uploaded) == [('shared/content/panupv2-all-antivirus-3000-3500', False),
+                                    ('shared/content/panupv2-all-antivirus-3000-3500', True),
+                                    ('shared/software/PanOS_vm-9.0.0', False),
+                                    ('shared/software/PanOS_vm-9.0.0', True)]
+        for prefix in prefixes:
+            image = client.get_object(Bucket='bootstrap', Key=prefix + '/software/PanOS_vm-9.0.0')
+            assert image['Body'].read() == tmpdir.join('PanOS_vm-9.0.0').read_binary()
+            update = client.get_object(Bucket='bootstrap', Key=prefix + '/content/panupv2-all-antivirus-3000-3500')
+            assert update['Body'].read() == b'threat-id 1\n' * 1000
+            assert client.get_object(Bucket='bootstrap', Key=prefix + '/license/')['ContentLength'] == 0
+
+
+class _FileService(object):
+    """
+    Records the calls made by create_azure_fileshare, in place of a file service
+    """
+
+    account_name = 'bootstrapper'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directories = list()
+        self.files = dict()
+
+    def create_share(self, share_name):
+        self.share_name = share_name
+
+    def create_directory(self, share_name, directory_name):
+        with self.lock:
+            self.directories.append(directory_name)
+
+    def create_file_from_path(self, share_name, directory_name, file_name, file_path, max_connections=2):
+        with open(file_path, 'rb') as f:
+            self.create_file_from_bytes(share_name, directory_name, file_name, f.read(), max_connections)
+
+    def create_file_from_bytes(self, share_name, directory_name, file_name, data, max_connections=2):
+        assert directory_name in self.directories
+        self.files['%s/%s' % (directory_name, file_name)] = (data, max_connections)
+
+    def get_file_properties(self, share_name, directory_name, file_name):
+        path = '%s/%s' % (directory_name, file_name)
+        if path not in self.files:
+            raise AzureMissingResourceHttpError('Not found', 404)
+        properties = FileProperties()
+        properties.content_length = len(self.files[path][0])
+        return File(path, props=properties)
+
+    def make_file_url(self, share_name, directory_name, file_name):
+        return 'https://bootstrapper.file.core.windows.net/%s/%s/%s' % (share_name, directory_name, file_name)
+
+    def copy_file(self, share_name, directory_name, file_name, copy_source):
+        assert directory_name in self.directories
+        source = copy_source.split('/', 4)[4]
+        self.files['%s/%s' % (directory_name, file_name)] = (self.files[source][0], None)
+        copy = CopyProperties()
+        copy.status = 'success'
+        return copy
+
+
+def test_create_azure_fileshare(tmpdir, monkeypatch):
+    """
+    Tests directories are created before files are uploaded with the configured number of range connections
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Create Azure File Share".center(79, '-'))
+
+    monkeypatch.setattr(archive_utils, '_archive_dir', str(tmpdir.join('archives')))
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(tmpdir.join('content_updates')))
+    monkeypatch.setitem(cloud_utils.__options, 'azure', dict(cloud_utils.__options['azure'], max_connections=3))
+    file_service = _FileService()
+    monkeypatch.setattr(cloud_utils, 'get_file_service', lambda account_name, account_key: file_service)
+
+    files = _files(tmpdir)
+    files['panos.yaml'] = {'archive_path': 'plugins/vm_series', 'contents': 'plugin: true'}
+    response = archive_utils.create_azure_fileshare(files, 'panos-cloud', 'bootstrapper', 'key')
+    assert response == 'Azure file-share {} created successfully'.format(file_service.share_name)
+    assert sorted(file_service.directories) == ['config', 'content', 'license', 'plugins', 'plugins/vm_series',
+                                                'software']
+    assert file_service.directories.index('plugins') < file_service.directories.index('plugins/vm_series')
+    assert sorted(file_service.files) == ['config/bootstrap.xml', 'config/init-cfg.txt',
+                                          'plugins/vm_series/panos.yaml', 'software/PanOS_vm-9.0.0']
+    assert file_service.files['software/PanOS_vm-9.0.0'] == (tmpdir.join('PanOS_vm-9.0.0').read_binary(), 3)
+    assert file_service.files['config/bootstrap.xml'] == (b'<config></config>', 3)
+    # nothing is staged on disk
+    assert not tmpdir.join('archives').check()
+
+
+def test_create_azure_fileshare_shared(tmpdir, monkeypatch):
+    """
+    Tests packages are uploaded into their own directory of a shared file share, with content updates and software
+    images uploaded once and copied into each directory
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Create Azure File Share Shared".center(79, '-'))
+
+    _content_update(tmpdir, monkeypatch)
+    monkeypatch.setitem(cloud_utils.__options, 'azure', dict(cloud_utils.__options['azure'], shared_share='bootstrap'))
+    file_service = _FileService()
+    monkeypatch.setattr(cloud_utils, 'get_file_service', lambda account_name, account_key: file_service)
+    uploaded = _record_shared(monkeypatch)
+
+    files = _files(tmpdir)
+    directories = list()
+    for _ in range(2):
+        response = archive_utils.create_azure_fileshare(files, 'panos-cloud', 'bootstrapper', 'key')
+        assert response.startswith('Azure file-share bootstrap directory panos-cloud-')
+        directories.append(response.split()[4])
+
+    assert not hasattr(file_service, 'share_name')
+    assert sorted(u for u in uploaded if u[1]) == [('shared/content/panupv2-all-antivirus-3000-3500', True),
+                                             ('shared/software/PanOS_vm-9.0.0', True)]
+    assert len(uploaded) == 4
+    for directory in directories:
+        assert directory + '/license' in file_service.directories
+        assert file_service.files[directory + '/software/PanOS_vm-9.0.0'][0] == \
+            tmpdir.join('PanOS_vm-9.0.0').read_binary()
+        assert file_service.files[directory + '/content/panupv2-all-antivirus-3000-3500'][0] == \
+            b'threat-id 1\n' * 1000
+    # the locks of the shared files go once their uploads are done
+    assert len(cloud_utils.__shared) == 0
+
+
+class _PendingFileService(_FileService):
+    """
+    Records aborted copies, in place of an Azure FileService whose copies never finish
+    """
+
+    def __init__(self):
+        super(_PendingFileService, self).__init__()
+        self.aborted = list()
+
+    def copy_file(self, share_name, directory_name, file_name, copy_source):
+        copy = CopyProperties()
+        copy.id = 'copy-id'
+        copy.status = 'pending'
+        return copy
+
+    def get_file_properties(self, share_name, directory_name, file_name):
+        properties = FileProperties()
+        properties.copy = self.copy_file(share_name, directory_name, file_name, None)
+        return File(file_name, props=properties)
+
+    def abort_copy_file(self, share_name, directory_name, file_name, copy_id):
+        self.aborted.append(('%s/%s' % (directory_name, file_name), copy_id))
+
+
+def test_copy_azure_file_timeout(monkeypatch):
+    """
+    Tests server side copies that do not finish in time are aborted, with the wait between checks growing
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Copy Azure File Timeout".center(79, '-'))
+
+    monkeypatch.setitem(cloud_utils.__options, 'azure', dict(cloud_utils.__options['azure'], copy_timeout=100))
+    clock = [0]
+    delays = list()
+    monkeypatch.setattr(archive_utils.time, 'time', lambda: clock[0])
+
+    def sleep(seconds):
+        delays.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(archive_utils.time, 'sleep', sleep)
+    file_service = _PendingFileService()
+    with pytest.raises(AzureException):
+        archive_utils._copy_azure_file(file_service, 'bootstrap', 'shared/software/PanOS_vm-9.0.0',
+                                       'panos-cloud/software/PanOS_vm-9.0.0')
+
+    assert delays == [1, 2, 4, 8, 16, 30, 30, 9]
+    assert file_service.aborted == [('panos-cloud/software/PanOS_vm-9.0.0', 'copy-id')]
+
+
+class _Blob(object):
+    """
+    Records an upload of create_gcp_bucket, in place of a GCS blob
+    """
+
+    def __init__(self, bucket, name, chunk_size=None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+
+    def upload_from_string(self, data, content_type=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.bucket.blobs[self.name] = (data, self.chunk_size)
+
+    def upload_from_filename(self, filename):
+        with open(filename, 'rb') as f:
+            self.bucket.blobs[self.name] = (f.read(), self.chunk_size)
+
+    def rewrite(self, source, token=None):
+        # large blobs are rewritten in two calls
+        if token is None and len(self.bucket.blobs[source.name][0]) > 1024 * 1024:
+            return 'token', 1024 * 1024, len(self.bucket.blobs[source.name][0])
+        self.bucket.blobs[self.name] = (self.bucket.blobs[source.name][0], None)
+        return None, len(self.bucket.blobs[source.name][0]), len(self.bucket.blobs[source.name][0])
+
+
+class _Bucket(object):
+    """
+    Records the uploads of create_gcp_bucket, in place of a GCS bucket and client
+    """
+
+    def __init__(self):
+        self.blobs = dict()
+
+    def create_bucket(self, bucket_name):
+        self.name = bucket_name
+        return self
+
+    def bucket(self, bucket_name):
+        self.name = bucket_name
+        return self
+
+    def blob(self, name, chunk_size=None):
+        return _Blob(self, name, chunk_size)
+
+    def get_blob(self, name):
+        if name not in self.blobs:
+            return None
+        blob = _Blob(self, name)
+        blob.size = len(self.blobs[name][0])
+        return blob
+
+
+def test_create_gcp_bucket(tmpdir, monkeypatch):
+    """
+    Tests large files are sent in resumable uploads and the upload time of every blob is returned
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Create GCP Bucket".center(79, '-'))
+
+    monkeypatch.setattr(archive_utils, '_archive_dir', str(tmpdir.join('archives')))
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(tmpdir.join('content_updates')))
+    monkeypatch.setitem(cloud_utils.__options, 'gcp', dict(cloud_utils.__options['gcp'],
+                                                            resumable_threshold=1024 * 1024, chunk_size=1024 * 1024))
+    bucket = _Bucket()
+    monkeypatch.setattr(cloud_utils, 'get_gcp_client', lambda project_id, access_token: bucket)
+
+    timings = list()
+    response = archive_utils.create_gcp_bucket(_files(tmpdir), 'panos-cloud', 'project', 'token', timings)
+    assert response == 'GCP Bucket {} created successfully'.format(bucket.name)
+    assert sorted(bucket.blobs) == ['config/', 'config/bootstrap.xml', 'config/init-cfg.txt', 'content/', 'license/',
+                                    'software/', 'software/PanOS_vm-9.0.0']
+    assert bucket.blobs['software/PanOS_vm-9.0.0'] == (tmpdir.join('PanOS_vm-9.0.0').read_binary(), 1024 * 1024)
+    assert bucket.blobs['config/init-cfg.txt'] == (b'type=dhcp-client\nhostname=panos-cloud\n', None)
+    # nothing is staged on disk
+    assert not tmpdir.join('archives').check()
+
+    assert sorted(t['name'] for t in timings) == sorted(bucket.blobs)
+    assert [t['size'] for t in timings if t['name'] == 'software/PanOS_vm-9.0.0'] == [6 * 1024 * 1024]
+    assert all(t['seconds'] >= 0 for t in timings)
+
+
+def test_create_gcp_bucket_shared(tmpdir, monkeypatch):
+    """
+    Tests packages are uploaded under their own prefix of a shared bucket, with content updates and software images
+    uploaded once and rewritten into each prefix
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Create GCP Bucket Shared".center(79, '-'))
+
+    _content_update(tmpdir, monkeypatch)
+    monkeypatch.setitem(cloud_utils.__options, 'gcp', dict(cloud_utils.__options['gcp'], shared_bucket='bootstrap'))
+    bucket = _Bucket()
+    monkeypatch.setattr(cloud_utils, 'get_gcp_client', lambda project_id, access_token: bucket)
+    uploaded = _record_shared(monkeypatch)
+
+    files = _files(tmpdir)
+    prefixes = list()
+    for _ in range(2):
+        response = archive_utils.create_gcp_bucket(files, 'panos-cloud', 'project', 'token')
+        assert response.startswith('GCP Bucket bootstrap prefix panos-cloud-')
+        prefixes.append(response.split()[4])
+
+    assert sorted(u for u in uploaded if u[1]) == [('shared/content/panupv2-all-antivirus-3000-3500', True),
+                                             ('shared/software/PanOS_vm-9.0.0', True)]
+    assert len(uploaded) == 4
+    for prefix in prefixes:
+        assert bucket.blobs[prefix + '/software/PanOS_vm-9.0.0'][0] == tmpdir.join('PanOS_vm-9.0.0').read_binary()
+        assert bucket.blobs[prefix + '/content/panupv2-all-antivirus-3000-3500'][0] == b'threat-id 1\n' * 1000
+        assert prefix + '/config/init-cfg.txt' in bucket.blobs
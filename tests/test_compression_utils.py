@@ -0,0 +1,100 @@
+import gzip
+import zlib
+
+import pytest
+
+from bootstrapper.lib import compression_utils
+
+
+def test_resolve_options():
+    """
+    Tests request overrides are merged over the configured settings and validated
+    :return: test assertions
+    """
+    print("Test: Resolve Compression Options".center(79, '-'))
+
+    options = compression_utils.resolve_options({'level': 9}, {'store_compressed': 'false', 'threads': '4'})
+    assert options['level'] == 9
+    assert options['store_compressed'] is False
+    assert options['threads'] == 4
+    assert compression_utils.resolve_options() == compression_utils.default_options
+
+    for overrides in ({'level': 10}, {'level': 'fast'}, {'threads': -1}, {'store_compressed': 'maybe'},
+                      {'parallel_min_size': -1}, {'method': 'bzip2'}):
+        with pytest.raises(ValueError):
+            compression_utils.resolve_options(None, overrides)
+
+
+def test_is_compressed(tmpdir):
+    """
+    Tests already compressed files are found by extension or magic number
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Is Compressed".center(79, '-'))
+
+    assert compression_utils.is_compressed('PanOS_vm-9.0.0.tgz', b'')
+    assert compression_utils.is_compressed('panupv2-all-contents-8000-5000', b'\x1f\x8b\x08\x00')
+    assert compression_utils.is_compressed('software.bin', b'\xfd7zXZ\x00\x00')
+    assert not compression_utils.is_compressed('bootstrap.xml', b'<config')
+    assert not compression_utils.is_compressed('archive.tgz', b'', store_extensions=['.zip'])
+
+    plain = tmpdir.join('init-cfg.txt')
+    plain.write_binary(b'type=dhcp-client\n')
+    assert not compression_utils.is_compressed_file(str(plain))
+
+
+def _gzip_members(stream):
+    """
+    Decompresses a gzip stream member by member
+    :return: list of the decompressed members
+    """
+    members = list()
+    while stream:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        members.append(decompressor.decompress(stream))
+        assert decompressor.eof
+        stream = decompressor.unused_data
+
+    return members
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+def test_iter_gzip(monkeypatch, threads):
+    """
+    Tests parallel and serial compression produce a single gzip stream, including stored data
+    :param monkeypatch: pytest monkeypatch
+    :param threads: number of compression threads
+    :return: test assertions
+    """
+    print("Test: Iter Gzip".center(79, '-'))
+
+    # small blocks so the parallel mode splits the input
+    monkeypatch.setattr(compression_utils, '_block_size', 4096)
+    image = b'\x1f\x8b' + bytes(range(256)) * 200
+    data = [b'header %d\n' % i for i in range(1000)] + [{'stored': [image[:100], image[100:]]}]
+    data += [b'trailer %d\n' % i for i in range(5000)]
+    expected = b''.join(d if isinstance(d, bytes) else image for d in data)
+
+    stream = b''.join(compression_utils.iter_gzip(iter(data), compresslevel=6, threads=threads,
+                                                  parallel_min_size=1024))
+    assert _gzip_members(stream) == [expected]
+    assert gzip.decompress(stream) == expected
+
+    stored = b''.join(compression_utils.iter_gzip([b'abc' * 1000], compresslevel=0, threads=threads,
+                                                  parallel_min_size=0))
+    assert len(stored) > 3000
+    assert gzip.decompress(stored) == b'abc' * 1000
+
+
+def test_iter_gzip_members():
+    """
+    Tests already compressed gzip members are copied in between the compressed streams
+    :return: test assertions
+    """
+    print("Test: Iter Gzip Members".center(79, '-'))
+
+    member = gzip.compress(b'precompressed')
+    data = [b'before', {'gzip_member': [member[:5], member[5:]]}, b'after']
+    stream = b''.join(compression_utils.iter_gzip(data, threads=1))
+    assert _gzip_members(stream) == [b'before', b'precompressed', b'after']
@@ -0,0 +1,89 @@
+import hashlib
+import os
+
+from bootstrapper.lib import content_catalog
+
+
+def _touch_dir(path, offset):
+    """
+    Moves the directory mtime forward, file system timestamps are too coarse to rely on between quick writes
+    """
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + offset))
+
+
+def test_parse_version():
+    """
+    Tests content update versions compare numerically instead of lexically
+    :return: test assertions
+    """
+    print("Test: Parse Version".center(79, '-'))
+
+    assert content_catalog.parse_version('panupv2-all-contents-8000-5000') == (8000, 5000)
+    assert content_catalog.parse_version('panup-all-wildfire-400000-400500') == (400000, 400500)
+    assert content_catalog.parse_version('README') == tuple()
+    assert content_catalog.parse_version('panupv2-all-contents-10000-5000') > \
+        content_catalog.parse_version('panupv2-all-contents-9999-5000')
+
+
+def test_get_latest(tmpdir, monkeypatch):
+    """
+    Tests the latest update is cached until the directory changes
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: Get Latest Content Update".center(79, '-'))
+
+    monkeypatch.setattr(content_catalog, '_digest_dir', str(tmpdir.join('digests')))
+
+    package_dir = tmpdir.mkdir('antivirus')
+    assert content_catalog.get_latest(str(tmpdir.join('missing'))) is None
+    assert content_catalog.get_latest(str(package_dir)) is None
+
+    package_dir.join('panupv2-all-antivirus-999-1000').write_binary(b'OLDER')
+    package_dir.join('panupv2-all-antivirus-1000-1001').write_binary(b'NEWER')
+    package_dir.join('.panupv2-all-antivirus-2000-2000.partial').write_binary(b'PARTIAL')
+    _touch_dir(str(package_dir), 1000)
+
+    latest = content_catalog.get_latest(str(package_dir))
+    assert latest['name'] == 'panupv2-all-antivirus-1000-1001'
+    assert latest['version'] == '1000-1001'
+    assert latest['size'] == 5
+    assert latest['sha256'] == hashlib.sha256(b'NEWER').hexdigest()
+    assert content_catalog.get_latest(str(package_dir)) is latest
+
+    package_dir.join('panupv2-all-antivirus-1001-1002').write_binary(b'NEWEST!')
+    _touch_dir(str(package_dir), 2000)
+    latest = content_catalog.get_latest(str(package_dir))
+    assert latest['name'] == 'panupv2-all-antivirus-1001-1002'
+    assert latest['sha256'] == hashlib.sha256(b'NEWEST!').hexdigest()
+
+
+def test_file_digest(tmpdir, monkeypatch):
+    """
+    Tests digests are stored on disk and reused by other workers until the file changes
+    :param tmpdir: pytest tmpdir
+    :param monkeypatch: pytest monkeypatch
+    :return: test assertions
+    """
+    print("Test: File Digest".center(79, '-'))
+
+    monkeypatch.setattr(content_catalog, '_digest_dir', str(tmpdir.join('digests')))
+    image = tmpdir.join('PanOS_vm-9.0.0')
+    image.write_binary(b'IMAGE')
+    assert content_catalog.file_digest(str(image)) == hashlib.sha256(b'IMAGE').hexdigest()
+
+    # a fresh worker reads the stored digest instead of hashing the file again
+    content_catalog.clear()
+    hashed = list()
+    sha256_file = content_catalog.sha256_file
+    monkeypatch.setattr(content_catalog, 'sha256_file', lambda path: hashed.append(path) or sha256_file(path))
+    assert content_catalog.file_digest(str(image)) == hashlib.sha256(b'IMAGE').hexdigest()
+    assert hashed == []
+
+    image.write_binary(b'IMAGE2')
+    stat = os.stat(str(image))
+    os.utime(str(image), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert content_catalog.file_digest(str(image)) == hashlib.sha256(b'IMAGE2').hexdigest()
+    assert hashed == [str(image)]
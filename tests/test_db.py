@@ -0,0 +1,22 @@
+from sqlalchemy import create_engine
+from sqlalchemy import inspect
+
+from bootstrapper.lib import db
+
+
+def test_upgrade_db(tmpdir):
+    """
+    Tests missing columns are added to databases from older versions once, and up to date databases are left alone
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Upgrade DB".center(79, '-'))
+
+    engine = create_engine('sqlite:///%s' % tmpdir.join('bootstrapper.db'))
+    with engine.connect() as connection:
+        connection.execute('CREATE TABLE templates (id INTEGER PRIMARY KEY, name VARCHAR(50), type VARCHAR(32), '
+                           'description VARCHAR(120), template VARCHAR)')
+
+    assert db.upgrade_db(engine) == ['variables']
+    assert 'variables' in [c['name'] for c in inspect(engine).get_columns('templates')]
+    assert db.upgrade_db(engine) == []
@@ -0,0 +1,47 @@
+import os
+
+from bootstrapper.lib import file_utils
+
+
+def test_iter_file(tmpdir):
+    """
+    Tests files are read in chunks through a memory map
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Iter File".center(79, '-'))
+
+    source = tmpdir.join('panupv2-all-contents-8000-5000')
+    source.write_binary(os.urandom(10000))
+    chunks = list(file_utils.iter_file(str(source), chunk_size=4096))
+    assert [len(c) for c in chunks] == [4096, 4096, 1808]
+    assert b''.join(chunks) == source.read_binary()
+
+    part = list(file_utils.iter_file(str(source), chunk_size=4096, offset=4000, length=5000))
+    assert [len(c) for c in part] == [4096, 904]
+    assert b''.join(part) == source.read_binary()[4000:9000]
+
+    empty = tmpdir.join('empty')
+    empty.write_binary(b'')
+    assert list(file_utils.iter_file(str(empty))) == []
+
+
+def test_link_or_copy(tmpdir):
+    """
+    Tests files are hard linked when possible and copied otherwise
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Link Or Copy".center(79, '-'))
+
+    source = tmpdir.join('PanOS_vm-9.0.0')
+    source.write_binary(os.urandom(100000))
+
+    linked = tmpdir.join('linked')
+    file_utils.link_or_copy(str(source), str(linked))
+    assert os.path.samefile(str(source), str(linked))
+
+    copied = tmpdir.join('copied')
+    file_utils.copy_file(str(source), str(copied))
+    assert not os.path.samefile(str(source), str(copied))
+    assert copied.read_binary() == source.read_binary()
@@ -0,0 +1,103 @@
+import io
+import struct
+
+import pytest
+
+from bootstrapper.lib import iso_utils
+
+
+def _entries(tmpdir):
+    content_update = tmpdir.join('panupv2-all-contents-8000-5000')
+    content_update.write_binary(b'\x1f\x8b' + b'CONTENT' * 1000)
+    return [
+        ('config/', None),
+        ('content/', None),
+        ('software/', None),
+        ('license/', None),
+        ('content/panupv2-all-contents-8000-5000', str(content_update)),
+        ('config/init-cfg.txt', b'type=dhcp-client\nhostname=panos-iso\n'),
+        ('config/bootstrap.xml', b'<config/>'),
+        ('license/authcodes', b'ABC123'),
+        ('heat-template.yaml', b''),
+    ]
+
+
+def test_iso_layout(tmpdir):
+    """
+    Tests the volume descriptors written by the built in ISO writer
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: ISO Layout".center(79, '-'))
+
+    layout = iso_utils.build_layout(_entries(tmpdir))
+    image = b''.join(iso_utils.iter_image(layout))
+    assert len(image) == layout['size']
+    assert len(image) % iso_utils.sector_size == 0
+
+    pvd = image[16 * iso_utils.sector_size:17 * iso_utils.sector_size]
+    assert pvd[0:7] == b'\x01CD001\x01'
+    assert pvd[40:72].rstrip() == b'bootstrap'
+    assert struct.unpack('<I', pvd[80:84])[0] == layout['sectors']
+
+    svd = image[17 * iso_utils.sector_size:18 * iso_utils.sector_size]
+    assert svd[0:7] == b'\x02CD001\x01'
+    assert svd[88:91] == b'%/E'
+    assert svd[40:72].decode('utf-16-be').rstrip() == 'bootstrap'
+
+    terminator = image[18 * iso_utils.sector_size:19 * iso_utils.sector_size]
+    assert terminator[0:7] == b'\xffCD001\x01'
+
+
+def test_iso_names():
+    """
+    Tests primary volume names are shortened and kept unique like mkisofs -l -allow-lowercase -allow-multidot
+    :return: test assertions
+    """
+    print("Test: ISO Names".center(79, '-'))
+
+    used = set()
+    assert iso_utils._iso_name('init-cfg.txt', False, used) == b'init_cfg.txt;1'
+    assert iso_utils._iso_name('authcodes', False, used) == b'authcodes.;1'
+    assert iso_utils._iso_name('config', True, used) == b'config'
+    long_name = 'panupv2-all-contents-8000-5000-and-some-more'
+    first = iso_utils._iso_name(long_name, False, used)
+    second = iso_utils._iso_name(long_name + '-again', False, used)
+    assert len(first) <= 33
+    assert first != second
+
+
+def test_iso_read_back(tmpdir):
+    """
+    Tests the image can be read back through the Rock Ridge and Joliet trees
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    pycdlib = pytest.importorskip('pycdlib')
+    print("Test: ISO Read Back".center(79, '-'))
+
+    entries = _entries(tmpdir)
+    iso_file = tmpdir.join('bootstrap.iso')
+    with open(str(iso_file), 'wb') as f:
+        for chunk in iso_utils.iter_image(iso_utils.build_layout(entries)):
+            f.write(chunk)
+
+    iso = pycdlib.PyCdlib()
+    iso.open(str(iso_file))
+    try:
+        assert iso.has_rock_ridge()
+        assert iso.has_joliet()
+        for path, source in entries:
+            if source is None:
+                continue
+
+            if isinstance(source, str):
+                with open(source, 'rb') as f:
+                    source = f.read()
+
+            for kwargs in ({'rr_path': '/' + path}, {'joliet_path': '/' + path}):
+                contents = io.BytesIO()
+                iso.get_file_from_iso_fp(contents, **kwargs)
+                assert contents.getvalue() == source
+    finally:
+        iso.close()
@@ -0,0 +1,148 @@
+import gzip
+import io
+import os
+import tarfile
+import zipfile
+import zlib
+
+from bootstrapper.lib import archive_utils
+from bootstrapper.lib import member_store
+
+
+def test_get_member(tmpdir):
+    """
+    Tests files are compressed into the store once and can be copied out as gzip members
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Get Precompressed Member".center(79, '-'))
+
+    store_dir = str(tmpdir.join('store'))
+    source = tmpdir.join('panupv2-all-apps-8000-5000')
+    source.write_binary(b'application signatures ' * 10000)
+
+    member = member_store.get_member(str(source), store_dir)
+    assert member['size'] == len(source.read_binary())
+    assert member['crc32'] == zlib.crc32(source.read_binary())
+    assert member['compressed_size'] < member['size']
+    assert len(os.listdir(store_dir)) == 2
+
+    # a renamed copy of the same contents is served from the store
+    renamed = tmpdir.join('panupv2-all-apps-8000-5000.renamed')
+    renamed.write_binary(source.read_binary())
+    assert member_store.get_member(str(renamed), store_dir)['deflate_path'] == member['deflate_path']
+
+    stream = b''.join(member_store.iter_gzip_member(member)) + gzip.compress(b'trailer')
+    assert gzip.decompress(stream) == source.read_binary() + b'trailer'
+
+    assert member_store.prune(store_dir, 0) == 1
+    assert os.listdir(store_dir) == []
+
+
+def test_prune(tmpdir):
+    """
+    Tests members in use count towards the size of the store but are never removed
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Prune Precompressed Members".center(79, '-'))
+
+    store_dir = str(tmpdir.join('store'))
+    older = tmpdir.join('panupv2-all-apps-8000-5000')
+    older.write_binary(b'application signatures ' * 10000)
+    newer = tmpdir.join('PanOS_vm-9.0.0')
+    newer.write_binary(b'software image ' * 20000)
+
+    older_member = member_store.get_member(str(older), store_dir)
+    os.utime(older_member['deflate_path'][:-len('.deflate')] + '.json', (1, 1))
+    newer_member = member_store.get_member(str(newer), store_dir)
+    newer_meta = newer_member['deflate_path'][:-len('.deflate')] + '.json'
+
+    # the store only fits the member in use, so the other one goes even though it alone is under the limit
+    assert member_store.prune(store_dir, newer_member['compressed_size'], keep=(newer_meta,)) == 1
+    assert not os.path.exists(older_member['deflate_path'])
+    assert os.path.exists(newer_member['deflate_path'])
+
+    assert member_store.prune(store_dir, 0, keep=(newer_meta,)) == 0
+    assert os.path.exists(newer_member['deflate_path'])
+
+
+def test_archives_with_precompressed_members(monkeypatch, tmpdir):
+    """
+    Tests zip and tgz archives built from precompressed members are readable
+    :param monkeypatch: pytest monkeypatch
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Archives With Precompressed Members".center(79, '-'))
+
+    content_dir = tmpdir.mkdir('content_updates')
+    contents = b'threat signatures ' * 10000
+    content_dir.mkdir('appthreat').join('panupv2-all-contents-8000-5000').write_binary(contents)
+    incompressible = os.urandom(100000)
+    content_dir.mkdir('antivirus').join('panupv2-all-antivirus-3000-3500').write_binary(incompressible)
+
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(content_dir))
+    monkeypatch.setitem(archive_utils.__options, 'precompressed_dir', str(tmpdir.join('store')))
+    monkeypatch.setitem(archive_utils.__options, 'precompressed_min_size', 0)
+    files = {'init-cfg.txt': {'archive_path': 'config', 'contents': 'hostname=panos-precompressed\n'}}
+
+    for _ in range(2):
+        with zipfile.ZipFile(archive_utils.create_archive_buffer(files, 'precompressed')) as zf:
+            assert zf.testzip() is None
+            info = zf.getinfo('content/panupv2-all-contents-8000-5000')
+            assert info.compress_type == zipfile.ZIP_DEFLATED
+            assert zf.read(info) == contents
+            info = zf.getinfo('content/panupv2-all-antivirus-3000-3500')
+            assert info.compress_type == zipfile.ZIP_STORED
+            assert zf.read(info) == incompressible
+            assert zf.read('config/init-cfg.txt') == b'hostname=panos-precompressed\n'
+
+        tgz = archive_utils.create_tgz_buffer(files, 'precompressed').read()
+        with tarfile.open(fileobj=io.BytesIO(tgz), mode='r:gz') as tar:
+            assert tar.extractfile('./content/panupv2-all-contents-8000-5000').read() == contents
+            assert tar.extractfile('./content/panupv2-all-antivirus-3000-3500').read() == incompressible
+            assert tar.extractfile('./config/init-cfg.txt').read() == b'hostname=panos-precompressed\n'
+
+
+def test_stored_members(monkeypatch, tmpdir):
+    """
+    Tests files that are already compressed go through the member store at level 0, which keeps only their crc32 and
+    size and copies their data from the source file into zip and tgz archives
+    :param monkeypatch: pytest monkeypatch
+    :param tmpdir: pytest tmpdir
+    :return: test assertions
+    """
+    print("Test: Stored Precompressed Members".center(79, '-'))
+
+    store_dir = str(tmpdir.join('store'))
+    for size in (0, 1000, 200000):
+        source = tmpdir.join('PanOS_vm-9.0.%d' % size)
+        source.write_binary(os.urandom(size))
+        member = member_store.get_member(str(source), store_dir, 0)
+        assert 'deflate_path' not in member
+        assert member['crc32'] == zlib.crc32(source.read_binary())
+        assert gzip.decompress(b''.join(member_store.iter_gzip_member(member))) == source.read_binary()
+
+    # only the json files are kept
+    assert all(name.endswith('.json') for name in os.listdir(store_dir))
+
+    content_dir = tmpdir.mkdir('content_updates')
+    contents = gzip.compress(b'threat signatures ' * 10000)
+    content_dir.mkdir('appthreat').join('panupv2-all-contents-8000-5000').write_binary(contents)
+    monkeypatch.setattr(archive_utils, '_content_update_dir', str(content_dir))
+    monkeypatch.setitem(archive_utils.__options, 'precompressed_dir', str(tmpdir.join('archive_store')))
+    monkeypatch.setitem(archive_utils.__options, 'precompressed_min_size', 0)
+    files = {'init-cfg.txt': {'archive_path': 'config', 'contents': 'hostname=panos-stored\n'}}
+
+    with zipfile.ZipFile(archive_utils.create_archive_buffer(files, 'stored')) as zf:
+        info = zf.getinfo('content/panupv2-all-contents-8000-5000')
+        assert info.compress_type == zipfile.ZIP_STORED
+        # the crc came from the member store, so no data descriptor was needed
+        assert not info.flag_bits & 0x08
+        assert zf.read(info) == contents
+
+    tgz = archive_utils.create_tgz_buffer(files, 'stored').read()
+    with tarfile.open(fileobj=io.BytesIO(tgz), mode='r:gz') as tar:
+        assert tar.extractfile('./content/panupv2-all-contents-8000-5000').read() == contents
+    assert len(os.listdir(str(tmpdir.join('archive_store')))) == 1